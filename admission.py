@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Допуск обновлений до обработки: whitelist и лимиты частоты.
+
+Решение принимается локально, до постановки в очередь и до любых
+запросов к Telegram и OpenAI. У каждого пользователя и каждого чата
+есть корзина токенов (token bucket): она пополняется с постоянной
+скоростью, а обновление списывает из нее свою стоимость (фото и
+генерация изображения дороже текста). Если токенов не хватает,
+обновление отбрасывается.
+
+Ответ об отказе (нет в whitelist или превышен лимит) отправляется
+пользователю не чаще notice_interval секунд, чтобы поток сообщений от
+одного человека не превращался в такой же поток ответов.
+"""
+
+import time
+import threading
+from collections import Counter, OrderedDict
+
+# Виды обновлений (стоимость задается для каждого)
+KIND_TEXT = "text"
+KIND_PHOTO = "photo"
+KIND_IMAGE = "image"
+KIND_OTHER = "other"
+
+# Результаты допуска
+ADMITTED = "admitted"
+DENIED = "denied"
+USER_RATE = "user_rate"
+CHAT_RATE = "chat_rate"
+
+
+class TokenBucket:
+    """Корзина на burst токенов, пополняемая со скоростью rate токенов в секунду"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def can_take(self, cost):
+        # Стоимость больше емкости корзины списывается только из полной корзины
+        return self.tokens >= min(cost, self.burst)
+
+    def take(self, cost):
+        self.tokens -= min(cost, self.burst)
+
+
+class _Buckets:
+    """Корзины по ключу с вытеснением давно не использованных (LRU)"""
+
+    def __init__(self, per_minute, burst, max_keys):
+        self.rate = per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def get(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.refill(now)
+        return bucket
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class AdmissionControl:
+    """Лимиты частоты по пользователям и чатам, whitelist и ограничение ответов об отказе"""
+
+    def __init__(self, is_allowed, user_rate=20, user_burst=30, chat_rate=60, chat_burst=60,
+                 costs=None, notice_interval=60.0, max_keys=10000):
+        # is_allowed(user_id) - проверка whitelist
+        self.is_allowed = is_allowed
+        self.costs = costs or {}
+        self.notice_interval = notice_interval
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        # rate <= 0 отключает лимит
+        self._users = _Buckets(user_rate, user_burst, max_keys) if user_rate > 0 else None
+        self._chats = _Buckets(chat_rate, chat_burst, max_keys) if chat_rate > 0 else None
+        self._notified = OrderedDict()
+        self.results = Counter()
+        self.notices = Counter()
+
+    def admit(self, user_id, chat_id, kind):
+        """ADMITTED или причина отказа (DENIED, USER_RATE, CHAT_RATE)"""
+        if user_id is not None and not self.is_allowed(user_id):
+            return self._record(kind, DENIED)
+        cost = self.costs.get(kind, 1)
+        now = time.monotonic()
+        with self._lock:
+            user_bucket = chat_bucket = None
+            if self._users is not None and user_id is not None:
+                user_bucket = self._users.get(user_id, now)
+            if self._chats is not None and chat_id is not None:
+                chat_bucket = self._chats.get(chat_id, now)
+            if user_bucket is not None and not user_bucket.can_take(cost):
+                result = USER_RATE
+            elif chat_bucket is not None and not chat_bucket.can_take(cost):
+                result = CHAT_RATE
+            else:
+                for bucket in (user_bucket, chat_bucket):
+                    if bucket is not None:
+                        bucket.take(cost)
+                result = ADMITTED
+        return self._record(kind, result)
+
+    def _record(self, kind, result):
+        with self._lock:
+            self.results[(kind, result)] += 1
+        return result
+
+    def should_notify(self, user_id, reason):
+        """Можно ли сейчас ответить пользователю об отказе (не чаще notice_interval)"""
+        key = (user_id, reason)
+        now = time.monotonic()
+        with self._lock:
+            notified_at = self._notified.get(key)
+            if notified_at is not None and now - notified_at < self.notice_interval:
+                self.notices["suppressed"] += 1
+                return False
+            self._notified[key] = now
+            self._notified.move_to_end(key)
+            if len(self._notified) > self.max_keys:
+                self._notified.popitem(last=False)
+            self.notices["sent"] += 1
+            return True
+
+    def stats(self):
+        """Принятые и отброшенные обновления по видам и причинам, ответы об отказе"""
+        with self._lock:
+            admitted = Counter()
+            shed = Counter()
+            shed_by_kind = Counter()
+            for (kind, result), count in self.results.items():
+                if result == ADMITTED:
+                    admitted[kind] += count
+                else:
+                    shed[result] += count
+                    shed_by_kind[kind] += count
+            return {
+                "admitted": dict(admitted),
+                "shed": dict(shed),
+                "shed_by_kind": dict(shed_by_kind),
+                "notices_sent": self.notices["sent"],
+                "notices_suppressed": self.notices["suppressed"],
+                "tracked_users": len(self._users) if self._users is not None else 0,
+                "tracked_chats": len(self._chats) if self._chats is not None else 0,
+            }
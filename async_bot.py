@@ -0,0 +1,653 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Асинхронный режим бота: AsyncTeleBot + AsyncOpenAI + aiohttp.
+
+Запуск: python async_bot.py (синхронный режим по-прежнему: python bot.py)
+
+Каждое обновление обрабатывается отдельной задачей asyncio, поэтому один
+процесс обслуживает сотни одновременных диалогов без потока на каждый.
+Настройки, хранилище, тексты и сборка запросов общие с bot.py; операции
+с диском и обработка изображений выполняются в пуле потоков.
+"""
+
+import os
+import sys
+import time
+import signal
+import asyncio
+
+from openai import AsyncOpenAI
+from telebot import asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+from telebot.asyncio_helper import ApiTelegramException
+
+import logs
+import metrics
+from bot import (
+    TG_BOT_TOKEN, TELEGRAM_API_URL, TELEGRAM_FILE_URL, OPENAI_API_KEY, MODELS, STREAM_RESPONSES,
+    SEARCH_CACHE_SIZE, GOOGLE_SEARCH_URL, SEARCH_NOT_CONFIGURED_TEXT, TOOL_TIMEOUTS, DEFAULT_TOOL_TIMEOUT,
+    TOOL_RESULT_INLINE_LIMIT, METRICS_HOST, METRICS_PORT, IMAGE_GENERATION_PARAMS, IMAGE_HISTORY_TEXT,
+    IMAGE_HISTORY_THUMBNAIL,
+    HISTORY_CLEARED_TEXT, SEARCHING_TEXT, EMPTY_RESPONSE_TEXT, IMAGE_USAGE_TEXT, IMAGE_PROGRESS_TEXT,
+    IMAGE_ERROR_TEXT, IMAGE_QUEUED_TEXT, IMAGE_QUEUE_FULL_TEXT, IMAGE_USER_LIMIT_TEXT,
+    IMAGE_WORKERS, IMAGE_QUEUE_LIMIT, IMAGE_JOBS_PER_USER, PHOTO_ERROR_TEXT, MESSAGE_ERROR_TEXT, HISTORY_DIR, STORAGE_BACKEND,
+    storage, blob_store, search_cache, compactor, model_latency, openai_scheduler, record_model_latency,
+    estimate_request_tokens,
+    admission, admit_update, update_chat_id, update_user, DENIED, CHAT_BUSY, CHAT_BUSY_TEXT,
+    CHAT_QUEUE_LIMIT, UPDATE_QUEUE_LIMIT,
+    SEARCH_PREFETCH_RESULTS, search_prefetcher, prefetch_enabled, claim_search_prefetch, finish_search_prefetch,
+    is_user_allowed, build_access_denied_text, build_welcome_text, build_menu_text,
+    build_model_selection_text, build_stats_text, build_image_caption, build_photo_message,
+    photo_cache, photo_cache_key, get_cached_photo_part, build_photo_part,
+    photo_detail, build_openai_params, tool_calls_to_dicts, merge_tool_call_deltas,
+    parse_tool_call, is_google_search_configured, google_search_params, search_cache_key,
+    format_google_results, load_chat_history, save_chat_history, clear_chat_history,
+    get_user_model, resolve_model, set_user_model, get_image_history_mode, set_image_history_mode,
+    create_menu_keyboard, create_model_keyboard, StreamingReply
+)
+from blobs import make_tool_message
+from dispatcher import AsyncChatDispatcher
+from jobs import AsyncJobQueue, JobRejected, QUEUE_FULL
+from prefetch import Speculation, UNUSED
+from images import select_photo_size
+from telegram_html import html_to_text, render_chunks
+from http_client import create_aiohttp_session, create_async_openai_http_client
+
+log = logs.get_logger("async_bot")
+
+# Одновременных соединений с Telegram Bot API и OpenAI
+ASYNC_TELEGRAM_CONNECTIONS = int(os.getenv('ASYNC_TELEGRAM_CONNECTIONS', '200'))
+ASYNC_OPENAI_CONNECTIONS = int(os.getenv('ASYNC_OPENAI_CONNECTIONS', '500'))
+
+asyncio_helper.REQUEST_LIMIT = ASYNC_TELEGRAM_CONNECTIONS
+if TELEGRAM_API_URL:
+    asyncio_helper.API_URL = TELEGRAM_API_URL
+asyncio_helper.FILE_URL = TELEGRAM_FILE_URL
+bot = AsyncTeleBot(TG_BOT_TOKEN)
+
+openai_client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    max_retries=0,
+    http_client=create_async_openai_http_client(max_connections=ASYNC_OPENAI_CONNECTIONS)
+)
+
+# aiohttp сессия для Google Search создается при запуске event loop
+http = None
+# Очереди обработки по чатам и event loop, в котором они работают (start_dispatcher)
+chat_dispatcher = None
+# Очередь генерации изображений: обработчик /image не занимает очередь чата на время генерации
+image_jobs = None
+event_loop = None
+# Упреждающие поиски, результат которых модели не понадобился: задачи держатся здесь до завершения
+prefetch_tasks = set()
+
+
+async def check_user_access(message):
+    """Проверка доступа пользователя к боту"""
+    if is_user_allowed(message.from_user):
+        return True
+    if admission.should_notify(message.from_user.id, DENIED):
+        await bot.reply_to(message, build_access_denied_text(message.from_user.id), parse_mode='Markdown')
+    return False
+
+
+async def reply_to_update(update, text):
+    """Ответить на обновление, не обрабатывая его (сообщением или уведомлением для кнопки)"""
+    try:
+        if update.message is not None:
+            await bot.reply_to(update.message, text, parse_mode='Markdown')
+        elif update.callback_query is not None:
+            await bot.answer_callback_query(update.callback_query.id, text)
+    except Exception as e:
+        log.error("notice_failed", error=e)
+
+
+def start_dispatcher():
+    """Пропускать к обработчикам только допущенные обновления (до любых запросов к Telegram и OpenAI)
+    и обрабатывать их в очередях по чатам: сообщения одного чата - по очереди, разных - параллельно"""
+    global chat_dispatcher, image_jobs, event_loop
+    chat_dispatcher = AsyncChatDispatcher(max_chat_queue=CHAT_QUEUE_LIMIT, max_pending=UPDATE_QUEUE_LIMIT)
+    image_jobs = AsyncJobQueue(workers=IMAGE_WORKERS, max_pending=IMAGE_QUEUE_LIMIT,
+                               max_per_user=IMAGE_JOBS_PER_USER)
+    event_loop = asyncio.get_running_loop()
+    process_updates = bot.process_new_updates
+
+    async def process_update(update):
+        # Все записи в лог при обработке обновления помечаются его update_id
+        with logs.request_context(update.update_id):
+            await process_updates([update])
+
+    async def route_updates(updates):
+        for update in updates:
+            accepted, notice = admit_update(update)
+            if not accepted:
+                if notice:
+                    await reply_to_update(update, notice)
+                continue
+            if not await chat_dispatcher.submit(update_chat_id(update), process_update, update):
+                log.warning("chat_queue_full", update_id=update.update_id, chat_id=update_chat_id(update))
+                user = update_user(update)
+                if user is None or admission.should_notify(user.id, CHAT_BUSY):
+                    await reply_to_update(update, CHAT_BUSY_TEXT)
+
+    bot.process_new_updates = route_updates
+    if compactor is not None:
+        compactor.apply = apply_compaction
+
+
+def apply_compaction(chat_id, swap):
+    """Заменить историю сжатой в очереди чата (вызывается из потока сжатия)"""
+    submitted = asyncio.run_coroutine_threadsafe(
+        chat_dispatcher.submit(chat_id, asyncio.to_thread, swap), event_loop).result()
+    if not submitted:
+        log.warning("compaction_postponed", chat_id=chat_id, reason="chat queue is full")
+
+
+async def fetch_google_results(query, num_results=5):
+    """Запрос к Google Custom Search API (исключения не перехватываются)"""
+    async with http.get(GOOGLE_SEARCH_URL, params=google_search_params(query, num_results)) as response:
+        response.raise_for_status()
+        return format_google_results(await response.json(), query, num_results)
+
+
+async def google_search(query, num_results=5):
+    """Поиск в Google через Custom Search API (с кэшем и объединением одинаковых запросов)"""
+    try:
+        if not is_google_search_configured():
+            return SEARCH_NOT_CONFIGURED_TEXT
+
+        if SEARCH_CACHE_SIZE <= 0:
+            return await fetch_google_results(query, num_results)
+
+        key, ttl = search_cache_key(query, num_results)
+        return await search_cache.get_or_load_async(key, lambda: fetch_google_results(query, num_results), ttl)
+
+    except Exception as e:
+        log.error("google_search_failed", query=query, error=e)
+        return f"Ошибка поиска: {str(e)}"
+
+
+async def execute_tool_call(tool_call):
+    """Выполнить один вызов функции и вернуть результат в виде строки"""
+    function_name = tool_call["function"]["name"]
+    try:
+        function_name, function_args = parse_tool_call(tool_call)
+    except ValueError:
+        return f"Некорректные аргументы функции {function_name}"
+
+    started = time.perf_counter()
+    if function_name == "google_search":
+        function_response = await google_search(**function_args)
+    else:
+        function_response = f"Неизвестная функция: {function_name}"
+    metrics.tool_seconds.observe(time.perf_counter() - started, function=function_name)
+    return function_response
+
+
+def start_search_prefetch(text):
+    """Запустить поиск по тексту сообщения, если это вероятный поисковый вопрос (иначе None)"""
+    if not prefetch_enabled():
+        return None
+    target = search_prefetcher.query_for(text)
+    if target is None:
+        return None
+    query, category = target
+    task = asyncio.create_task(google_search(query, SEARCH_PREFETCH_RESULTS))
+    prefetch_tasks.add(task)
+    task.add_done_callback(prefetch_tasks.discard)
+    return Speculation(query, category, task)
+
+
+async def execute_tool_calls(tool_calls, speculation=None):
+    """Выполнить вызовы функций параллельно; результаты возвращаются в порядке tool_calls.
+
+    speculation - упреждающий поиск сообщения: подходящий вызов google_search получает его результат.
+    """
+    prefetched = claim_search_prefetch(speculation, tool_calls) if speculation is not None else None
+
+    async def run(index, tool_call):
+        function_name = tool_call["function"]["name"]
+        timeout = TOOL_TIMEOUTS.get(function_name, DEFAULT_TOOL_TIMEOUT)
+        try:
+            call = speculation.result if index == prefetched else execute_tool_call(tool_call)
+            result = await asyncio.wait_for(call, timeout)
+            metrics.tool_calls_total.inc(function=function_name, status="ok")
+            return result
+        except asyncio.TimeoutError:
+            log.warning("tool_call_timeout", function=function_name, timeout=timeout)
+            metrics.tool_calls_total.inc(function=function_name, status="timeout")
+            return f"Превышено время ожидания функции {function_name}"
+        except Exception as e:
+            log.error("tool_call_failed", function=function_name, error=e)
+            metrics.tool_calls_total.inc(function=function_name, status="error")
+            return f"Ошибка выполнения функции {function_name}: {str(e)}"
+
+    return await asyncio.gather(*(run(index, tool_call) for index, tool_call in enumerate(tool_calls)))
+
+
+class AsyncStreamingReply(StreamingReply):
+    """StreamingReply для AsyncTeleBot"""
+
+    async def update(self, text, force=False):
+        text = self._pending_text(text, force)
+        if text is None:
+            return
+
+        try:
+            if self.sent is None:
+                self.sent = await bot.reply_to(self.message, text + self.CURSOR)
+            else:
+                await bot.edit_message_text(text + self.CURSOR, self.chat_id, self.sent.message_id)
+            self._mark_shown(text)
+        except ApiTelegramException as e:
+            self._handle_edit_error(e)
+
+    async def finish(self, text):
+        chunks = render_chunks(text) or render_chunks(EMPTY_RESPONSE_TEXT)
+        first, rest = chunks[0], chunks[1:]
+
+        if self.sent is None:
+            self.sent = await self._send(first)
+        else:
+            await self._edit(first)
+
+        for chunk in rest:
+            await self._send(chunk)
+
+    async def _send(self, text):
+        return await send_html(self.message, text)
+
+    async def _edit(self, text):
+        try:
+            await bot.edit_message_text(text, self.chat_id, self.sent.message_id, parse_mode='HTML')
+        except ApiTelegramException as markup_error:
+            if 'message is not modified' in markup_error.description:
+                return
+            log.warning("markup_rejected", operation="edit", error=markup_error)
+            metrics.markdown_fallbacks_total.inc(operation="edit")
+            await bot.edit_message_text(html_to_text(text), self.chat_id, self.sent.message_id)
+
+
+async def create_chat_completion(params):
+    """Запрос chat.completions через openai_scheduler (лимиты и повторы)"""
+    return await openai_scheduler.call_async(params["model"], estimate_request_tokens(params),
+                                             openai_client.chat.completions.with_raw_response.create,
+                                             **params)
+
+
+async def complete_chat(model, messages, reply=None, use_tools=True, image_history=IMAGE_HISTORY_TEXT):
+    """Получить ответ модели в виде (текст, tool_calls); при reply - потоково"""
+    # Сборка контекста читает вложения с диска, поэтому выполняется в пуле потоков
+    params = await asyncio.to_thread(
+        build_openai_params, model, messages, 4000, use_tools, reply is not None, image_history)
+
+    started = time.perf_counter()
+    if reply is None:
+        response = await create_chat_completion(params)
+        elapsed = time.perf_counter() - started
+        record_model_latency(model, elapsed, elapsed)
+        metrics.record_usage(model, response.usage)
+        response_message = response.choices[0].message
+        return response_message.content, tool_calls_to_dicts(response_message.tool_calls)
+
+    stream = await create_chat_completion(params)
+    content = ""
+    tool_calls = {}
+    first_token_at = None
+    async for chunk in stream:
+        metrics.record_usage(model, chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if first_token_at is None and (delta.content or delta.tool_calls):
+            first_token_at = time.perf_counter()
+
+        if delta.content:
+            content += delta.content
+            await reply.update(content)
+
+        merge_tool_call_deltas(tool_calls, delta.tool_calls)
+
+    finished_at = time.perf_counter()
+    record_model_latency(model, (first_token_at or finished_at) - started, finished_at - started)
+    return content or None, [tool_calls[index] for index in sorted(tool_calls)]
+
+
+async def send_html(message, text):
+    """Ответить частью ответа в HTML (без разметки, если Telegram ее не принял)"""
+    try:
+        return await bot.reply_to(message, text, parse_mode='HTML')
+    except ApiTelegramException as markup_error:
+        log.warning("markup_rejected", operation="send", error=markup_error)
+        metrics.markdown_fallbacks_total.inc(operation="send")
+        return await bot.reply_to(message, html_to_text(text))
+
+
+async def send_answer(message, reply, text):
+    """Отправить окончательный ответ (дописать потоковое сообщение или ответить частями)"""
+    if reply is not None:
+        await reply.finish(text)
+        return
+    for chunk in render_chunks(text):
+        await send_html(message, chunk)
+
+
+@bot.message_handler(commands=['start', 'help'])
+async def send_welcome(message):
+    """Обработчик команд /start и /help"""
+    if not await check_user_access(message):
+        return
+
+    current_model = await asyncio.to_thread(get_user_model, message.chat.id)
+    await bot.reply_to(message, build_welcome_text(MODELS[current_model]["name"]), parse_mode='Markdown')
+
+
+@bot.message_handler(commands=['new'])
+async def new_conversation(message):
+    """Обработчик команды /new - очистка истории"""
+    if not await check_user_access(message):
+        return
+
+    await asyncio.to_thread(clear_chat_history, message.chat.id)
+    await bot.reply_to(message, HISTORY_CLEARED_TEXT, parse_mode='Markdown')
+
+
+@bot.message_handler(commands=['menu'])
+async def show_menu(message):
+    """Обработчик команды /menu - показать меню"""
+    if not await check_user_access(message):
+        return
+
+    chat_id = message.chat.id
+    current_model = await asyncio.to_thread(get_user_model, chat_id)
+    image_history = await asyncio.to_thread(get_image_history_mode, chat_id)
+    markup = create_menu_keyboard(image_history)
+    await bot.send_message(chat_id, build_menu_text(MODELS[current_model]["name"]),
+                           reply_markup=markup, parse_mode='Markdown')
+
+
+@bot.message_handler(commands=['stats'])
+async def show_stats(message):
+    """Обработчик команды /stats - статистика работы бота"""
+    if not await check_user_access(message):
+        return
+
+    await bot.reply_to(message, build_stats_text(), parse_mode='Markdown')
+
+
+@bot.message_handler(commands=['image', 'generate'])
+async def generate_image(message):
+    """Обработчик команды /image - генерация изображения"""
+    if not await check_user_access(message):
+        return
+
+    chat_id = message.chat.id
+    command_parts = message.text.split(maxsplit=1)
+
+    if len(command_parts) < 2:
+        await bot.reply_to(message, IMAGE_USAGE_TEXT, parse_mode='Markdown')
+        return
+
+    prompt = command_parts[1]
+    status_message = await bot.reply_to(message, IMAGE_PROGRESS_TEXT, parse_mode='Markdown')
+    trace = metrics.Trace("image", IMAGE_GENERATION_PARAMS["model"])
+
+    # Места в очереди, которые показывались пользователю
+    positions = []
+
+    async def show_position(position):
+        positions.append(position)
+        await bot.edit_message_text(IMAGE_QUEUED_TEXT.format(position=position), chat_id,
+                                    status_message.message_id, parse_mode='Markdown')
+
+    try:
+        image_jobs.submit(message.from_user.id, run_image_job, chat_id, prompt, status_message.message_id,
+                          trace, positions, on_position=show_position)
+    except JobRejected as e:
+        log.warning("image_job_rejected", user_id=message.from_user.id, reason=e.reason)
+        text = IMAGE_QUEUE_FULL_TEXT if e.reason == QUEUE_FULL else IMAGE_USER_LIMIT_TEXT
+        await bot.edit_message_text(text, chat_id, status_message.message_id, parse_mode='Markdown')
+        trace.finish()
+
+
+async def run_image_job(chat_id, prompt, status_message_id, trace, positions):
+    """Сгенерировать изображение и отправить его в чат (выполняется в очереди image_jobs)"""
+    metrics.stage_seconds.observe(time.perf_counter() - trace.started,
+                                  handler=trace.handler, stage="queue", model=trace.model)
+    try:
+        # Пока задача ждала, в сообщении было место в очереди
+        if positions:
+            await bot.edit_message_text(IMAGE_PROGRESS_TEXT, chat_id, status_message_id, parse_mode='Markdown')
+
+        with trace.span("generation"):
+            response = await openai_scheduler.call_async(IMAGE_GENERATION_PARAMS["model"], 0,
+                                                         openai_client.images.with_raw_response.generate,
+                                                         prompt=prompt, **IMAGE_GENERATION_PARAMS)
+        image_url = response.data[0].url
+        revised_prompt = response.data[0].revised_prompt
+
+        await bot.delete_message(chat_id, status_message_id)
+        with trace.span("reply"):
+            await bot.send_photo(chat_id, image_url, caption=build_image_caption(prompt, revised_prompt),
+                                 parse_mode='HTML')
+
+    except Exception:
+        log.exception("image_generation_failed", chat_id=chat_id)
+        trace.error()
+        await bot.edit_message_text(IMAGE_ERROR_TEXT, chat_id, status_message_id, parse_mode='Markdown')
+    finally:
+        trace.finish()
+
+
+@bot.message_handler(content_types=['photo'])
+async def handle_photo(message):
+    """Обработчик фотографий"""
+    if not await check_user_access(message):
+        return
+
+    chat_id = message.chat.id
+    await bot.send_chat_action(chat_id, 'typing')
+
+    trace = metrics.Trace("photo")
+    try:
+        user_model = await asyncio.to_thread(get_user_model, chat_id)
+        user_model = trace.model = resolve_model(chat_id, user_model, message.caption, attachments=1)
+        detail = photo_detail(message.caption)
+        photo = select_photo_size(message.photo, detail)
+        cache_key = photo_cache_key(photo, detail)
+        image_part = await asyncio.to_thread(get_cached_photo_part, cache_key)
+        if image_part is None:
+            with trace.span("download"):
+                file_info = await bot.get_file(photo.file_id)
+                photo_bytes = await bot.download_file(file_info.file_path)
+            # Уменьшение изображения и запись в blob_store - в пуле потоков
+            with trace.span("image_prepare"):
+                image_part = await asyncio.to_thread(build_photo_part, photo_bytes, detail, cache_key)
+
+        with trace.span("history_load"):
+            history = await asyncio.to_thread(load_chat_history, chat_id)
+        history.append(build_photo_message(message.caption, image_part))
+
+        image_history = await asyncio.to_thread(get_image_history_mode, chat_id)
+        reply = AsyncStreamingReply(message) if STREAM_RESPONSES else None
+        with trace.span("completion"):
+            assistant_message, _ = await complete_chat(user_model, history, reply, image_history=image_history)
+
+        if not assistant_message or assistant_message.strip() == "":
+            log.error("empty_response", model=user_model, tool_calls=0)
+            assistant_message = EMPTY_RESPONSE_TEXT
+
+        history.append({
+            "role": "assistant",
+            "content": assistant_message
+        })
+        with trace.span("history_save"):
+            await asyncio.to_thread(save_chat_history, chat_id, history)
+
+        with trace.span("reply"):
+            await send_answer(message, reply, assistant_message)
+
+    except Exception:
+        log.exception("photo_failed", chat_id=chat_id)
+        trace.error()
+        await bot.reply_to(message, PHOTO_ERROR_TEXT, parse_mode='Markdown')
+    finally:
+        trace.finish()
+
+
+@bot.message_handler(func=lambda message: True, content_types=['text'])
+async def handle_message(message):
+    """Обработчик текстовых сообщений"""
+    if not await check_user_access(message):
+        return
+
+    chat_id = message.chat.id
+    await bot.send_chat_action(chat_id, 'typing')
+
+    trace = metrics.Trace("message")
+    try:
+        user_model = await asyncio.to_thread(get_user_model, chat_id)
+        user_model = trace.model = resolve_model(chat_id, user_model, message.text)
+        speculation = start_search_prefetch(message.text)
+        with trace.span("history_load"):
+            history = await asyncio.to_thread(load_chat_history, chat_id)
+        history.append({
+            "role": "user",
+            "content": message.text
+        })
+
+        image_history = await asyncio.to_thread(get_image_history_mode, chat_id)
+        reply = AsyncStreamingReply(message) if STREAM_RESPONSES else None
+        with trace.span("completion"):
+            response_content, tool_calls = await complete_chat(user_model, history, reply,
+                                                               image_history=image_history)
+
+        if tool_calls:
+            history.append({
+                "role": "assistant",
+                "content": response_content,
+                "tool_calls": tool_calls
+            })
+
+            if reply is not None:
+                await reply.update(SEARCHING_TEXT, force=True)
+
+            with trace.span("tools"):
+                function_responses = await execute_tool_calls(tool_calls, speculation)
+            for tool_call, function_response in zip(tool_calls, function_responses):
+                history.append(await asyncio.to_thread(
+                    make_tool_message, blob_store, tool_call["id"], function_response, TOOL_RESULT_INLINE_LIMIT))
+
+            with trace.span("completion_after_tools"):
+                assistant_message, _ = await complete_chat(user_model, history, reply, use_tools=False,
+                                                           image_history=image_history)
+        else:
+            assistant_message = response_content
+            if speculation is not None:
+                finish_search_prefetch(speculation, UNUSED)
+
+        if not assistant_message or assistant_message.strip() == "":
+            log.error("empty_response", model=user_model, tool_calls=len(tool_calls))
+            assistant_message = EMPTY_RESPONSE_TEXT
+
+        history.append({
+            "role": "assistant",
+            "content": assistant_message
+        })
+        with trace.span("history_save"):
+            await asyncio.to_thread(save_chat_history, chat_id, history)
+
+        with trace.span("reply"):
+            await send_answer(message, reply, assistant_message)
+
+    except Exception:
+        log.exception("message_failed", chat_id=chat_id)
+        trace.error()
+        await bot.reply_to(message, MESSAGE_ERROR_TEXT, parse_mode='Markdown')
+    finally:
+        trace.finish()
+
+
+@bot.callback_query_handler(func=lambda call: True)
+async def callback_handler(call):
+    """Обработчик нажатий на кнопки меню"""
+    if not is_user_allowed(call.from_user):
+        await bot.answer_callback_query(call.id, "⛔ Доступ запрещен", show_alert=True)
+        return
+
+    chat_id = call.message.chat.id
+    message_id = call.message.message_id
+
+    try:
+        if call.data == "new_chat":
+            await asyncio.to_thread(clear_chat_history, chat_id)
+            await bot.answer_callback_query(call.id, "✅ История очищена!")
+            await bot.edit_message_text(HISTORY_CLEARED_TEXT, chat_id, message_id)
+
+        elif call.data == "select_model":
+            current_model = await asyncio.to_thread(get_user_model, chat_id)
+            await bot.edit_message_text(build_model_selection_text(current_model), chat_id, message_id,
+                                        reply_markup=create_model_keyboard(current_model), parse_mode='Markdown')
+
+        elif call.data.startswith("model_"):
+            selected_model = call.data.replace("model_", "")
+
+            if selected_model in MODELS:
+                await asyncio.to_thread(set_user_model, chat_id, selected_model)
+                await bot.answer_callback_query(call.id, f"✅ Модель изменена на {MODELS[selected_model]['name']}")
+                await bot.edit_message_text(build_model_selection_text(selected_model), chat_id, message_id,
+                                            reply_markup=create_model_keyboard(selected_model), parse_mode='Markdown')
+
+        elif call.data == "back_to_menu":
+            current_model = await asyncio.to_thread(get_user_model, chat_id)
+            image_history = await asyncio.to_thread(get_image_history_mode, chat_id)
+            await bot.edit_message_text(build_menu_text(MODELS[current_model]["name"]), chat_id, message_id,
+                                        reply_markup=create_menu_keyboard(image_history), parse_mode='Markdown')
+
+        elif call.data == "toggle_image_history":
+            if await asyncio.to_thread(get_image_history_mode, chat_id) == IMAGE_HISTORY_THUMBNAIL:
+                new_mode = IMAGE_HISTORY_TEXT
+                await bot.answer_callback_query(call.id, "✅ Старые изображения будут заменяться описанием")
+            else:
+                new_mode = IMAGE_HISTORY_THUMBNAIL
+                await bot.answer_callback_query(call.id, "✅ Старые изображения будут отправляться миниатюрами")
+            await asyncio.to_thread(set_image_history_mode, chat_id, new_mode)
+            await bot.edit_message_reply_markup(chat_id, message_id, reply_markup=create_menu_keyboard(new_mode))
+
+    except Exception as e:
+        log.error("callback_failed", data=call.data, error=e)
+        await bot.answer_callback_query(call.id, "❌ Произошла ошибка")
+
+
+async def main():
+    """Запуск бота в асинхронном режиме"""
+    global http
+    http = create_aiohttp_session()
+    start_dispatcher()
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_HOST, METRICS_PORT)
+        log.info("metrics_listening", url=f"http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    try:
+        await bot.infinity_polling()
+    finally:
+        # Уже принятые сообщения дорабатываются, чтобы их история успела сохраниться
+        await chat_dispatcher.shutdown(timeout=30)
+        await image_jobs.shutdown(timeout=30)
+        await http.close()
+        await bot.close_session()
+
+
+if __name__ == '__main__':
+    log.info("bot_started", engine="async", updates="polling")
+    log.info("history_storage", path=HISTORY_DIR.absolute(), backend=STORAGE_BACKEND)
+
+    # systemd останавливает службу через SIGTERM: завершаемся штатно,
+    # чтобы отложенные записи истории успели попасть на диск
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        asyncio.run(main())
+    finally:
+        model_latency.save()
+        photo_cache.save()
+        storage.close()
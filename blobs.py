@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Контентно-адресуемое хранилище вложений (изображения, большие результаты функций).
+
+В истории чата хранится только ссылка вида blob:<sha256>.<ext>, а сами данные
+лежат на диске один раз. Перед запросом к OpenAI expand_messages() подставляет
+данные только для текущего хода; в более старых ходах изображения заменяются
+текстовой пометкой или миниатюрой с detail=low, а результаты функций - их началом.
+
+Данные, на которые больше не ссылается ни одна история (после /new или сжатия),
+удаляет BlobCollector: он собирает ссылки из всех историй и удаляет остальные
+файлы (mark-and-sweep). Файлы моложе min_age не удаляются: ссылка на только что
+сохраненные данные может быть еще только в памяти обработчика.
+"""
+
+import os
+import time
+import base64
+import hashlib
+import threading
+from pathlib import Path
+
+import images
+from logs import get_logger
+
+log = get_logger(__name__)
+
+BLOB_SCHEME = "blob:"
+
+# Режимы отображения старых изображений в запросе
+IMAGE_HISTORY_TEXT = "text"
+IMAGE_HISTORY_THUMBNAIL = "thumbnail"
+
+OLD_IMAGE_TEXT = "[Изображение из предыдущего сообщения - его содержимое описано в ответе ассистента]"
+
+MIME_TYPES = {"jpg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+
+
+class BlobStore:
+    """Файлы с именем по SHA-256 содержимого: blobs/ab/abcdef....jpg"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, ref):
+        name = ref[len(BLOB_SCHEME):]
+        return self.directory / name[:2] / name
+
+    def put(self, data, ext="bin"):
+        """Сохранить данные и вернуть ссылку на них"""
+        ref = f"{BLOB_SCHEME}{hashlib.sha256(data).hexdigest()}.{ext}"
+        path = self._path(ref)
+        if not self.touch(ref):
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        return ref
+
+    def exists(self, ref):
+        return self._path(ref).exists()
+
+    def touch(self, ref):
+        """Отметить данные как используемые сейчас (False, если их нет).
+
+        Время изменения файла - время последнего использования: collect() не удаляет
+        данные, на которые только что сослались повторно, но еще не сохранили историю.
+        """
+        try:
+            os.utime(self._path(ref))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def collect(self, live_refs, min_age=3600.0):
+        """Удалить данные, которых нет в live_refs и которые не использовались min_age секунд.
+
+        Возвращает (число удаленных файлов, освобожденные байты).
+        """
+        live_names = {ref[len(BLOB_SCHEME):] for ref in live_refs}
+        deadline = time.time() - min_age
+        removed = freed = 0
+        for path in self.directory.glob("*/*"):
+            if path.name in live_names:
+                continue
+            try:
+                stat = path.stat()
+                # Временные файлы put() тоже удаляются, если их оставил упавший процесс
+                if stat.st_mtime > deadline:
+                    continue
+                path.unlink()
+            except FileNotFoundError:
+                # Удалил другой процесс (шард)
+                continue
+            removed += 1
+            freed += stat.st_size
+        return removed, freed
+
+    def get(self, ref):
+        """Прочитать данные по ссылке"""
+        return self._path(ref).read_bytes()
+
+    def data_url(self, ref):
+        """Ссылка в виде data: URL для OpenAI"""
+        ext = ref.rsplit(".", 1)[-1]
+        mime = MIME_TYPES.get(ext, "application/octet-stream")
+        return f"data:{mime};base64,{base64.b64encode(self.get(ref)).decode('utf-8')}"
+
+
+def is_blob_ref(value):
+    return isinstance(value, str) and value.startswith(BLOB_SCHEME)
+
+
+def history_refs(history):
+    """Ссылки на данные в сообщениях истории"""
+    for message in history:
+        if is_blob_ref(message.get("content_ref")):
+            yield message["content_ref"]
+        content = message.get("content")
+        if isinstance(content, list):
+            for part in content:
+                image_url = part.get("image_url") if part.get("type") == "image_url" else None
+                for name in ("url", "thumbnail"):
+                    if image_url and is_blob_ref(image_url.get(name)):
+                        yield image_url[name]
+
+
+class BlobCollector:
+    """Фоновое удаление данных, на которые больше не ссылаются истории.
+
+    live_refs() возвращает все используемые ссылки. Сборка запускается по request()
+    (после /new и сжатия истории), но не чаще раза в interval секунд: обход всех
+    историй дорогой, а освободить место можно и с задержкой.
+    """
+
+    def __init__(self, store, live_refs, interval=3600.0, min_age=3600.0):
+        self.store = store
+        self.live_refs = live_refs
+        self.interval = interval
+        self.min_age = min_age
+        self._requested = threading.Event()
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.removed = 0
+        self.freed = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._worker, name="blob-collector", daemon=True)
+        self._thread.start()
+
+    def request(self):
+        """Запросить сборку (выполнится не раньше, чем через interval после предыдущей)"""
+        self._requested.set()
+
+    def collect(self):
+        """Выполнить сборку сейчас"""
+        started = time.monotonic()
+        live = set(self.live_refs())
+        removed, freed = self.store.collect(live, self.min_age)
+        with self._lock:
+            self.runs += 1
+            self.removed += removed
+            self.freed += freed
+        log.info("blobs_collected", live=len(live), removed=removed, freed_bytes=freed,
+                 duration_ms=round((time.monotonic() - started) * 1000))
+
+    def _worker(self):
+        while True:
+            self._requested.wait()
+            self._requested.clear()
+            try:
+                self.collect()
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                log.error("blob_collect_failed", error=e)
+            # Запросы за это время копятся в одну следующую сборку
+            time.sleep(self.interval)
+
+    def stats(self):
+        with self._lock:
+            return {"runs": self.runs, "removed": self.removed, "freed": self.freed, "failed": self.failed}
+
+
+def make_thumbnail(data):
+    """Копия изображения для detail=low или None, если Pillow недоступен"""
+    if images.Image is None:
+        return None
+    return images.prepare_image(data, images.DETAIL_LOW)
+
+
+def make_image_part(store, data, ext="jpg", detail=None):
+    """Часть сообщения с изображением, которая хранит только ссылки на данные"""
+    image_url = {"url": store.put(data, ext)}
+    if detail:
+        image_url["detail"] = detail
+    thumbnail = make_thumbnail(data)
+    if thumbnail is not None:
+        image_url["thumbnail"] = store.put(thumbnail, "jpg")
+    return {"type": "image_url", "image_url": image_url}
+
+
+def make_tool_message(store, tool_call_id, content, inline_limit):
+    """Сообщение с результатом функции; длинный результат выносится в хранилище"""
+    message = {"role": "tool", "tool_call_id": tool_call_id, "content": content}
+    if len(content) > inline_limit:
+        message["content"] = content[:inline_limit] + "…"
+        message["content_ref"] = store.put(content.encode("utf-8"), "txt")
+    return message
+
+
+def _current_turn_start(messages):
+    for index in range(len(messages) - 1, -1, -1):
+        if messages[index].get("role") == "user":
+            return index
+    return 0
+
+
+def _expand_image_part(store, part, current, image_history):
+    image_url = part.get("image_url", {})
+    url = image_url.get("url", "")
+
+    if current:
+        expanded = {"url": store.data_url(url) if is_blob_ref(url) else url}
+        if "detail" in image_url:
+            expanded["detail"] = image_url["detail"]
+        return {"type": "image_url", "image_url": expanded}
+
+    if image_history == IMAGE_HISTORY_THUMBNAIL:
+        thumbnail = image_url.get("thumbnail") or url
+        if is_blob_ref(thumbnail):
+            thumbnail = store.data_url(thumbnail)
+        return {"type": "image_url", "image_url": {"url": thumbnail, "detail": "low"}}
+
+    return {"type": "text", "text": OLD_IMAGE_TEXT}
+
+
+def expand_messages(messages, store, image_history=IMAGE_HISTORY_TEXT):
+    """Подготовить сообщения из истории к отправке в OpenAI (история не изменяется)"""
+    current_start = _current_turn_start(messages)
+    expanded = []
+    for index, message in enumerate(messages):
+        current = index >= current_start
+        content = message.get("content")
+
+        if isinstance(content, list) and any(part.get("type") == "image_url" for part in content):
+            message = dict(message)
+            message["content"] = [
+                _expand_image_part(store, part, current, image_history)
+                if part.get("type") == "image_url" else part
+                for part in content
+            ]
+        elif "content_ref" in message:
+            message = {key: value for key, value in message.items() if key != "content_ref"}
+            if current:
+                message["content"] = store.get(messages[index]["content_ref"]).decode("utf-8")
+
+        expanded.append(message)
+    return expanded
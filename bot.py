@@ -2,62 +2,316 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 import json
-import base64
-import requests
+import time
+import signal
+import secrets
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import telebot
-from telebot import types
+from telebot import types, apihelper
+from telebot.apihelper import ApiTelegramException
 from openai import OpenAI
 from dotenv import load_dotenv
 from pathlib import Path
 
+from storage import CachedStorage, create_storage
+from latency import LatencyTracker
+from file_cache import FileCache
+from router import ModelRouter
+from openai_scheduler import OpenAIScheduler
+from dispatcher import ChatDispatcher
+from jobs import JobQueue, JobRejected, QUEUE_FULL
+from admission import (AdmissionControl, ADMITTED, DENIED, USER_RATE, CHAT_RATE,
+                       KIND_TEXT, KIND_PHOTO, KIND_IMAGE, KIND_OTHER)
+from webhook import SECRET_TOKEN_HEADER, WebhookServer
+from shards import ShardSupervisor, current_shard, serve_shard
+import metrics
+from context import build_context, count_message_tokens
+from compaction import HistoryCompactor, format_transcript
+from telegram_html import escape as escape_html, html_to_text, render_chunks
+from blobs import (BlobCollector, BlobStore, IMAGE_HISTORY_TEXT, IMAGE_HISTORY_THUMBNAIL,
+                   expand_messages, history_refs, make_image_part, make_tool_message)
+from images import choose_detail, prepare_image, select_photo_size
+from search_cache import CATEGORY_TTLS, TTLCache, normalize_query, query_category
+from prefetch import SearchPrefetcher, Speculation, HIT, MISS, UNUSED
+from http_client import create_openai_http_client, create_session, url_origin
+import logs
+
 # Загрузка переменных окружения
 load_dotenv()
 
-# Инициализация Telegram бота
+# Логи: уровень (DEBUG включает подробную диагностику запросов), формат text или json,
+# доля записываемых частых событий ("событие=доля,...") и ограничение длины полей
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_SAMPLE = os.getenv('LOG_SAMPLE', 'update_shed=0.1,chat_queue_full=0.1,model_routed=0.1')
+LOG_FIELD_LIMIT = int(os.getenv('LOG_FIELD_LIMIT', '500'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+logs.setup(LOG_LEVEL, LOG_FORMAT, sample=logs.parse_sample_rates(LOG_SAMPLE),
+           field_limit=LOG_FIELD_LIMIT, queue_size=LOG_QUEUE_SIZE)
+log = logs.get_logger("bot")
+
+# Адреса внешних API можно переопределить (локальный Bot API сервер, заглушки в loadtest.py).
+# Формат адресов Bot API как в telebot: https://api.telegram.org/bot{0}/{1}, где {0} - токен
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+TELEGRAM_FILE_URL = os.getenv('TELEGRAM_FILE_URL', 'https://api.telegram.org/file/bot{0}/{1}')
+GOOGLE_SEARCH_URL = os.getenv('GOOGLE_SEARCH_URL', "https://www.googleapis.com/customsearch/v1")
+
+# Общий пул HTTP соединений для Telegram Bot API, скачивания файлов и Google Search
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '32'))
+http_session = create_session(
+    host_pools={
+        url_origin(TELEGRAM_API_URL or "https://api.telegram.org/"): HTTP_POOL_SIZE,
+        url_origin(GOOGLE_SEARCH_URL): 10
+    },
+    timeout=(5, 30)
+)
+
+# Инициализация Telegram бота (запросы к Bot API идут через общий пул соединений)
 TG_BOT_TOKEN = os.getenv('TG_BOT_TOKEN')
-bot = telebot.TeleBot(TG_BOT_TOKEN)
+apihelper.CUSTOM_REQUEST_SENDER = http_session.request
+apihelper.API_URL = TELEGRAM_API_URL
+apihelper.FILE_URL = TELEGRAM_FILE_URL
+# Обработчики вызываются в потоке, который передает обновления: параллелизм и порядок
+# обработки задает диспетчер очередей по чатам (см. start_dispatcher)
+bot = telebot.TeleBot(TG_BOT_TOKEN, threaded=False)
+
+# Диспетчер: сообщения одного чата обрабатываются по очереди, разных чатов - параллельно
+CHAT_WORKERS = int(os.getenv('CHAT_WORKERS', '16'))
+CHAT_QUEUE_LIMIT = int(os.getenv('CHAT_QUEUE_LIMIT', '10'))
+UPDATE_QUEUE_LIMIT = int(os.getenv('UPDATE_QUEUE_LIMIT', '1000'))
+
+# Генерация изображений идет в отдельной очереди со своими потоками,
+# чтобы долгие запросы DALL-E не задерживали ответы на текст
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '2'))
+IMAGE_QUEUE_LIMIT = int(os.getenv('IMAGE_QUEUE_LIMIT', '20'))
+# Сколько изображений один пользователь может ждать одновременно
+IMAGE_JOBS_PER_USER = int(os.getenv('IMAGE_JOBS_PER_USER', '1'))
+image_jobs = None
+dispatcher = None
+
+# Несколько процессов-шардов (по ядру на шард): обновления распределяются по хэшу chat_id,
+# прием обновлений и допуск остаются в основном процессе (1 - все в одном процессе)
+SHARDS = int(os.getenv('SHARDS', '1'))
+SHARD_QUEUE_LIMIT = int(os.getenv('SHARD_QUEUE_LIMIT', '1000'))
+SHARD_HEALTH_INTERVAL = float(os.getenv('SHARD_HEALTH_INTERVAL', '5'))
+# Шард без отчета о состоянии дольше этого времени считается зависшим и перезапускается
+SHARD_HEALTH_TIMEOUT = float(os.getenv('SHARD_HEALTH_TIMEOUT', '30'))
+# Номер шарда, если этот процесс - шард (None в основном процессе)
+SHARD_INDEX = current_shard()
+# Файлы, которые каждый процесс перезаписывает целиком из своей памяти, у шардов свои
+SHARD_SUFFIX = f".{SHARD_INDEX}" if SHARD_INDEX is not None else ""
+
+# Способ получения обновлений: polling (getUpdates) или webhook (встроенный HTTP сервер)
+UPDATE_MODE = os.getenv('UPDATE_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+# HTTP эндпоинт /metrics для Prometheus (0 - отключен)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
 
 # Инициализация OpenAI клиента
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-client = OpenAI(api_key=OPENAI_API_KEY)
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '100'))
+# Повторы выполняет openai_scheduler, поэтому встроенные повторы клиента отключены
+client = OpenAI(
+    api_key=OPENAI_API_KEY,
+    max_retries=0,
+    http_client=create_openai_http_client(max_connections=OPENAI_MAX_CONNECTIONS)
+)
+
+# Очередь запросов по лимитам OpenAI (из заголовков ответов) и повторы при 429/5xx
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '5'))
+OPENAI_BACKOFF_BASE = float(os.getenv('OPENAI_BACKOFF_BASE', '0.5'))
+OPENAI_BACKOFF_MAX = float(os.getenv('OPENAI_BACKOFF_MAX', '30'))
+# Доля лимита в запасе и максимальное ожидание его восстановления (сек)
+OPENAI_RATE_LIMIT_HEADROOM = float(os.getenv('OPENAI_RATE_LIMIT_HEADROOM', '0.05'))
+OPENAI_QUEUE_MAX_WAIT = float(os.getenv('OPENAI_QUEUE_MAX_WAIT', '60'))
+openai_scheduler = OpenAIScheduler(
+    max_retries=OPENAI_MAX_RETRIES,
+    backoff_base=OPENAI_BACKOFF_BASE,
+    backoff_max=OPENAI_BACKOFF_MAX,
+    headroom=OPENAI_RATE_LIMIT_HEADROOM,
+    max_wait=OPENAI_QUEUE_MAX_WAIT,
+)
 
 # Google Custom Search API
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 GOOGLE_CX = os.getenv('GOOGLE_CX')
 
+# Кэш результатов поиска (0 - отключить); время жизни зависит от категории запроса
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE', '512'))
+search_cache = TTLCache(max_entries=SEARCH_CACHE_SIZE)
+
+# Упреждающий поиск: для вопросов о погоде, новостях, ценах и датах поиск по тексту
+# сообщения запускается одновременно с первым запросом к модели (prefetch.py)
+SEARCH_PREFETCH = os.getenv('SEARCH_PREFETCH', 'false').lower() in ('1', 'true', 'yes')
+# Минимальная близость запроса модели к упреждающему (0-1), при которой используется готовый результат
+SEARCH_PREFETCH_SIMILARITY = float(os.getenv('SEARCH_PREFETCH_SIMILARITY', '0.5'))
+SEARCH_PREFETCH_RESULTS = int(os.getenv('SEARCH_PREFETCH_RESULTS', '5'))
+# Более длинные сообщения не считаются поисковыми вопросами
+SEARCH_PREFETCH_MAX_CHARS = int(os.getenv('SEARCH_PREFETCH_MAX_CHARS', '200'))
+search_prefetcher = SearchPrefetcher(
+    min_similarity=SEARCH_PREFETCH_SIMILARITY,
+    num_results=SEARCH_PREFETCH_RESULTS,
+    max_chars=SEARCH_PREFETCH_MAX_CHARS,
+)
+
 # Whitelist разрешенных пользователей (для приватного использования)
 ALLOWED_USER_IDS_STR = os.getenv('ALLOWED_USER_IDS', '')
 ALLOWED_USER_IDS = set()
 if ALLOWED_USER_IDS_STR:
     try:
         ALLOWED_USER_IDS = {int(uid.strip()) for uid in ALLOWED_USER_IDS_STR.split(',') if uid.strip()}
-        print(f"Whitelist активирован для {len(ALLOWED_USER_IDS)} пользователей: {ALLOWED_USER_IDS}")
+        log.info("whitelist_enabled", users=len(ALLOWED_USER_IDS), ids=sorted(ALLOWED_USER_IDS))
     except ValueError:
-        print("Ошибка парсинга ALLOWED_USER_IDS. Whitelist отключен.")
+        log.error("whitelist_parse_failed", value=ALLOWED_USER_IDS_STR, whitelist="disabled")
+
+# Допуск обновлений до постановки в очередь: корзины токенов на пользователя и на чат
+# (пополнение в токенах в минуту и емкость, 0 - без лимита) и стоимость обновления по виду
+ADMISSION_USER_RATE = float(os.getenv('ADMISSION_USER_RATE', '20'))
+ADMISSION_USER_BURST = float(os.getenv('ADMISSION_USER_BURST', '30'))
+ADMISSION_CHAT_RATE = float(os.getenv('ADMISSION_CHAT_RATE', '60'))
+ADMISSION_CHAT_BURST = float(os.getenv('ADMISSION_CHAT_BURST', '60'))
+ADMISSION_COSTS = {
+    KIND_TEXT: float(os.getenv('ADMISSION_COST_TEXT', '1')),
+    KIND_PHOTO: float(os.getenv('ADMISSION_COST_PHOTO', '3')),
+    KIND_IMAGE: float(os.getenv('ADMISSION_COST_IMAGE', '10')),
+    KIND_OTHER: float(os.getenv('ADMISSION_COST_OTHER', '0.5')),
+}
+# Отвечать об отказе (доступ запрещен, лимит) одному пользователю не чаще раза в столько секунд
+ADMISSION_NOTICE_INTERVAL = float(os.getenv('ADMISSION_NOTICE_INTERVAL', '60'))
+admission = AdmissionControl(
+    lambda user_id: not ALLOWED_USER_IDS or user_id in ALLOWED_USER_IDS,
+    user_rate=ADMISSION_USER_RATE,
+    user_burst=ADMISSION_USER_BURST,
+    chat_rate=ADMISSION_CHAT_RATE,
+    chat_burst=ADMISSION_CHAT_BURST,
+    costs=ADMISSION_COSTS,
+    notice_interval=ADMISSION_NOTICE_INTERVAL,
+)
 
 # Директория для хранения истории чатов
-HISTORY_DIR = Path('./chat_history')
+HISTORY_DIR = Path(os.getenv('HISTORY_DIR', './chat_history'))
 HISTORY_DIR.mkdir(exist_ok=True)
 
-# Хранилище настроек пользователей (модель по умолчанию)
-user_settings = {}
+# Бэкенд хранилища истории и настроек: json (файл на чат, перезапись целиком),
+# jsonl (только дописывание новых сообщений) или sqlite (WAL, пакетная фиксация)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'jsonl')
+storage = create_storage(STORAGE_BACKEND, HISTORY_DIR, shared_settings=SHARDS > 1)
+
+# Изображения и длинные результаты функций хранятся один раз в chat_history/blobs,
+# а в истории остаются только ссылки на них
+blob_store = BlobStore(HISTORY_DIR / 'blobs')
+# Удаление данных, на которые не ссылается ни одна история: после /new и сжатия, но не чаще
+# раза в BLOB_GC_INTERVAL секунд (0 - не удалять); данные моложе BLOB_GC_MIN_AGE секунд не удаляются
+BLOB_GC_INTERVAL = float(os.getenv('BLOB_GC_INTERVAL', '3600'))
+BLOB_GC_MIN_AGE = float(os.getenv('BLOB_GC_MIN_AGE', '3600'))
+# Результаты функций длиннее этого лимита в старых ходах заменяются своим началом
+TOOL_RESULT_INLINE_LIMIT = int(os.getenv('TOOL_RESULT_INLINE_LIMIT', '1500'))
+# Как отправлять изображения из прошлых ходов: text (текстовая пометка) или
+# thumbnail (миниатюра с detail=low); пользователь может переключить в /menu
+DEFAULT_IMAGE_HISTORY = os.getenv('IMAGE_HISTORY', IMAGE_HISTORY_TEXT)
+
+# Детализация изображений для Vision: auto (по подписи к фото), low или high.
+# От нее зависит, какой размер фото скачивается из Telegram и до какого оно уменьшается
+VISION_DETAIL = os.getenv('VISION_DETAIL', 'auto')
+VISION_JPEG_QUALITY = int(os.getenv('VISION_JPEG_QUALITY', '85'))
+
+# Подготовленные фото по file_unique_id: повторное фото не скачивается и не пережимается
+# (0 - отключить кэш). Данные лежат в blob_store, кэш хранит только ссылки на них
+PHOTO_CACHE_SIZE = int(os.getenv('PHOTO_CACHE_SIZE', '2000'))
+photo_cache = FileCache(HISTORY_DIR / f'photo_cache{SHARD_SUFFIX}.json', max_entries=PHOTO_CACHE_SIZE)
+
+# Кэш активных историй в памяти: запись на диск выполняется фоновым потоком
+# не реже, чем раз в HISTORY_FLUSH_INTERVAL секунд (0 записей - кэш отключен)
+HISTORY_CACHE_ENTRIES = int(os.getenv('HISTORY_CACHE_ENTRIES', '256'))
+HISTORY_CACHE_MB = float(os.getenv('HISTORY_CACHE_MB', '64'))
+HISTORY_FLUSH_INTERVAL = float(os.getenv('HISTORY_FLUSH_INTERVAL', '2.0'))
+if HISTORY_CACHE_ENTRIES > 0:
+    storage = CachedStorage(
+        storage,
+        max_entries=HISTORY_CACHE_ENTRIES,
+        max_bytes=int(HISTORY_CACHE_MB * 1024 * 1024),
+        flush_interval=HISTORY_FLUSH_INTERVAL
+    )
+
+# Фоновое сжатие истории: когда в чате больше COMPACT_MAX_TURNS ходов или COMPACT_MAX_TOKENS
+# токенов, старые ходы пересказываются моделью COMPACT_MODEL, последние COMPACT_KEEP_TURNS
+# ходов остаются как есть
+HISTORY_COMPACTION = os.getenv('HISTORY_COMPACTION', 'true').lower() in ('1', 'true', 'yes')
+COMPACT_MAX_TURNS = int(os.getenv('COMPACT_MAX_TURNS', '30'))
+COMPACT_MAX_TOKENS = int(os.getenv('COMPACT_MAX_TOKENS', '12000'))
+COMPACT_KEEP_TURNS = int(os.getenv('COMPACT_KEEP_TURNS', '6'))
+COMPACT_MODEL = os.getenv('COMPACT_MODEL', 'gpt-4o-mini')
+COMPACT_SUMMARY_TOKENS = int(os.getenv('COMPACT_SUMMARY_TOKENS', '800'))
+
+# Скользящая статистика задержек моделей по реальным запросам (показывается в меню и /stats).
+# Чем больше MODEL_LATENCY_ALPHA, тем быстрее оценка забывает старые запросы
+MODEL_LATENCY_ALPHA = float(os.getenv('MODEL_LATENCY_ALPHA', '0.1'))
+model_latency = LatencyTracker(HISTORY_DIR / f'model_latency{SHARD_SUFFIX}.json', alpha=MODEL_LATENCY_ALPHA)
+
+# Потоковая выдача ответов: первые токены сразу уходят в сообщение-заглушку,
+# которое затем дописывается через edit_message_text
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', 'true').lower() in ('1', 'true', 'yes')
+# Минимальный интервал между правками сообщения (Telegram ограничивает частоту правок:
+# ~1 в секунду для личных чатов и ~20 в минуту для групп)
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))
+STREAM_EDIT_INTERVAL_GROUP = float(os.getenv('STREAM_EDIT_INTERVAL_GROUP', '3.0'))
+# Максимальная длина одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Модель по умолчанию (выбор пользователя хранится в storage)
 DEFAULT_MODEL = "gpt-4o-mini"
 
+# Псевдо-модель: реальная модель выбирается под каждый запрос (router.py)
+AUTO_MODEL = "auto"
+
 # Доступные модели
+# context_budget - сколько токенов истории (вместе с системным сообщением) отправлять в запросе
+# tier - сложность запросов, которые автоматический выбор отдает модели (1 - простые, 2 - сложные)
 MODELS = {
     "gpt-4o-mini": {
         "name": "GPT-4o Mini ⚡",
-        "speed": "0.75 сек",
-        "description": "Быстрая модель"
+        "description": "Быстрая модель",
+        "context_budget": int(os.getenv('CONTEXT_BUDGET_GPT_4O_MINI', '8000')),
+        "tier": 1
     },
     "gpt-5": {
         "name": "GPT-5 🧠",
-        "speed": "3.80 сек",
-        "description": "Мощная модель"
+        "description": "Мощная модель",
+        "context_budget": int(os.getenv('CONTEXT_BUDGET_GPT_5', '16000')),
+        "tier": 2
+    },
+    AUTO_MODEL: {
+        "name": "Авто 🔀",
+        "description": "Модель выбирается под каждый запрос"
     }
 }
 
+# Автоматический выбор модели: самая дешевая модель, которой по силам запрос
+# и чья ожидаемая задержка не больше ROUTER_LATENCY_SLO секунд
+ROUTER_LATENCY_SLO = float(os.getenv('ROUTER_LATENCY_SLO', '10.0'))
+# Сколько баллов сложности (код, длина, рассуждения, вложения) нужно для сильной модели
+ROUTER_COMPLEX_SCORE = int(os.getenv('ROUTER_COMPLEX_SCORE', '2'))
+# С какой длины (символов) запрос считается длинным
+ROUTER_LONG_PROMPT = int(os.getenv('ROUTER_LONG_PROMPT', '600'))
+model_router = ModelRouter(
+    {model: info["tier"] for model, info in MODELS.items() if "tier" in info},
+    model_latency,
+    slo=ROUTER_LATENCY_SLO,
+    complex_score=ROUTER_COMPLEX_SCORE,
+    long_prompt=ROUTER_LONG_PROMPT,
+)
+
 # Системное сообщение для ChatGPT
 SYSTEM_MESSAGE = {
     "role": "system",
@@ -86,107 +340,315 @@ Guidelines:
 }
 
 
-def get_chat_history_path(chat_id):
-    """Получить путь к файлу истории чата"""
-    return HISTORY_DIR / f"chat_{chat_id}.json"
-
-
 def load_chat_history(chat_id):
-    """Загрузить историю чата из файла"""
-    history_path = get_chat_history_path(chat_id)
-    if history_path.exists():
-        try:
-            with open(history_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"Error loading chat history: {e}")
-            return [SYSTEM_MESSAGE]
-    return [SYSTEM_MESSAGE]
+    """Загрузить историю чата из хранилища"""
+    try:
+        history = storage.load_history(chat_id)
+    except Exception as e:
+        log.error("history_load_failed", chat_id=chat_id, error=e)
+        return [SYSTEM_MESSAGE]
+    return history or [SYSTEM_MESSAGE]
 
 
 def save_chat_history(chat_id, history):
-    """Сохранить историю чата в файл"""
-    history_path = get_chat_history_path(chat_id)
+    """Сохранить историю чата (дописываются только новые сообщения)"""
     try:
-        with open(history_path, 'w', encoding='utf-8') as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
+        storage.save_history(chat_id, history)
     except Exception as e:
-        print(f"Error saving chat history: {e}")
+        log.error("history_save_failed", chat_id=chat_id, error=e)
+        return
+    if compactor is not None:
+        compactor.schedule(chat_id, history)
 
 
 def clear_chat_history(chat_id):
     """Очистить историю чата"""
-    history_path = get_chat_history_path(chat_id)
-    if history_path.exists():
-        history_path.unlink()
+    storage.clear_history(chat_id)
+    if blob_collector is not None:
+        blob_collector.request()
+
+
+def live_blob_refs():
+    """Ссылки на данные во всех историях (включая еще не записанные на диск)"""
+    return {ref for _, history in storage.histories() for ref in history_refs(history)}
+
+
+blob_collector = BlobCollector(blob_store, live_blob_refs, interval=BLOB_GC_INTERVAL,
+                               min_age=BLOB_GC_MIN_AGE) if BLOB_GC_INTERVAL > 0 else None
+
+
+COMPACT_PROMPT = (
+    "Кратко перескажи начало диалога пользователя с ассистентом. Сохрани все, что понадобится "
+    "для продолжения разговора: факты о пользователе, имена, числа, принятые решения, "
+    "договоренности и незакрытые вопросы. Пиши на языке диалога, без вступлений."
+)
+
+
+def summarize_history(messages):
+    """Краткое содержание сообщений истории (для сжатия)"""
+    request = [
+        {"role": "system", "content": COMPACT_PROMPT},
+        {"role": "user", "content": format_transcript(messages)}
+    ]
+    params = build_openai_params(COMPACT_MODEL, request, max_tokens=COMPACT_SUMMARY_TOKENS, use_tools=False)
+    response = create_chat_completion(params)
+    metrics.record_usage(COMPACT_MODEL, response.usage)
+    summary = response.choices[0].message.content
+    if not summary or not summary.strip():
+        # Без пересказа старые ходы потерялись бы - оставляем историю как есть
+        raise ValueError("empty summary")
+    return summary
+
+
+def apply_compaction(chat_id, swap):
+    """Заменить историю сжатой: в очереди чата, чтобы не пересечься с его обработчиком"""
+    if not dispatcher.submit(chat_id, swap):
+        log.warning("compaction_postponed", chat_id=chat_id, reason="chat queue is full")
+
+
+# Замену истории выполняют очереди по чатам: apply задается при их запуске (start_dispatcher)
+compactor = HistoryCompactor(
+    storage, summarize_history, None,
+    max_turns=COMPACT_MAX_TURNS,
+    max_tokens=COMPACT_MAX_TOKENS,
+    keep_turns=COMPACT_KEEP_TURNS,
+    on_compacted=(lambda chat_id: blob_collector.request()) if blob_collector is not None else None,
+) if HISTORY_COMPACTION else None
 
 
 def get_user_model(chat_id):
     """Получить модель пользователя"""
-    return user_settings.get(chat_id, DEFAULT_MODEL)
+    model = storage.get_setting(chat_id, 'model', DEFAULT_MODEL)
+    # Модель могла быть удалена из MODELS после сохранения настройки
+    return model if model in MODELS else DEFAULT_MODEL
+
+
+def resolve_model(chat_id, model, text, attachments=0):
+    """Модель для запроса: при выборе "Авто" ее определяет model_router"""
+    if model != AUTO_MODEL:
+        return model
+    routed, reason = model_router.route(text, attachments)
+    log.info("model_routed", chat_id=chat_id, model=routed, reason=reason)
+    metrics.router_decisions_total.inc(model=routed)
+    return routed
 
 
 def set_user_model(chat_id, model):
     """Установить модель пользователя"""
-    user_settings[chat_id] = model
+    storage.set_setting(chat_id, 'model', model)
 
 
-def check_user_access(message):
-    """Проверка доступа пользователя к боту"""
+def get_image_history_mode(chat_id):
+    """Получить режим отображения старых изображений для чата"""
+    return storage.get_setting(chat_id, 'image_history', DEFAULT_IMAGE_HISTORY)
+
+
+def set_image_history_mode(chat_id, mode):
+    """Установить режим отображения старых изображений для чата"""
+    storage.set_setting(chat_id, 'image_history', mode)
+
+
+@functools.lru_cache(maxsize=1024)
+def build_access_denied_text(user_id):
+    """Текст сообщения об отказе в доступе"""
+    return (
+        "⛔ *Доступ запрещен*\n\n"
+        "Этот бот предназначен только для авторизованных пользователей.\n\n"
+        f"Ваш ID: `{user_id}`\n\n"
+        "Если вы считаете, что это ошибка, обратитесь к администратору бота."
+    )
+
+
+def is_user_allowed(user):
+    """Проверить пользователя по whitelist"""
     if not ALLOWED_USER_IDS:
         # Если whitelist пустой, разрешаем всем (для обратной совместимости)
         return True
 
-    user_id = message.from_user.id
-    if user_id not in ALLOWED_USER_IDS:
+    if user.id not in ALLOWED_USER_IDS:
         # Пользователь не в whitelist
-        username = message.from_user.username or message.from_user.first_name or "Неизвестный"
-        print(f"❌ Доступ запрещен для пользователя: {username} (ID: {user_id})")
-        bot.reply_to(message,
-            "⛔ *Доступ запрещен*\n\n"
-            "Этот бот предназначен только для авторизованных пользователей.\n\n"
-            f"Ваш ID: `{user_id}`\n\n"
-            "Если вы считаете, что это ошибка, обратитесь к администратору бота.",
-            parse_mode='Markdown')
+        username = user.username or user.first_name or "Неизвестный"
+        log.warning("access_denied", user_id=user.id, username=username)
         return False
     return True
 
 
-def google_search(query, num_results=5):
-    """Поиск в Google через Custom Search API"""
-    try:
-        if not GOOGLE_API_KEY or not GOOGLE_CX or GOOGLE_CX == "your_search_engine_id_here":
-            return "Google Search не настроен. Требуется GOOGLE_CX в .env файле."
+def check_user_access(message):
+    """Проверка доступа пользователя к боту"""
+    if is_user_allowed(message.from_user):
+        return True
+    if admission.should_notify(message.from_user.id, DENIED):
+        bot.reply_to(message, build_access_denied_text(message.from_user.id), parse_mode='Markdown')
+    return False
+
+
+SEARCH_NOT_CONFIGURED_TEXT = "Google Search не настроен. Требуется GOOGLE_CX в .env файле."
 
-        url = "https://www.googleapis.com/customsearch/v1"
-        params = {
-            "key": GOOGLE_API_KEY,
-            "cx": GOOGLE_CX,
-            "q": query,
-            "num": min(num_results, 10)  # API ограничивает до 10
-        }
 
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+def is_google_search_configured():
+    """Заданы ли ключи Google Custom Search API"""
+    return bool(GOOGLE_API_KEY and GOOGLE_CX and GOOGLE_CX != "your_search_engine_id_here")
 
-        if "items" not in data:
-            return f"Ничего не найдено по запросу: {query}"
 
-        results = []
-        for i, item in enumerate(data["items"][:num_results], 1):
-            title = item.get("title", "Без названия")
-            snippet = item.get("snippet", "")
-            link = item.get("link", "")
-            results.append(f"{i}. **{title}**\n{snippet}\n{link}")
+def google_search_params(query, num_results):
+    """Параметры запроса к Google Custom Search API"""
+    return {
+        "key": GOOGLE_API_KEY,
+        "cx": GOOGLE_CX,
+        "q": query,
+        "num": min(num_results, 10)  # API ограничивает до 10
+    }
+
+
+def search_cache_key(query, num_results):
+    """Ключ кэша поиска и время жизни результата"""
+    return (normalize_query(query), num_results), CATEGORY_TTLS[query_category(query)]
+
+
+def format_google_results(data, query, num_results):
+    """Преобразовать ответ Google Custom Search API в текст для модели"""
+    if "items" not in data:
+        return f"Ничего не найдено по запросу: {query}"
+
+    results = []
+    for i, item in enumerate(data["items"][:num_results], 1):
+        title = item.get("title", "Без названия")
+        snippet = item.get("snippet", "")
+        link = item.get("link", "")
+        results.append(f"{i}. **{title}**\n{snippet}\n{link}")
+
+    return "\n\n".join(results)
+
 
-        return "\n\n".join(results)
+def fetch_google_results(query, num_results=5):
+    """Запрос к Google Custom Search API (исключения не перехватываются)"""
+    response = http_session.get(GOOGLE_SEARCH_URL, params=google_search_params(query, num_results),
+                                timeout=(5, 10))
+    response.raise_for_status()
+    return format_google_results(response.json(), query, num_results)
+
+
+def google_search(query, num_results=5):
+    """Поиск в Google через Custom Search API (с кэшем и объединением одинаковых запросов)"""
+    try:
+        if not is_google_search_configured():
+            return SEARCH_NOT_CONFIGURED_TEXT
+
+        if SEARCH_CACHE_SIZE <= 0:
+            return fetch_google_results(query, num_results)
+
+        key, ttl = search_cache_key(query, num_results)
+        return search_cache.get_or_load(key, lambda: fetch_google_results(query, num_results), ttl)
 
     except Exception as e:
-        print(f"Google Search error: {e}")
+        log.error("google_search_failed", query=query, error=e)
         return f"Ошибка поиска: {str(e)}"
 
 
+# Вызовы функций из одного ответа модели выполняются параллельно в общем пуле потоков
+TOOL_WORKERS = int(os.getenv('TOOL_WORKERS', '8'))
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix='tool')
+# Максимальное время выполнения каждой функции (секунды)
+TOOL_TIMEOUTS = {
+    "google_search": float(os.getenv('GOOGLE_SEARCH_TIMEOUT', '15'))
+}
+DEFAULT_TOOL_TIMEOUT = 15.0
+
+
+def parse_tool_call(tool_call):
+    """Имя функции и аргументы вызова (ValueError при некорректном JSON)"""
+    function_name = tool_call["function"]["name"]
+    return function_name, json.loads(tool_call["function"]["arguments"] or "{}")
+
+
+def execute_tool_call(tool_call):
+    """Выполнить один вызов функции и вернуть результат в виде строки"""
+    function_name = tool_call["function"]["name"]
+    try:
+        function_name, function_args = parse_tool_call(tool_call)
+    except ValueError:
+        return f"Некорректные аргументы функции {function_name}"
+
+    log.debug("tool_call", function=function_name, args=function_args)
+
+    started = time.perf_counter()
+    if function_name == "google_search":
+        function_response = google_search(**function_args)
+    else:
+        function_response = f"Неизвестная функция: {function_name}"
+    metrics.tool_seconds.observe(time.perf_counter() - started, function=function_name)
+
+    log.debug("tool_result", function=function_name, result=function_response)
+    return function_response
+
+
+def prefetch_enabled():
+    return SEARCH_PREFETCH and is_google_search_configured()
+
+
+def finish_search_prefetch(speculation, result):
+    """Учесть исход упреждающего поиска (HIT, MISS или UNUSED)"""
+    search_prefetcher.record(speculation, result)
+    metrics.search_prefetch_total.inc(category=speculation.category, result=result)
+    log.debug("search_prefetch", category=speculation.category, query=speculation.query, result=result)
+
+
+def claim_search_prefetch(speculation, tool_calls):
+    """Индекс вызова из tool_calls, который получит результат упреждающего поиска, или None"""
+    calls = []
+    for tool_call in tool_calls:
+        try:
+            calls.append(parse_tool_call(tool_call))
+        except ValueError:
+            calls.append((tool_call["function"]["name"], None))
+    index = search_prefetcher.match(speculation, calls)
+    finish_search_prefetch(speculation, HIT if index is not None else MISS)
+    return index
+
+
+def start_search_prefetch(text):
+    """Запустить поиск по тексту сообщения, если это вероятный поисковый вопрос (иначе None)"""
+    if not prefetch_enabled():
+        return None
+    target = search_prefetcher.query_for(text)
+    if target is None:
+        return None
+    query, category = target
+    future = tool_executor.submit(contextvars.copy_context().run, google_search, query, SEARCH_PREFETCH_RESULTS)
+    return Speculation(query, category, future)
+
+
+def execute_tool_calls(tool_calls, speculation=None):
+    """Выполнить вызовы функций параллельно; результаты возвращаются в порядке tool_calls.
+
+    speculation - упреждающий поиск сообщения: подходящий вызов google_search получает его результат.
+    """
+    started = time.monotonic()
+    prefetched = claim_search_prefetch(speculation, tool_calls) if speculation is not None else None
+    # Вызовы выполняются в контексте запроса, чтобы их логи несли его ID
+    futures = [speculation.result if index == prefetched else
+               tool_executor.submit(contextvars.copy_context().run, execute_tool_call, tool_call)
+               for index, tool_call in enumerate(tool_calls)]
+
+    results = []
+    for tool_call, future in zip(tool_calls, futures):
+        function_name = tool_call["function"]["name"]
+        timeout = TOOL_TIMEOUTS.get(function_name, DEFAULT_TOOL_TIMEOUT)
+        try:
+            # Таймаут отсчитывается от запуска, а не от окончания предыдущей функции
+            results.append(future.result(timeout=max(0, started + timeout - time.monotonic())))
+            metrics.tool_calls_total.inc(function=function_name, status="ok")
+        except FutureTimeoutError:
+            log.warning("tool_call_timeout", function=function_name, timeout=timeout)
+            metrics.tool_calls_total.inc(function=function_name, status="timeout")
+            results.append(f"Превышено время ожидания функции {function_name}")
+        except Exception as e:
+            log.error("tool_call_failed", function=function_name, error=e)
+            metrics.tool_calls_total.inc(function=function_name, status="error")
+            results.append(f"Ошибка выполнения функции {function_name}: {str(e)}")
+    return results
+
+
 # Определение инструментов (tools) для Function Calling
 TOOLS = [
     {
@@ -214,8 +676,16 @@ TOOLS = [
 ]
 
 
-def call_openai_api(model, messages, max_tokens=4000, use_tools=True):
-    """Универсальная функция вызова OpenAI API с правильными параметрами"""
+def build_openai_params(model, messages, max_tokens=4000, use_tools=True, stream=False,
+                        image_history=IMAGE_HISTORY_TEXT):
+    """Параметры запроса chat.completions с учетом особенностей модели"""
+    # Отправляем только последние ходы, помещающиеся в бюджет контекста модели
+    budget = MODELS.get(model, {}).get("context_budget")
+    if budget:
+        messages = build_context(messages, budget)
+    # Вложения по ссылкам: полные данные только для текущего хода
+    messages = expand_messages(messages, blob_store, image_history)
+
     if model == "gpt-5":
         # GPT-5 требует max_completion_tokens и не поддерживает температуру
         # GPT-5 - reasoning модель, нужно больше токенов для размышлений + ответа
@@ -227,7 +697,11 @@ def call_openai_api(model, messages, max_tokens=4000, use_tools=True):
         if use_tools:
             params["tools"] = TOOLS
             params["tool_choice"] = "auto"
-        return client.chat.completions.create(**params)
+        if stream:
+            params["stream"] = True
+            # Последний фрагмент потока содержит usage (для метрик токенов)
+            params["stream_options"] = {"include_usage": True}
+        return params
     else:
         # Остальные модели используют стандартные параметры
         params = {
@@ -238,10 +712,495 @@ def call_openai_api(model, messages, max_tokens=4000, use_tools=True):
         if use_tools:
             params["tools"] = TOOLS
             params["tool_choice"] = "auto"
-        return client.chat.completions.create(**params)
+        if stream:
+            params["stream"] = True
+            # Последний фрагмент потока содержит usage (для метрик токенов)
+            params["stream_options"] = {"include_usage": True}
+        return params
+
+
+def estimate_request_tokens(params):
+    """Сколько токенов запрос спишет из лимита: контекст и максимум ответа"""
+    max_tokens = params.get("max_tokens") or params.get("max_completion_tokens") or 0
+    return sum(count_message_tokens(message) for message in params["messages"]) + max_tokens
+
+
+def create_chat_completion(params):
+    """Запрос chat.completions через openai_scheduler (лимиты и повторы)"""
+    return openai_scheduler.call(params["model"], estimate_request_tokens(params),
+                                 client.chat.completions.with_raw_response.create, **params)
+
+
+def record_model_latency(model, ttft, total):
+    """Учесть задержку запроса к модели в скользящей статистике и метриках"""
+    model_latency.record(model, ttft, total)
+    stats = model_latency.get(model)
+    metrics.model_ttft_seconds.set(stats["ttft"], model=model)
+    metrics.model_latency_seconds.set(stats["total"], model=model)
+
+
+def tool_calls_to_dicts(tool_calls):
+    """tool_calls из ответа OpenAI в виде словарей для истории"""
+    return [
+        {
+            "id": tc.id,
+            "type": tc.type,
+            "function": {
+                "name": tc.function.name,
+                "arguments": tc.function.arguments
+            }
+        } for tc in (tool_calls or [])
+    ]
+
+
+def merge_tool_call_deltas(tool_calls, deltas):
+    """Добавить фрагменты tool_calls из потокового ответа (tool_calls - словарь по индексу)"""
+    # Аргументы tool_calls приходят фрагментами, склеиваем их по индексу
+    for tc in deltas or []:
+        entry = tool_calls.setdefault(tc.index, {
+            "id": None,
+            "type": "function",
+            "function": {"name": "", "arguments": ""}
+        })
+        if tc.id:
+            entry["id"] = tc.id
+        if tc.function and tc.function.name:
+            entry["function"]["name"] += tc.function.name
+        if tc.function and tc.function.arguments:
+            entry["function"]["arguments"] += tc.function.arguments
+
+
+class StreamingReply:
+    """Ответ, который выводится по мере генерации через правки одного сообщения"""
+
+    CURSOR = " ▌"
+
+    def __init__(self, message):
+        self.message = message
+        self.chat_id = message.chat.id
+        self.sent = None
+        self.shown_text = ""
+        self.next_edit_at = 0.0
+        if message.chat.type in ('group', 'supergroup'):
+            self.interval = STREAM_EDIT_INTERVAL_GROUP
+        else:
+            self.interval = STREAM_EDIT_INTERVAL
+
+    def _pending_text(self, text, force):
+        """Текст, который пора показать, или None, если правку нужно пропустить"""
+        if not text or not text.strip():
+            return None
+        # Пока ответ генерируется, показываем только первую часть
+        text = text[:TELEGRAM_MESSAGE_LIMIT - len(self.CURSOR)]
+        if text == self.shown_text or (not force and time.monotonic() < self.next_edit_at):
+            return None
+        return text
+
+    def _mark_shown(self, text):
+        self.shown_text = text
+        self.next_edit_at = time.monotonic() + self.interval
+
+    def update(self, text, force=False):
+        """Показать промежуточный текст (не чаще, чем позволяет интервал правок)"""
+        text = self._pending_text(text, force)
+        if text is None:
+            return
+
+        try:
+            if self.sent is None:
+                # Первые токены: отправляем сообщение-заглушку сразу
+                self.sent = bot.reply_to(self.message, text + self.CURSOR)
+            else:
+                bot.edit_message_text(text + self.CURSOR, self.chat_id, self.sent.message_id)
+            self._mark_shown(text)
+        except ApiTelegramException as e:
+            self._handle_edit_error(e)
+
+    def finish(self, text):
+        """Показать окончательный ответ с разметкой (Markdown модели переводится в HTML)"""
+        # Без частей заглушка потокового сообщения осталась бы без окончательного ответа
+        chunks = render_chunks(text) or render_chunks(EMPTY_RESPONSE_TEXT)
+        first, rest = chunks[0], chunks[1:]
+
+        if self.sent is None:
+            self.sent = self._send(first)
+        else:
+            self._edit(first)
+
+        # Всё, что не поместилось в одно сообщение, отправляем следом
+        for chunk in rest:
+            self._send(chunk)
+
+    def _send(self, text):
+        return send_html(self.message, text)
+
+    def _edit(self, text):
+        try:
+            bot.edit_message_text(text, self.chat_id, self.sent.message_id, parse_mode='HTML')
+        except ApiTelegramException as markup_error:
+            if 'message is not modified' in markup_error.description:
+                return
+            # Рендерер выдает корректный HTML, так что сюда попадать не должны
+            log.warning("markup_rejected", operation="edit", error=markup_error)
+            metrics.markdown_fallbacks_total.inc(operation="edit")
+            bot.edit_message_text(html_to_text(text), self.chat_id, self.sent.message_id)
+
+    def _handle_edit_error(self, error):
+        if error.error_code == 429:
+            # Превышен лимит правок: ждем столько, сколько просит Telegram
+            retry_after = error.result_json.get('parameters', {}).get('retry_after', self.interval)
+            self.next_edit_at = time.monotonic() + retry_after
+        elif 'message is not modified' not in error.description:
+            log.warning("stream_edit_failed", chat_id=self.chat_id, error=error)
+
+
+def complete_chat(model, messages, reply=None, use_tools=True, image_history=IMAGE_HISTORY_TEXT):
+    """Получить ответ модели в виде (текст, tool_calls).
+
+    Если передан reply, ответ запрашивается потоково и выводится в reply по мере генерации.
+    """
+    params = build_openai_params(model, messages, use_tools=use_tools, stream=reply is not None,
+                                 image_history=image_history)
+
+    # Задержка модели считается без сборки контекста
+    started = time.perf_counter()
+    if reply is None:
+        response = create_chat_completion(params)
+        elapsed = time.perf_counter() - started
+        record_model_latency(model, elapsed, elapsed)
+        metrics.record_usage(model, response.usage)
+        response_message = response.choices[0].message
+        return response_message.content, tool_calls_to_dicts(response_message.tool_calls)
+
+    stream = create_chat_completion(params)
+    content = ""
+    tool_calls = {}
+    first_token_at = None
+    for chunk in stream:
+        metrics.record_usage(model, chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if first_token_at is None and (delta.content or delta.tool_calls):
+            first_token_at = time.perf_counter()
+
+        if delta.content:
+            content += delta.content
+            reply.update(content)
+
+        merge_tool_call_deltas(tool_calls, delta.tool_calls)
+
+    finished_at = time.perf_counter()
+    record_model_latency(model, (first_token_at or finished_at) - started, finished_at - started)
+    return content or None, [tool_calls[index] for index in sorted(tool_calls)]
+
+
+def send_html(message, text):
+    """Ответить частью ответа в HTML (без разметки, если Telegram ее не принял)"""
+    try:
+        return bot.reply_to(message, text, parse_mode='HTML')
+    except ApiTelegramException as markup_error:
+        log.warning("markup_rejected", operation="send", error=markup_error)
+        metrics.markdown_fallbacks_total.inc(operation="send")
+        return bot.reply_to(message, html_to_text(text))
+
+
+def send_answer(message, reply, text):
+    """Отправить окончательный ответ (дописать потоковое сообщение или ответить частями)"""
+    if reply is not None:
+        reply.finish(text)
+        return
+    for chunk in render_chunks(text):
+        send_html(message, chunk)
+
+
+# Тексты сообщений бота (общие для синхронного и асинхронного режимов)
+HISTORY_CLEARED_TEXT = "✅ История диалога очищена. Начинаем новый разговор!"
+SEARCHING_TEXT = "🔍 Ищу информацию..."
+EMPTY_RESPONSE_TEXT = "Извините, я не смог сгенерировать ответ. Попробуйте еще раз."
+IMAGE_USAGE_TEXT = (
+    "🎨 Для генерации изображения укажите описание:\n\n"
+    "Пример: `/image кот в космосе`\n"
+    "Или: `/generate робот читает книгу`"
+)
+IMAGE_PROGRESS_TEXT = "🎨 *Генерирую изображение...*\n\n⏱ Это может занять ~10 секунд"
+IMAGE_ERROR_TEXT = "❌ *Ошибка генерации изображения*\n\nПопробуйте изменить описание или повторить попытку позже."
+IMAGE_QUEUED_TEXT = "⏳ *Изображение в очереди: {position}*\n\nГенерация начнется, как только освободится место"
+IMAGE_QUEUE_FULL_TEXT = "⏳ *Очередь генерации изображений заполнена*\n\nПопробуйте через минуту."
+IMAGE_USER_LIMIT_TEXT = "⏳ *Ваши изображения еще генерируются*\n\nДождитесь их, прежде чем заказывать новые."
+PHOTO_ERROR_TEXT = (
+    "⚠️ *Ошибка анализа изображения*\n\n"
+    "Попробуйте:\n"
+    "• Отправить изображение ещё раз\n"
+    "• Использовать `/new` для нового диалога"
+)
+MESSAGE_ERROR_TEXT = (
+    "⚠️ *Ошибка обработки сообщения*\n\n"
+    "Попробуйте:\n"
+    "• Переформулировать вопрос\n"
+    "• Использовать `/new` для нового диалога"
+)
+DEFAULT_PHOTO_CAPTION = "Что на этом изображении?"
+CHAT_BUSY_TEXT = "⏳ Слишком много сообщений подряд. Дождитесь ответа на предыдущие."
+RATE_LIMITED_TEXT = "⏳ Слишком много запросов. Подождите немного и повторите."
+ACCESS_DENIED_SHORT_TEXT = "⛔ Доступ запрещен"
+# Причина ответа об отказе, когда переполнена очередь чата
+CHAT_BUSY = "chat_busy"
+
+# Параметры генерации изображений DALL-E
+IMAGE_GENERATION_PARAMS = {
+    "model": "dall-e-3",
+    "size": "1024x1024",
+    "quality": "standard",
+    "n": 1,
+}
+
+
+def build_welcome_text(model_name):
+    """Текст приветствия для /start и /help"""
+    return f"""
+👋 *Привет! Я ChatGPT бот*
+
+Текущая модель: *{model_name}*
+
+*📋 Доступные команды:*
+`/start` или `/help` - показать это сообщение
+`/menu` - открыть меню настроек
+`/new` - начать новый диалог
+`/image` - создать изображение 🎨
+`/stats` - статистика работы бота
+
+*✨ Что я умею:*
+📝 Отвечать на текстовые сообщения
+🖼 Анализировать изображения (отправь фото)
+🎨 Генерировать изображения
+💬 Поддерживать контекст разговора
+⚡ Отвечать очень быстро!
+
+💡 Просто отправь мне сообщение или фото!
+    """.strip()
 
 
-def create_menu_keyboard():
+def build_menu_text(model_name):
+    """Текст главного меню"""
+    return f"""
+⚙️ *Меню настроек*
+
+Текущая модель: *{model_name}*
+
+Выберите действие:
+    """.strip()
+
+
+def format_model_speed(model):
+    """Короткая оценка скорости модели для кнопки выбора"""
+    if model == AUTO_MODEL:
+        return "по запросу"
+    stats = model_latency.get(model)
+    if stats is None:
+        return "нет данных"
+    return f"~{stats['total']:.1f} сек"
+
+
+def format_model_latency(model):
+    """Оценка скорости модели: первый токен и полный ответ"""
+    if model == AUTO_MODEL:
+        return f"лучшая модель в пределах {ROUTER_LATENCY_SLO:.0f} сек"
+    stats = model_latency.get(model)
+    if stats is None:
+        return "нет данных"
+    return f"первый токен ~{stats['ttft']:.1f} сек, ответ ~{stats['total']:.1f} сек"
+
+
+def build_model_selection_text(current_model):
+    """Текст со списком моделей и отметкой активной"""
+    model_text = "🤖 *Выберите модель:*\n\n"
+    for model_id, model_info in MODELS.items():
+        status = "✅ *Активна*" if model_id == current_model else ""
+        model_text += f"• *{model_info['name']}*\n"
+        model_text += f"  Скорость: `{format_model_latency(model_id)}`\n"
+        model_text += f"  {model_info['description']}\n"
+        if status:
+            model_text += f"  {status}\n"
+        model_text += "\n"
+    return model_text
+
+
+def build_shard_stats_text():
+    """Раздел /stats о процессах-шардах (по файлу состояния, который пишет супервизор)"""
+    try:
+        with open(HISTORY_DIR / 'shards.json', 'r', encoding='utf-8') as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        return "\n\n*Шарды:* нет данных"
+    text = (f"\n\n*Шарды* (этот чат - шард `{SHARD_INDEX}`, "
+            f"обновлено `{time.time() - status['updated_at']:.0f}` с назад):\n")
+    for shard in status['shards']:
+        report = shard['report']
+        dispatcher_stats = report.get('dispatcher', {})
+        state = "✅" if shard['alive'] else "❌"
+        text += (f"{state} `{shard['shard']}`: pid `{shard['pid']}`, в очереди `{shard['queued']}`, "
+                 f"получено `{report.get('received', 0)}`, "
+                 f"в обработке `{dispatcher_stats.get('running', 0)}`/`{dispatcher_stats.get('workers', 0)}`, "
+                 f"перезапусков `{shard['restarts']}`\n")
+    text += f"Передано шардам: `{status['routed']}`, отклонено: `{status['rejected']}`"
+    return text
+
+
+def build_stats_text():
+    """Текст статистики для /stats"""
+    cache_stats = search_cache.stats()
+    text = (
+        "📊 *Статистика*\n\n"
+        "*Кэш поиска:*\n"
+        f"Записей: `{cache_stats['size']}`\n"
+        f"Попаданий: `{cache_stats['hits']}`\n"
+        f"Промахов: `{cache_stats['misses']}`\n"
+        f"Объединено одинаковых запросов: `{cache_stats['shared']}`\n"
+        f"Доля попаданий: `{cache_stats['hit_rate']:.0%}`"
+    )
+    if prefetch_enabled():
+        prefetch_stats = search_prefetcher.stats()
+        text += (
+            "\n\n*Упреждающий поиск:*\n"
+            f"Запущено: `{prefetch_stats['started']}`, пригодилось: `{prefetch_stats['hits']}` "
+            f"(`{prefetch_stats['hit_rate']:.0%}`)\n"
+            f"Модель искала другое: `{prefetch_stats['misses']}`, не искала: `{prefetch_stats['unused']}`"
+        )
+    if compactor is not None:
+        compact_stats = compactor.stats()
+        text += (
+            "\n\n*Сжатие истории:*\n"
+            f"Сжато чатов: `{compact_stats['compacted']}`, в очереди: `{compact_stats['pending']}`, "
+            f"пропущено: `{compact_stats['skipped']}`, ошибок: `{compact_stats['failed']}`"
+        )
+    if blob_collector is not None:
+        blob_stats = blob_collector.stats()
+        text += (
+            "\n\n*Вложения:*\n"
+            f"Удалено неиспользуемых: `{blob_stats['removed']}` (`{blob_stats['freed'] / 1024 / 1024:.1f}` МБ) "
+            f"за `{blob_stats['runs']}` проходов, ошибок: `{blob_stats['failed']}`"
+        )
+    if SHARDS > 1:
+        text += build_shard_stats_text()
+    admission_stats = admission.stats()
+    shed = admission_stats['shed']
+    text += (
+        "\n\n*Допуск запросов:*\n"
+        f"Принято: `{sum(admission_stats['admitted'].values())}`, "
+        f"отброшено: `{sum(shed.values())}` (нет доступа: `{shed.get(DENIED, 0)}`, "
+        f"лимит пользователя: `{shed.get(USER_RATE, 0)}`, лимит чата: `{shed.get(CHAT_RATE, 0)}`)\n"
+        f"Отброшено по видам: " + (", ".join(f"{kind} `{count}`" for kind, count in
+                                          sorted(admission_stats['shed_by_kind'].items())) or "`0`") + "\n"
+        f"Ответов об отказе: `{admission_stats['notices_sent']}`, "
+        f"подавлено: `{admission_stats['notices_suppressed']}`"
+    )
+    photo_stats = photo_cache.stats()
+    text += (
+        "\n\n*Кэш фото:*\n"
+        f"Записей: `{photo_stats['size']}`, попаданий: `{photo_stats['hits']}`, "
+        f"промахов: `{photo_stats['misses']}` (`{photo_stats['hit_rate']:.0%}`)"
+    )
+    if logs.dropped():
+        text += f"\n\n*Логи:* отброшено записей при переполненной очереди: `{logs.dropped()}`"
+    model_stats = model_latency.snapshot()
+    if model_stats:
+        text += "\n\n*Модели (скользящее среднее ± отклонение):*\n"
+        for model, stats in sorted(model_stats.items()):
+            text += (f"`{model}`: первый токен `{stats['ttft']:.2f}±{stats['ttft_dev']:.2f}` с, "
+                     f"ответ `{stats['total']:.2f}±{stats['total_dev']:.2f}` с (n={stats['samples']})\n")
+        text = text.rstrip("\n")
+    latency = metrics.handler_seconds.quantiles()
+    if latency:
+        text += "\n\n*Время ответа (p50 / p95 / p99):*\n"
+        for (handler, model), (count, values) in sorted(latency.items()):
+            text += (f"{handler} `{model}`: `{values[0.5]:.1f}` / `{values[0.95]:.1f}` / "
+                     f"`{values[0.99]:.1f}` с (n={count})\n")
+        text = text.rstrip("\n")
+    openai_stats = openai_scheduler.stats()
+    text += (
+        "\n\n*Запросы к OpenAI:*\n"
+        f"Отправлено: `{openai_stats['requests']}`, ждут лимита: `{openai_stats['waiting']}`\n"
+        f"Задержано по лимиту: `{openai_stats['delayed']}`, повторов: `{openai_stats['retries']}`, "
+        f"ошибок: `{openai_stats['failed']}`"
+    )
+    if dispatcher is not None:
+        queue_stats = dispatcher.stats()
+        text += (
+            "\n\n*Очереди обработки:*\n"
+            f"Потоков: `{queue_stats['workers']}`, занято: `{queue_stats['running']}`\n"
+            f"В очереди: `{queue_stats['pending']}` (чатов: `{queue_stats['chats']}`)\n"
+            f"Обработано: `{queue_stats['completed']}`, с ошибкой: `{queue_stats['failed']}`\n"
+            f"Отклонено: `{queue_stats['rejected']}`, ожиданий места в очереди: `{queue_stats['blocked']}`"
+        )
+    if image_jobs is not None:
+        image_stats = image_jobs.stats()
+        text += (
+            "\n\n*Генерация изображений:*\n"
+            f"Потоков: `{image_stats['workers']}`, занято: `{image_stats['running']}`, "
+            f"в очереди: `{image_stats['pending']}`\n"
+            f"Готово: `{image_stats['completed']}`, с ошибкой: `{image_stats['failed']}`, "
+            f"отклонено: `{image_stats['rejected']}`"
+        )
+    return text
+
+
+def build_image_caption(prompt, revised_prompt):
+    """Подпись к сгенерированному изображению"""
+    # Запрос пользователя может содержать что угодно, поэтому подпись в HTML с экранированием
+    return (f"🎨 <b>Изображение готово!</b>\n\n📝 <b>Ваш запрос:</b> {escape_html(prompt)}\n\n"
+            f"💡 <b>Улучшенный промпт:</b>\n{escape_html((revised_prompt or '')[:200])}...")
+
+
+def photo_detail(caption):
+    """Уровень детализации Vision для фото с такой подписью"""
+    return VISION_DETAIL if VISION_DETAIL != 'auto' else choose_detail(caption)
+
+
+def photo_cache_key(photo, detail):
+    """Ключ кэша подготовленного фото: тот же файл с той же детализацией и качеством"""
+    return f"{photo.file_unique_id}:{detail}:{VISION_JPEG_QUALITY}"
+
+
+def get_cached_photo_part(cache_key):
+    """Часть сообщения с уже подготовленным фото или None"""
+    image_part = photo_cache.get(cache_key)
+    if image_part is not None:
+        image_url = image_part["image_url"]
+        # touch: данные снова используются, пока ссылка на них есть только в новом сообщении
+        if all(blob_store.touch(image_url[name]) for name in ("url", "thumbnail") if name in image_url):
+            metrics.photo_cache_total.inc(result="hit")
+            return image_part
+        photo_cache.discard(cache_key)
+    metrics.photo_cache_total.inc(result="miss")
+    return None
+
+
+def build_photo_part(photo_bytes, detail, cache_key=None):
+    """Часть сообщения с фото.
+
+    Фото уменьшается до размера, который реально использует OpenAI, и сохраняется
+    в blob_store - в истории остается только ссылка.
+    """
+    photo_data = prepare_image(photo_bytes, detail, VISION_JPEG_QUALITY)
+    image_part = make_image_part(blob_store, photo_data, detail=detail)
+    if cache_key is not None:
+        photo_cache.put(cache_key, image_part)
+    return image_part
+
+
+def build_photo_message(caption, image_part):
+    """Сообщение пользователя с фото для истории"""
+    return {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": caption or DEFAULT_PHOTO_CAPTION},
+            image_part
+        ]
+    }
+
+
+def create_menu_keyboard(image_history=IMAGE_HISTORY_TEXT):
     """Создать клавиатуру главного меню"""
     markup = types.InlineKeyboardMarkup(row_width=1)
 
@@ -253,8 +1212,13 @@ def create_menu_keyboard():
         "🤖 Выбрать модель",
         callback_data="select_model"
     )
+    image_history_name = "миниатюры" if image_history == IMAGE_HISTORY_THUMBNAIL else "текст"
+    btn_image_history = types.InlineKeyboardButton(
+        f"🖼 Старые изображения: {image_history_name}",
+        callback_data="toggle_image_history"
+    )
 
-    markup.add(btn_new_chat, btn_select_model)
+    markup.add(btn_new_chat, btn_select_model, btn_image_history)
     return markup
 
 
@@ -264,7 +1228,7 @@ def create_model_keyboard(current_model):
 
     for model_id, model_info in MODELS.items():
         checkmark = "✅ " if model_id == current_model else ""
-        btn_text = f"{checkmark}{model_info['name']} - {model_info['speed']}"
+        btn_text = f"{checkmark}{model_info['name']} - {format_model_speed(model_id)}"
         btn = types.InlineKeyboardButton(
             btn_text,
             callback_data=f"model_{model_id}"
@@ -283,31 +1247,8 @@ def send_welcome(message):
     if not check_user_access(message):
         return
 
-    chat_id = message.chat.id
-    current_model = get_user_model(chat_id)
-    model_name = MODELS[current_model]["name"]
-
-    welcome_text = f"""
-👋 *Привет! Я ChatGPT бот*
-
-Текущая модель: *{model_name}*
-
-*📋 Доступные команды:*
-`/start` или `/help` - показать это сообщение
-`/menu` - открыть меню настроек
-`/new` - начать новый диалог
-`/image` - создать изображение 🎨
-
-*✨ Что я умею:*
-📝 Отвечать на текстовые сообщения
-🖼 Анализировать изображения (отправь фото)
-🎨 Генерировать изображения
-💬 Поддерживать контекст разговора
-⚡ Отвечать очень быстро!
-
-💡 Просто отправь мне сообщение или фото!
-    """
-    bot.reply_to(message, welcome_text.strip(), parse_mode='Markdown')
+    current_model = get_user_model(message.chat.id)
+    bot.reply_to(message, build_welcome_text(MODELS[current_model]["name"]), parse_mode='Markdown')
 
 
 @bot.message_handler(commands=['new'])
@@ -318,7 +1259,7 @@ def new_conversation(message):
 
     chat_id = message.chat.id
     clear_chat_history(chat_id)
-    bot.reply_to(message, "✅ История диалога очищена. Начинаем новый разговор!", parse_mode='Markdown')
+    bot.reply_to(message, HISTORY_CLEARED_TEXT, parse_mode='Markdown')
 
 
 @bot.message_handler(commands=['menu'])
@@ -328,18 +1269,18 @@ def show_menu(message):
         return
 
     chat_id = message.chat.id
-    current_model = get_user_model(chat_id)
-    model_name = MODELS[current_model]["name"]
+    menu_text = build_menu_text(MODELS[get_user_model(chat_id)]["name"])
+    markup = create_menu_keyboard(get_image_history_mode(chat_id))
+    bot.send_message(chat_id, menu_text, reply_markup=markup, parse_mode='Markdown')
 
-    menu_text = f"""
-⚙️ *Меню настроек*
 
-Текущая модель: *{model_name}*
+@bot.message_handler(commands=['stats'])
+def show_stats(message):
+    """Обработчик команды /stats - статистика работы бота"""
+    if not check_user_access(message):
+        return
 
-Выберите действие:
-    """
-    markup = create_menu_keyboard()
-    bot.send_message(chat_id, menu_text.strip(), reply_markup=markup, parse_mode='Markdown')
+    bot.reply_to(message, build_stats_text(), parse_mode='Markdown')
 
 
 @bot.message_handler(commands=['image', 'generate'])
@@ -354,47 +1295,69 @@ def generate_image(message):
     command_parts = message.text.split(maxsplit=1)
 
     if len(command_parts) < 2:
-        bot.reply_to(message,
-            "🎨 Для генерации изображения укажите описание:\n\n"
-            "Пример: `/image кот в космосе`\n"
-            "Или: `/generate робот читает книгу`",
-            parse_mode='Markdown')
+        bot.reply_to(message, IMAGE_USAGE_TEXT, parse_mode='Markdown')
         return
 
     prompt = command_parts[1]
 
     # Показываем, что бот работает
-    status_message = bot.reply_to(message, "🎨 *Генерирую изображение...*\n\n⏱ Это может занять ~10 секунд", parse_mode='Markdown')
+    status_message = bot.reply_to(message, IMAGE_PROGRESS_TEXT, parse_mode='Markdown')
+    trace = metrics.Trace("image", IMAGE_GENERATION_PARAMS["model"])
 
+    if image_jobs is None:
+        run_image_job(chat_id, prompt, status_message.message_id, trace, [])
+        return
+
+    # Места в очереди, которые показывались пользователю
+    positions = []
+
+    def show_position(position):
+        positions.append(position)
+        bot.edit_message_text(IMAGE_QUEUED_TEXT.format(position=position), chat_id,
+                              status_message.message_id, parse_mode='Markdown')
+
+    try:
+        image_jobs.submit(message.from_user.id, run_image_job, chat_id, prompt, status_message.message_id,
+                          trace, positions, on_position=show_position)
+    except JobRejected as e:
+        log.warning("image_job_rejected", user_id=message.from_user.id, reason=e.reason)
+        text = IMAGE_QUEUE_FULL_TEXT if e.reason == QUEUE_FULL else IMAGE_USER_LIMIT_TEXT
+        bot.edit_message_text(text, chat_id, status_message.message_id, parse_mode='Markdown')
+        trace.finish()
+
+
+def run_image_job(chat_id, prompt, status_message_id, trace, positions):
+    """Сгенерировать изображение и отправить его в чат (выполняется в очереди image_jobs)"""
+    metrics.stage_seconds.observe(time.perf_counter() - trace.started,
+                                  handler=trace.handler, stage="queue", model=trace.model)
     try:
+        # Пока задача ждала, в сообщении было место в очереди
+        if positions:
+            bot.edit_message_text(IMAGE_PROGRESS_TEXT, chat_id, status_message_id, parse_mode='Markdown')
+
         # Генерируем изображение
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            size="1024x1024",
-            quality="standard",
-            n=1,
-        )
+        with trace.span("generation"):
+            response = openai_scheduler.call(IMAGE_GENERATION_PARAMS["model"], 0,
+                                             client.images.with_raw_response.generate,
+                                             prompt=prompt, **IMAGE_GENERATION_PARAMS)
 
         image_url = response.data[0].url
         revised_prompt = response.data[0].revised_prompt
 
         # Удаляем статусное сообщение
-        bot.delete_message(chat_id, status_message.message_id)
+        bot.delete_message(chat_id, status_message_id)
 
         # Отправляем изображение
-        caption_text = f"🎨 *Изображение готово!*\n\n📝 *Ваш запрос:* {prompt}\n\n💡 *Улучшенный промпт:*\n{revised_prompt[:200]}..."
-        bot.send_photo(chat_id, image_url, caption=caption_text, parse_mode='Markdown')
+        caption_text = build_image_caption(prompt, revised_prompt)
+        with trace.span("reply"):
+            bot.send_photo(chat_id, image_url, caption=caption_text, parse_mode='HTML')
 
-    except Exception as e:
-        error_message = f"Произошла ошибка при генерации изображения: {str(e)}"
-        print(error_message)
-        bot.edit_message_text(
-            "❌ *Ошибка генерации изображения*\n\nПопробуйте изменить описание или повторить попытку позже.",
-            chat_id,
-            status_message.message_id,
-            parse_mode='Markdown'
-        )
+    except Exception:
+        log.exception("image_generation_failed", chat_id=chat_id)
+        trace.error()
+        bot.edit_message_text(IMAGE_ERROR_TEXT, chat_id, status_message_id, parse_mode='Markdown')
+    finally:
+        trace.finish()
 
 
 @bot.message_handler(content_types=['photo'])
@@ -408,44 +1371,48 @@ def handle_photo(message):
     # Показываем, что бот печатает
     bot.send_chat_action(chat_id, 'typing')
 
+    trace = metrics.Trace("photo")
     try:
-        # Получаем самое большое фото (последнее в списке)
-        photo = message.photo[-1]
-        file_info = bot.get_file(photo.file_id)
+        user_model = trace.model = resolve_model(chat_id, get_user_model(chat_id), message.caption,
+                                                 attachments=1)
 
-        # Скачиваем фото
-        file_url = f'https://api.telegram.org/file/bot{TG_BOT_TOKEN}/{file_info.file_path}'
-        photo_response = requests.get(file_url)
+        # Детализация определяет, какого размера фото достаточно
+        detail = photo_detail(message.caption)
 
-        # Конвертируем в base64
-        photo_base64 = base64.b64encode(photo_response.content).decode('utf-8')
+        # Берем наименьший размер фото, которого хватает для выбранной детализации
+        photo = select_photo_size(message.photo, detail)
+        cache_key = photo_cache_key(photo, detail)
+        image_part = get_cached_photo_part(cache_key)
 
-        # Получаем caption (если есть)
-        caption = message.caption if message.caption else "Что на этом изображении?"
+        if image_part is None:
+            with trace.span("download"):
+                file_info = bot.get_file(photo.file_id)
+
+                # Скачиваем фото
+                file_url = TELEGRAM_FILE_URL.format(TG_BOT_TOKEN, file_info.file_path)
+                photo_response = http_session.get(file_url, timeout=(5, 30))
+                photo_response.raise_for_status()
+
+            with trace.span("image_prepare"):
+                image_part = build_photo_part(photo_response.content, detail, cache_key)
 
         # Загружаем историю чата
-        history = load_chat_history(chat_id)
+        with trace.span("history_load"):
+            history = load_chat_history(chat_id)
 
         # Добавляем сообщение пользователя с изображением
-        history.append({
-            "role": "user",
-            "content": [
-                {"type": "text", "text": caption},
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{photo_base64}"
-                    }
-                }
-            ]
-        })
+        history.append(build_photo_message(message.caption, image_part))
 
-        # Получаем модель пользователя и отправляем запрос в OpenAI
-        user_model = get_user_model(chat_id)
-        response = call_openai_api(user_model, history)
+        # Отправляем запрос в OpenAI
+        reply = StreamingReply(message) if STREAM_RESPONSES else None
+        with trace.span("completion"):
+            assistant_message, _ = complete_chat(user_model, history, reply,
+                                                 image_history=get_image_history_mode(chat_id))
 
-        # Получаем ответ
-        assistant_message = response.choices[0].message.content
+        # Проверяем, что ответ не пустой
+        if not assistant_message or assistant_message.strip() == "":
+            log.error("empty_response", model=user_model, tool_calls=0)
+            assistant_message = EMPTY_RESPONSE_TEXT
 
         # Добавляем ответ в историю
         history.append({
@@ -454,27 +1421,19 @@ def handle_photo(message):
         })
 
         # Сохраняем историю
-        save_chat_history(chat_id, history)
+        with trace.span("history_save"):
+            save_chat_history(chat_id, history)
 
         # Отправляем ответ пользователю
-        try:
-            bot.reply_to(message, assistant_message, parse_mode='Markdown')
-        except Exception as markdown_error:
-            # Если Markdown не работает, отправляем без форматирования
-            print(f"Markdown error: {markdown_error}")
-            bot.reply_to(message, assistant_message)
+        with trace.span("reply"):
+            send_answer(message, reply, assistant_message)
 
-    except Exception as e:
-        error_message = f"Произошла ошибка при обработке изображения: {str(e)}"
-        print(error_message)
-        import traceback
-        traceback.print_exc()
-        bot.reply_to(message,
-            "⚠️ *Ошибка анализа изображения*\n\n"
-            "Попробуйте:\n"
-            "• Отправить изображение ещё раз\n"
-            "• Использовать `/new` для нового диалога",
-            parse_mode='Markdown')
+    except Exception:
+        log.exception("photo_failed", chat_id=chat_id)
+        trace.error()
+        bot.reply_to(message, PHOTO_ERROR_TEXT, parse_mode='Markdown')
+    finally:
+        trace.finish()
 
 
 @bot.message_handler(func=lambda message: True, content_types=['text'])
@@ -489,9 +1448,17 @@ def handle_message(message):
     # Показываем, что бот печатает
     bot.send_chat_action(chat_id, 'typing')
 
+    trace = metrics.Trace("message")
     try:
+        # Модель пользователя нужна заранее: ею размечаются метрики всех этапов
+        user_model = trace.model = resolve_model(chat_id, get_user_model(chat_id), user_text)
+
+        # Вероятный поиск начинается сразу, пока загружается история и модель готовит вызов функции
+        speculation = start_search_prefetch(user_text)
+
         # Загружаем историю чата
-        history = load_chat_history(chat_id)
+        with trace.span("history_load"):
+            history = load_chat_history(chat_id)
 
         # Добавляем сообщение пользователя
         history.append({
@@ -499,112 +1466,75 @@ def handle_message(message):
             "content": user_text
         })
 
-        # Получаем модель пользователя и отправляем запрос в OpenAI
-        user_model = get_user_model(chat_id)
-        print(f"[DEBUG] Using model: {user_model}")
-        print(f"[DEBUG] History messages count: {len(history)}")
+        log.debug("message_received", chat_id=chat_id, model=user_model, history=len(history))
 
-        response = call_openai_api(user_model, history)
-
-        print(f"[DEBUG] Response type: {type(response)}")
-        print(f"[DEBUG] Response.choices: {response.choices if hasattr(response, 'choices') else 'No choices'}")
-
-        response_message = response.choices[0].message
-        tool_calls = response_message.tool_calls
+        # При потоковом режиме первые токены сразу появляются в сообщении-заглушке
+        reply = StreamingReply(message) if STREAM_RESPONSES else None
+        image_history = get_image_history_mode(chat_id)
+        with trace.span("completion"):
+            response_content, tool_calls = complete_chat(user_model, history, reply,
+                                                         image_history=image_history)
 
         # Проверяем, хочет ли модель вызвать функцию
         if tool_calls:
-            print(f"[DEBUG] Tool calls detected: {len(tool_calls)}")
+            log.debug("tool_calls_requested", count=len(tool_calls))
 
             # Добавляем ответ модели с tool_calls в историю
             history.append({
                 "role": "assistant",
-                "content": response_message.content,
-                "tool_calls": [
-                    {
-                        "id": tc.id,
-                        "type": tc.type,
-                        "function": {
-                            "name": tc.function.name,
-                            "arguments": tc.function.arguments
-                        }
-                    } for tc in tool_calls
-                ]
+                "content": response_content,
+                "tool_calls": tool_calls
             })
 
-            # Выполняем вызовы функций
-            for tool_call in tool_calls:
-                function_name = tool_call.function.name
-                function_args = json.loads(tool_call.function.arguments)
-
-                print(f"[DEBUG] Calling function: {function_name} with args: {function_args}")
+            if reply is not None:
+                reply.update(SEARCHING_TEXT, force=True)
 
-                if function_name == "google_search":
-                    function_response = google_search(**function_args)
-                else:
-                    function_response = f"Неизвестная функция: {function_name}"
+            # Выполняем вызовы функций параллельно
+            with trace.span("tools"):
+                function_responses = execute_tool_calls(tool_calls, speculation)
 
-                print(f"[DEBUG] Function response: {function_response[:200]}...")
-
-                # Добавляем результат функции в историю
-                history.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": function_response
-                })
+            # Добавляем результаты функций в историю в исходном порядке (длинные - в blob_store)
+            for tool_call, function_response in zip(tool_calls, function_responses):
+                history.append(make_tool_message(
+                    blob_store, tool_call["id"], function_response, TOOL_RESULT_INLINE_LIMIT))
 
             # Делаем второй запрос с результатами функций
-            second_response = call_openai_api(user_model, history, use_tools=False)
-            assistant_message = second_response.choices[0].message.content
+            with trace.span("completion_after_tools"):
+                assistant_message, _ = complete_chat(user_model, history, reply, use_tools=False,
+                                                     image_history=image_history)
         else:
             # Обычный ответ без tool calls
-            assistant_message = response_message.content
-
-        print(f"[DEBUG] Raw assistant_message: '{assistant_message}' (type: {type(assistant_message)})")
+            assistant_message = response_content
+            if speculation is not None:
+                finish_search_prefetch(speculation, UNUSED)
 
         # Проверяем, что ответ не пустой
         if not assistant_message or assistant_message.strip() == "":
-            print(f"[ERROR] Empty response from OpenAI. Full response: {response}")
-            assistant_message = "Извините, я не смог сгенерировать ответ. Попробуйте еще раз."
+            log.error("empty_response", model=user_model, tool_calls=len(tool_calls))
+            assistant_message = EMPTY_RESPONSE_TEXT
 
-        print(f"[DEBUG] Assistant message length: {len(assistant_message) if assistant_message else 0}")
-        print(f"[DEBUG] Assistant message preview: {assistant_message[:100] if assistant_message else 'None'}")
+        log.debug("assistant_message", length=len(assistant_message), text=assistant_message)
 
-        # Добавляем финальный ответ в историю (если не было tool calls)
-        if not tool_calls:
-            history.append({
-                "role": "assistant",
-                "content": assistant_message
-            })
-        else:
-            # Если были tool calls, добавляем финальный ответ
-            history.append({
-                "role": "assistant",
-                "content": assistant_message
-            })
+        # Добавляем финальный ответ в историю
+        history.append({
+            "role": "assistant",
+            "content": assistant_message
+        })
 
         # Сохраняем историю
-        save_chat_history(chat_id, history)
+        with trace.span("history_save"):
+            save_chat_history(chat_id, history)
 
         # Отправляем ответ пользователю
-        try:
-            bot.reply_to(message, assistant_message, parse_mode='Markdown')
-        except Exception as markdown_error:
-            # Если Markdown не работает, отправляем без форматирования
-            print(f"Markdown error: {markdown_error}")
-            bot.reply_to(message, assistant_message)
+        with trace.span("reply"):
+            send_answer(message, reply, assistant_message)
 
-    except Exception as e:
-        error_message = f"Произошла ошибка: {str(e)}"
-        print(error_message)
-        import traceback
-        traceback.print_exc()
-        bot.reply_to(message,
-            "⚠️ *Ошибка обработки сообщения*\n\n"
-            "Попробуйте:\n"
-            "• Переформулировать вопрос\n"
-            "• Использовать `/new` для нового диалога",
-            parse_mode='Markdown')
+    except Exception:
+        log.exception("message_failed", chat_id=chat_id)
+        trace.error()
+        bot.reply_to(message, MESSAGE_ERROR_TEXT, parse_mode='Markdown')
+    finally:
+        trace.finish()
 
 
 @bot.callback_query_handler(func=lambda call: True)
@@ -623,26 +1553,12 @@ def callback_handler(call):
             # Очистка истории
             clear_chat_history(chat_id)
             bot.answer_callback_query(call.id, "✅ История очищена!")
-            bot.edit_message_text(
-                "✅ История диалога очищена. Начинаем новый разговор!",
-                chat_id,
-                message_id
-            )
+            bot.edit_message_text(HISTORY_CLEARED_TEXT, chat_id, message_id)
 
         elif call.data == "select_model":
             # Показать выбор модели
             current_model = get_user_model(chat_id)
-            model_text = "🤖 *Выберите модель:*\n\n"
-
-            for model_id, model_info in MODELS.items():
-                status = "✅ *Активна*" if model_id == current_model else ""
-                model_text += f"• *{model_info['name']}*\n"
-                model_text += f"  Скорость: `{model_info['speed']}`\n"
-                model_text += f"  {model_info['description']}\n"
-                if status:
-                    model_text += f"  {status}\n"
-                model_text += "\n"
-
+            model_text = build_model_selection_text(current_model)
             markup = create_model_keyboard(current_model)
             bot.edit_message_text(model_text, chat_id, message_id, reply_markup=markup, parse_mode='Markdown')
 
@@ -657,42 +1573,233 @@ def callback_handler(call):
                 bot.answer_callback_query(call.id, f"✅ Модель изменена на {model_name}")
 
                 # Обновляем сообщение с новой активной моделью
-                model_text = "🤖 *Выберите модель:*\n\n"
-                for model_id, model_info in MODELS.items():
-                    status = "✅ *Активна*" if model_id == selected_model else ""
-                    model_text += f"• *{model_info['name']}*\n"
-                    model_text += f"  Скорость: `{model_info['speed']}`\n"
-                    model_text += f"  {model_info['description']}\n"
-                    if status:
-                        model_text += f"  {status}\n"
-                    model_text += "\n"
+                model_text = build_model_selection_text(selected_model)
 
                 markup = create_model_keyboard(selected_model)
                 bot.edit_message_text(model_text, chat_id, message_id, reply_markup=markup, parse_mode='Markdown')
 
         elif call.data == "back_to_menu":
             # Вернуться в главное меню
-            current_model = get_user_model(chat_id)
-            model_name = MODELS[current_model]["name"]
-
-            menu_text = f"""
-⚙️ *Меню настроек*
+            menu_text = build_menu_text(MODELS[get_user_model(chat_id)]["name"])
+            markup = create_menu_keyboard(get_image_history_mode(chat_id))
+            bot.edit_message_text(menu_text, chat_id, message_id, reply_markup=markup, parse_mode='Markdown')
+
+        elif call.data == "toggle_image_history":
+            # Переключение режима отображения старых изображений
+            if get_image_history_mode(chat_id) == IMAGE_HISTORY_THUMBNAIL:
+                new_mode = IMAGE_HISTORY_TEXT
+                bot.answer_callback_query(call.id, "✅ Старые изображения будут заменяться описанием")
+            else:
+                new_mode = IMAGE_HISTORY_THUMBNAIL
+                bot.answer_callback_query(call.id, "✅ Старые изображения будут отправляться миниатюрами")
+            set_image_history_mode(chat_id, new_mode)
+            markup = create_menu_keyboard(new_mode)
+            bot.edit_message_reply_markup(chat_id, message_id, reply_markup=markup)
 
-Текущая модель: *{model_name}*
+    except Exception as e:
+        log.error("callback_failed", data=call.data, error=e)
+        bot.answer_callback_query(call.id, "❌ Произошла ошибка")
 
-Выберите действие:
-            """
-            markup = create_menu_keyboard()
-            bot.edit_message_text(menu_text.strip(), chat_id, message_id, reply_markup=markup, parse_mode='Markdown')
 
+def update_chat_id(update):
+    """chat_id, к которому относится обновление (None для обновлений вне чатов)"""
+    message = update.message or update.edited_message or update.channel_post or update.edited_channel_post
+    if message is None and update.callback_query is not None:
+        message = update.callback_query.message
+    return message.chat.id if message is not None else None
+
+
+def update_user(update):
+    """Пользователь, от которого пришло обновление (None, если его нет)"""
+    if update.message is not None:
+        return update.message.from_user
+    if update.callback_query is not None:
+        return update.callback_query.from_user
+    return None
+
+
+def message_kind(message):
+    """Вид сообщения для стоимости в admission"""
+    if message.photo:
+        return KIND_PHOTO
+    text = message.text or ''
+    if not text.startswith('/'):
+        return KIND_TEXT if text else KIND_OTHER
+    command = text.split(maxsplit=1)[0].split('@')[0]
+    return KIND_IMAGE if command in ('/image', '/generate') else KIND_OTHER
+
+
+def admit_update(update):
+    """Допуск обновления до очереди и сетевых запросов: (допущено, текст ответа об отказе или None)"""
+    user = update_user(update)
+    if user is None:
+        return True, None
+    kind = message_kind(update.message) if update.message is not None else KIND_OTHER
+    result = admission.admit(user.id, update_chat_id(update), kind)
+    metrics.admission_total.inc(kind=kind, result=result)
+    if result == ADMITTED:
+        return True, None
+    if not admission.should_notify(user.id, result):
+        return False, None
+
+    if result == DENIED:
+        username = user.username or user.first_name or "Неизвестный"
+        log.warning("access_denied", user_id=user.id, username=username)
+        if update.message is None:
+            return False, ACCESS_DENIED_SHORT_TEXT
+        return False, build_access_denied_text(user.id)
+    log.warning("update_shed", reason=result, user_id=user.id, chat_id=update_chat_id(update), kind=kind)
+    return False, RATE_LIMITED_TEXT
+
+
+def reply_to_update(update, text):
+    """Ответить на обновление, не обрабатывая его (сообщением или уведомлением для кнопки)"""
+    try:
+        if update.message is not None:
+            bot.reply_to(update.message, text, parse_mode='Markdown')
+        elif update.callback_query is not None:
+            bot.answer_callback_query(update.callback_query.id, text)
     except Exception as e:
-        print(f"Error in callback handler: {e}")
-        bot.answer_callback_query(call.id, "❌ Произошла ошибка")
+        log.error("notice_failed", error=e)
+
+
+def make_update_router(submit, admit=True):
+    """process_new_updates, который передает каждое допущенное обновление в submit(update).
+
+    submit возвращает False, если очередь переполнена. admit=False - допуск уже выполнен
+    (в процессе-шарде его выполняет супервизор).
+    """
+    def route_updates(updates):
+        for update in updates:
+            # Смещение getUpdates сдвигаем сразу, не дожидаясь обработки
+            bot.last_update_id = max(bot.last_update_id, update.update_id)
+            if admit:
+                admitted, notice = admit_update(update)
+                if not admitted:
+                    if notice:
+                        reply_to_update(update, notice)
+                    continue
+            if not submit(update):
+                log.warning("chat_queue_full", update_id=update.update_id, chat_id=update_chat_id(update))
+                user = update_user(update)
+                if user is None or admission.should_notify(user.id, CHAT_BUSY):
+                    reply_to_update(update, CHAT_BUSY_TEXT)
+
+    return route_updates
+
+
+def start_dispatcher(admit=True):
+    """Направить обновления бота через очереди по чатам и запустить очередь изображений"""
+    global dispatcher, image_jobs
+    dispatcher = ChatDispatcher(workers=CHAT_WORKERS, max_chat_queue=CHAT_QUEUE_LIMIT,
+                                max_pending=UPDATE_QUEUE_LIMIT)
+    image_jobs = JobQueue(workers=IMAGE_WORKERS, max_pending=IMAGE_QUEUE_LIMIT,
+                          max_per_user=IMAGE_JOBS_PER_USER, name="image-worker")
+    process_updates = bot.process_new_updates
+
+    def process_update(update):
+        # Все записи в лог при обработке обновления помечаются его update_id
+        with logs.request_context(update.update_id):
+            process_updates([update])
+
+    bot.process_new_updates = make_update_router(
+        lambda update: dispatcher.submit(update_chat_id(update), process_update, update), admit)
+    if compactor is not None:
+        compactor.apply = apply_compaction
+
+
+def stop_dispatcher():
+    """Дождаться уже принятых сообщений, затем сбросить историю и кэши на диск"""
+    dispatcher.shutdown(timeout=30)
+    image_jobs.shutdown(timeout=30)
+    model_latency.save()
+    photo_cache.save()
+    storage.close()
+
+
+def run_shard(index, updates, health):
+    """Процесс-шард: обрабатывает обновления своих чатов из канала супервизора"""
+    # Ctrl+C получает вся группа процессов: шарды останавливает супервизор, дав им доработать
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_dispatcher(admit=False)
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_HOST, METRICS_PORT + 1 + index)
+
+    def stats():
+        return {"dispatcher": dispatcher.stats(), "images": image_jobs.stats()}
+
+    try:
+        serve_shard(index, updates, health, lambda update: bot.process_new_updates([update]), stats,
+                    health_interval=SHARD_HEALTH_INTERVAL)
+    finally:
+        stop_dispatcher()
+
+
+def start_supervisor():
+    """Запустить процессы-шарды и направлять им допущенные обновления по chat_id"""
+    supervisor = ShardSupervisor(SHARDS, run_shard, queue_limit=SHARD_QUEUE_LIMIT,
+                                 health_interval=SHARD_HEALTH_INTERVAL, health_timeout=SHARD_HEALTH_TIMEOUT,
+                                 status_path=HISTORY_DIR / 'shards.json')
+    supervisor.start()
+    bot.process_new_updates = make_update_router(
+        lambda update: supervisor.route(update_chat_id(update), update))
+    return supervisor
+
+
+def run_webhook():
+    """Принимать обновления через webhook до остановки процесса"""
+    # Без заданного секрета генерируем случайный: он нужен только Telegram
+    secret_token = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = WebhookServer(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, secret_token, bot.process_new_updates)
+
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=secret_token, max_connections=WEBHOOK_MAX_CONNECTIONS)
+        log.info("webhook_registered", url=WEBHOOK_URL)
+    else:
+        # WEBHOOK_URL не задан: webhook в Telegram не регистрируется
+        log.info("webhook_not_registered", mode="local")
+        if not WEBHOOK_SECRET:
+            # Сгенерированный секрет нигде больше не виден, а без него сервер отвечает 403 на любой запрос
+            log.warning("webhook_secret_generated", secret=secret_token, header=SECRET_TOKEN_HEADER)
+    log.info("webhook_listening", address=f"{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
 
 
 if __name__ == '__main__':
-    print("Бот запущен и готов к работе!")
-    print(f"История чатов сохраняется в: {HISTORY_DIR.absolute()}")
+    log.info("bot_started", engine="threads", updates=UPDATE_MODE)
+    log.info("history_storage", path=HISTORY_DIR.absolute(), backend=STORAGE_BACKEND)
+
+    # systemd останавливает службу через SIGTERM: завершаемся штатно,
+    # чтобы отложенные записи истории успели попасть на диск
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-    # Запускаем бота в режиме polling
-    bot.infinity_polling()
+    if SHARDS > 1:
+        supervisor = start_supervisor()
+        log.info("shards_started", shards=SHARDS)
+    else:
+        start_dispatcher()
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_HOST, METRICS_PORT)
+        log.info("metrics_listening", url=f"http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    try:
+        if UPDATE_MODE == 'webhook':
+            run_webhook()
+        else:
+            # getUpdates не работает, пока установлен webhook (например, после режима webhook)
+            try:
+                bot.remove_webhook()
+            except Exception as e:
+                log.error("remove_webhook_failed", error=e)
+            # Запускаем бота в режиме polling
+            bot.infinity_polling()
+    finally:
+        if SHARDS > 1:
+            supervisor.shutdown(timeout=30)
+            storage.close()
+        else:
+            stop_dispatcher()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Фоновое сжатие длинных историй чатов.
+
+Когда история чата превышает порог по числу ходов или токенов, старые ходы
+пересказываются дешевой моделью и заменяются одним системным сообщением с
+кратким содержанием. Начальное системное сообщение и последние keep_turns
+ходов остаются без изменений, а прежнее краткое содержание входит в новое.
+
+Пересказ выполняется в фоновом потоке, вне обработки сообщений. Замена
+истории передается в apply(chat_id, swap): бот выполняет ее в очереди чата,
+чтобы она не пересеклась с обработчиком. Перед заменой swap проверяет, что
+пересказанная часть истории не изменилась (например, после /new). Пока
+apply не задан (нет очередей по чатам), сжатие не планируется: замена вне
+очереди была бы потеряна, если бы обработчик сохранил прочитанную до нее
+историю.
+"""
+
+import queue
+import threading
+
+from context import count_message_tokens, split_turns
+from logs import get_logger
+
+log = get_logger(__name__)
+
+SUMMARY_PREFIX = "Краткое содержание предыдущей части разговора:\n"
+# Длинные сообщения (результаты поиска, код) попадают в пересказ сокращенными
+TRANSCRIPT_MESSAGE_LIMIT = 2000
+
+ROLE_NAMES = {"user": "Пользователь", "assistant": "Ассистент", "tool": "Результат поиска"}
+
+
+def is_summary(message):
+    return message.get("role") == "system" and str(message.get("content", "")).startswith(SUMMARY_PREFIX)
+
+
+def make_summary_message(text):
+    return {"role": "system", "content": SUMMARY_PREFIX + text.strip()}
+
+
+def _message_text(message):
+    content = message.get("content")
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if part.get("type") == "text":
+                parts.append(part.get("text", ""))
+            elif part.get("type") == "image_url":
+                parts.append("[изображение]")
+        content = " ".join(parts)
+    text = content or ""
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function", {})
+        text += f" [вызов {function.get('name')}: {function.get('arguments')}]"
+    return text.strip()
+
+
+def format_transcript(messages):
+    """Текст диалога для пересказа"""
+    lines = []
+    for message in messages:
+        if is_summary(message):
+            lines.append(message["content"])
+            continue
+        text = _message_text(message)
+        if not text:
+            continue
+        if len(text) > TRANSCRIPT_MESSAGE_LIMIT:
+            text = text[:TRANSCRIPT_MESSAGE_LIMIT] + "…"
+        lines.append(f"{ROLE_NAMES.get(message.get('role'), message.get('role'))}: {text}")
+    return "\n\n".join(lines)
+
+
+def split_history(history, keep_turns):
+    """Разделить историю для сжатия.
+
+    Возвращает системные сообщения без прежнего пересказа, сообщения для нового
+    пересказа и число сообщений с начала истории, которые он заменит.
+    """
+    head = 0
+    while head < len(history) and history[head].get("role") == "system":
+        head += 1
+    system = [message for message in history[:head] if not is_summary(message)]
+    summaries = [message for message in history[:head] if is_summary(message)]
+    turns = split_turns(history[head:])
+    if len(turns) <= keep_turns:
+        return system, [], 0
+    old = [message for turn in turns[:len(turns) - keep_turns] for message in turn]
+    return system, summaries + old, head + len(old)
+
+
+class HistoryCompactor:
+    """Очередь чатов на сжатие и фоновый поток, который их пересказывает"""
+
+    def __init__(self, storage, summarize, apply, max_turns=30, max_tokens=12000, keep_turns=6,
+                 on_compacted=None):
+        self.storage = storage
+        # summarize(messages) -> текст краткого содержания
+        self.summarize = summarize
+        # apply(chat_id, swap) - выполнить замену истории в очереди чата (None - сжатие выключено)
+        self.apply = apply
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.keep_turns = keep_turns
+        # on_compacted(chat_id) - вызывается после замены истории (например, чтобы удалить ненужные вложения)
+        self.on_compacted = on_compacted
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.compacted = 0
+        self.skipped = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._worker, name="history-compactor", daemon=True)
+        self._thread.start()
+
+    def needs_compaction(self, history):
+        turns = sum(1 for message in history if message.get("role") == "user")
+        if turns <= self.keep_turns:
+            return False
+        if turns > self.max_turns:
+            return True
+        return sum(count_message_tokens(message) for message in history) > self.max_tokens
+
+    def schedule(self, chat_id, history):
+        """Поставить чат в очередь на сжатие, если история превысила порог"""
+        if self.apply is None or not self.needs_compaction(history):
+            return False
+        with self._lock:
+            if chat_id in self._pending:
+                return False
+            self._pending.add(chat_id)
+        self._queue.put(chat_id)
+        return True
+
+    def _worker(self):
+        while True:
+            chat_id = self._queue.get()
+            try:
+                self.compact(chat_id)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                log.error("compaction_failed", chat_id=chat_id, error=e)
+            finally:
+                with self._lock:
+                    self._pending.discard(chat_id)
+
+    def compact(self, chat_id):
+        """Пересказать старые ходы чата и передать замену истории в apply"""
+        history = self.storage.load_history(chat_id)
+        if not history or not self.needs_compaction(history):
+            return
+        system, old, replaced = split_history(history, self.keep_turns)
+        if not old:
+            return
+
+        summary = make_summary_message(self.summarize(old))
+        prefix = history[:replaced]
+
+        def swap():
+            current = self.storage.load_history(chat_id)
+            if not current or current[:replaced] != prefix:
+                # История изменилась не только дописыванием (/new, другое сжатие) - пересказ устарел
+                with self._lock:
+                    self.skipped += 1
+                log.info("compaction_skipped", chat_id=chat_id, reason="history changed")
+                return
+            self.storage.replace_history(chat_id, system + [summary] + current[replaced:])
+            with self._lock:
+                self.compacted += 1
+            log.info("history_compacted", chat_id=chat_id, messages=replaced, summary_chars=len(summary["content"]))
+            if self.on_compacted is not None:
+                self.on_compacted(chat_id)
+
+        self.apply(chat_id, swap)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "compacted": self.compacted,
+                "skipped": self.skipped,
+                "failed": self.failed,
+            }
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Сборка контекста для OpenAI в пределах бюджета токенов.
+
+Из истории всегда берутся начальные системные сообщения, а затем - столько
+последних ходов, сколько помещается в бюджет. Ход начинается с сообщения
+пользователя и включает все ответы модели, tool_calls и результаты функций,
+поэтому пары tool_call/tool никогда не разрываются.
+"""
+
+import threading
+from functools import lru_cache
+
+ENCODING_NAME = "o200k_base"
+
+# Словарь tiktoken загружается при первом подсчете, а не при импорте: без кэша
+# (TIKTOKEN_CACHE_DIR) tiktoken скачивает его, и импорт модуля ждал бы сети
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD = 4
+# Стоимость изображения: detail=low - фиксированные 85 токенов, иначе оценка для 1024x1024
+IMAGE_TOKENS_LOW = 85
+IMAGE_TOKENS_HIGH = 765
+
+
+def _get_encoding():
+    """Словарь tiktoken или None (tiktoken не установлен или не смог загрузить словарь)"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding(ENCODING_NAME)
+                except Exception:
+                    # Считаем приближенно
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+@lru_cache(maxsize=8192)
+def count_text_tokens(text):
+    """Количество токенов в тексте"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # Приближенная оценка: ~3 символа на токен (с запасом для кириллицы)
+    return len(text) // 3 + 1
+
+
+def count_message_tokens(message):
+    """Количество токенов в одном сообщении истории"""
+    tokens = MESSAGE_OVERHEAD
+    content = message.get("content")
+    if isinstance(content, str):
+        tokens += count_text_tokens(content)
+    elif isinstance(content, list):
+        for part in content:
+            if part.get("type") == "text":
+                tokens += count_text_tokens(part.get("text"))
+            elif part.get("type") == "image_url":
+                detail = part.get("image_url", {}).get("detail", "auto")
+                tokens += IMAGE_TOKENS_LOW if detail == "low" else IMAGE_TOKENS_HIGH
+    for tool_call in message.get("tool_calls") or []:
+        function = tool_call.get("function", {})
+        tokens += count_text_tokens(function.get("name")) + count_text_tokens(function.get("arguments"))
+    return tokens
+
+
+def split_turns(messages):
+    """Разбить историю (без начальных системных сообщений) на ходы"""
+    turns = []
+    for message in messages:
+        if message.get("role") == "user" or not turns:
+            turns.append([message])
+        else:
+            turns[-1].append(message)
+    return turns
+
+
+def build_context(history, budget):
+    """Вернуть сообщения для запроса: системные + последние ходы в пределах budget токенов.
+
+    Последний ход включается всегда, даже если он один превышает бюджет.
+    """
+    head = 0
+    while head < len(history) and history[head].get("role") == "system":
+        head += 1
+    system, turns = history[:head], split_turns(history[head:])
+
+    used = sum(count_message_tokens(m) for m in system)
+    selected = []
+    for turn in reversed(turns):
+        turn_tokens = sum(count_message_tokens(m) for m in turn)
+        if selected and used + turn_tokens > budget:
+            break
+        selected.append(turn)
+        used += turn_tokens
+
+    context = list(system)
+    for turn in reversed(selected):
+        context.extend(turn)
+    return context
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Диспетчер обновлений с очередью на каждый чат.
+
+Задачи одного chat_id выполняются строго по очереди (история чата читается
+и сохраняется без гонок), а задачи разных чатов - параллельно в пуле потоков.
+Очереди ограничены: если у чата накопилось слишком много задач, новая
+отклоняется, а при переполнении общей очереди submit() ждет (backpressure),
+поэтому поток опроса Telegram перестает забирать новые обновления.
+
+AsyncChatDispatcher - то же для asyncio: задачи - корутины, а вместо
+пула потоков у каждого чата с задачами своя задача asyncio.
+"""
+
+import time
+import asyncio
+import threading
+from collections import deque
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+class ChatDispatcher:
+    """Пул потоков с упорядоченными очередями по ключу (chat_id)"""
+
+    def __init__(self, workers=8, max_chat_queue=10, max_pending=1000, name="chat-worker"):
+        self.max_chat_queue = max_chat_queue
+        self.max_pending = max_pending
+        # Очереди чатов, у которых есть ожидающие или выполняющиеся задачи
+        self._queues = {}
+        # Чаты, задачу которых можно брать в работу (не более одной задачи чата одновременно)
+        self._ready = deque()
+        self._pending = 0
+        self._running = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.blocked = 0
+
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, func, *args):
+        """Поставить func(*args) в очередь чата key.
+
+        Возвращает False, если очередь чата заполнена или диспетчер остановлен.
+        Если заполнена общая очередь, ждет, пока в ней освободится место.
+        """
+        with self._cond:
+            queue = self._queues.get(key)
+            if self._closed or (queue is not None and len(queue) >= self.max_chat_queue):
+                self.rejected += 1
+                return False
+
+            if self._pending >= self.max_pending:
+                self.blocked += 1
+                while self._pending >= self.max_pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    self.rejected += 1
+                    return False
+                queue = self._queues.get(key)
+
+            if queue is None:
+                queue = self._queues[key] = deque()
+                self._ready.append(key)
+            queue.append((func, args))
+            self._pending += 1
+            self._cond.notify_all()
+            return True
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ready and not (self._closed and self._pending == 0):
+                    self._cond.wait()
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+                func, args = self._queues[key].popleft()
+                self._running += 1
+
+            failed = False
+            try:
+                func(*args)
+            except Exception:
+                failed = True
+                log.exception("dispatcher_task_failed", chat_id=key)
+
+            with self._cond:
+                self.failed += failed
+                self._running -= 1
+                self._pending -= 1
+                self.completed += 1
+                if self._queues[key]:
+                    # Следующая задача чата встает в конец, чтобы чаты обслуживались по кругу
+                    self._ready.append(key)
+                else:
+                    del self._queues[key]
+                self._cond.notify_all()
+
+    def stats(self):
+        """Текущее состояние очередей и счетчики"""
+        with self._cond:
+            return {
+                "workers": len(self._threads),
+                "pending": self._pending,
+                "running": self._running,
+                "chats": len(self._queues),
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "failed": self.failed,
+                "blocked": self.blocked,
+            }
+
+    def shutdown(self, timeout=None):
+        """Перестать принимать задачи и дождаться выполнения уже принятых (не дольше timeout)"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+
+class AsyncChatDispatcher:
+    """Очереди корутин по ключу (chat_id): по одной выполняющейся на чат, чаты - параллельно"""
+
+    def __init__(self, max_chat_queue=10, max_pending=1000):
+        self.max_chat_queue = max_chat_queue
+        self.max_pending = max_pending
+        # Ожидающие задачи чатов, у которых есть ожидающие или выполняющаяся задача
+        self._queues = {}
+        # Задачи asyncio, обрабатывающие очереди чатов
+        self._runners = set()
+        self._pending = 0
+        self._running = 0
+        self._closed = False
+        self._space = asyncio.Event()
+        self._space.set()
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.blocked = 0
+
+    async def submit(self, key, func, *args):
+        """Поставить await func(*args) в очередь чата key (False - очередь чата заполнена или остановлена)"""
+        queue = self._queues.get(key)
+        if self._closed or (queue is not None and len(queue) >= self.max_chat_queue):
+            self.rejected += 1
+            return False
+
+        if self._pending >= self.max_pending:
+            self.blocked += 1
+            while self._pending >= self.max_pending and not self._closed:
+                self._space.clear()
+                await self._space.wait()
+            if self._closed:
+                self.rejected += 1
+                return False
+            queue = self._queues.get(key)
+
+        if queue is None:
+            queue = self._queues[key] = deque()
+            runner = asyncio.create_task(self._run(key, queue))
+            self._runners.add(runner)
+            runner.add_done_callback(self._runners.discard)
+        queue.append((func, args))
+        self._pending += 1
+        return True
+
+    async def _run(self, key, queue):
+        # Проверка и удаление пустой очереди идут без await между ними: submit не может
+        # добавить задачу в очередь, которую уже никто не обработает
+        while queue:
+            func, args = queue.popleft()
+            self._running += 1
+            try:
+                await func(*args)
+            except Exception:
+                self.failed += 1
+                log.exception("dispatcher_task_failed", chat_id=key)
+            finally:
+                self._running -= 1
+                self._pending -= 1
+                self.completed += 1
+                self._space.set()
+        del self._queues[key]
+
+    def stats(self):
+        """Текущее состояние очередей и счетчики"""
+        return {
+            "pending": self._pending,
+            "running": self._running,
+            "chats": len(self._queues),
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "blocked": self.blocked,
+        }
+
+    async def shutdown(self, timeout=None):
+        """Перестать принимать задачи и дождаться выполнения уже принятых (не дольше timeout)"""
+        self._closed = True
+        self._space.set()
+        if self._runners:
+            await asyncio.wait(set(self._runners), timeout=timeout)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Кэш обработанных файлов Telegram по file_unique_id.
+
+Одно и то же фото часто пересылают повторно или присылают с другой
+подписью. file_unique_id у него при этом не меняется, поэтому по нему
+можно сразу взять уже подготовленную часть сообщения (ссылки на
+уменьшенное изображение и миниатюру в blob_store) и не вызывать getFile,
+не скачивать и не пережимать фото заново.
+
+Сами данные лежат в blob_store, а кэш хранит только ссылки на них: это
+небольшой JSON-файл с вытеснением давно не использованных записей (LRU).
+"""
+
+import os
+import copy
+import json
+import time
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+class FileCache:
+    """LRU-кэш {ключ: JSON-значение} с периодическим сохранением на диск"""
+
+    def __init__(self, path, max_entries=1000, save_interval=60.0):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # Файл записан от давно использованных записей к недавним
+            self._entries = OrderedDict(data)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        except (OSError, ValueError) as e:
+            log.error("file_cache_load_failed", path=self.path, error=e)
+
+    def get(self, key):
+        """Копия значения или None"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return copy.deepcopy(value)
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = copy.deepcopy(value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+            save_now = time.monotonic() - self._saved_at >= self.save_interval
+        if save_now:
+            self.save()
+
+    def discard(self, key):
+        """Удалить запись (например, если данные, на которые она ссылается, пропали)"""
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._dirty = True
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+    def save(self):
+        """Записать кэш на диск (через временный файл)"""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = list(self._entries.items())
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.error("file_cache_save_failed", path=self.path, error=e)
+            with self._lock:
+                self._dirty = True
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Общие HTTP клиенты с пулами keep-alive соединений.
+
+Вместо отдельного TCP+TLS соединения на каждый запрос все исходящие
+запросы (Telegram Bot API, скачивание файлов, Google Search, OpenAI)
+используют долгоживущие пулы соединений с таймаутами и повторами.
+Для асинхронного режима (async_bot.py) есть аналогичные async клиенты.
+"""
+
+from urllib.parse import urlsplit
+
+import aiohttp
+import httpx
+import requests
+from openai import DefaultAsyncHttpxClient, DefaultHttpxClient
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class PooledSession(requests.Session):
+    """requests.Session с таймаутом по умолчанию для всех запросов"""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().request(method, url, **kwargs)
+
+
+def create_retry(retries=2, backoff_factor=0.3):
+    """Политика повторов: ошибки соединения - для любых запросов,
+    ошибки чтения и 5xx - только для идемпотентных GET/HEAD"""
+    return Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset({'GET', 'HEAD'}),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+
+
+def url_origin(url):
+    """Префикс scheme://host[:port]/ для отдельного пула соединений в create_session"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}/"
+
+
+def create_session(host_pools=None, default_pool_size=10, timeout=(5, 30), retries=2):
+    """Сессия requests с отдельным пулом соединений для каждого хоста из host_pools.
+
+    host_pools - словарь {префикс URL: размер пула}, например {"https://api.telegram.org/": 32}.
+    """
+    session = PooledSession(timeout)
+    retry = create_retry(retries)
+
+    default_adapter = HTTPAdapter(pool_connections=10, pool_maxsize=default_pool_size, max_retries=retry)
+    session.mount('https://', default_adapter)
+    session.mount('http://', default_adapter)
+
+    # requests выбирает адаптер с самым длинным совпадающим префиксом
+    for prefix, pool_size in (host_pools or {}).items():
+        session.mount(prefix, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry))
+
+    return session
+
+
+def _openai_limits(max_connections, max_keepalive_connections):
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_keepalive_connections,
+        keepalive_expiry=60
+    )
+
+
+def create_openai_http_client(max_connections=100, max_keepalive_connections=20,
+                              timeout=120.0, connect_timeout=5.0):
+    """httpx клиент для OpenAI с заданными лимитами пула и таймаутами"""
+    return DefaultHttpxClient(
+        limits=_openai_limits(max_connections, max_keepalive_connections),
+        timeout=httpx.Timeout(timeout, connect=connect_timeout)
+    )
+
+
+def create_async_openai_http_client(max_connections=500, max_keepalive_connections=100,
+                                    timeout=120.0, connect_timeout=5.0):
+    """Асинхронный httpx клиент для AsyncOpenAI"""
+    return DefaultAsyncHttpxClient(
+        limits=_openai_limits(max_connections, max_keepalive_connections),
+        timeout=httpx.Timeout(timeout, connect=connect_timeout)
+    )
+
+
+def create_aiohttp_session(limit=100, limit_per_host=20, timeout=30):
+    """aiohttp сессия с пулом keep-alive соединений (создается внутри event loop)"""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host, keepalive_timeout=60),
+        timeout=aiohttp.ClientTimeout(total=timeout, connect=5)
+    )
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Подготовка фотографий к отправке в OpenAI Vision.
+
+OpenAI все равно уменьшает изображения: при detail=low до 512x512, при detail=high
+так, чтобы короткая сторона была не больше 768 (а длинная - не больше 2048).
+Поэтому из размеров, которые хранит Telegram, выбирается наименьший достаточный,
+а при необходимости изображение дополнительно уменьшается и пережимается в JPEG.
+"""
+
+import io
+import re
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+DETAIL_LOW = "low"
+DETAIL_HIGH = "high"
+
+# Размеры, до которых OpenAI уменьшает изображение при каждом уровне детализации
+LOW_DETAIL_SIDE = 512
+HIGH_DETAIL_SHORT_SIDE = 768
+HIGH_DETAIL_LONG_SIDE = 2048
+
+# Подписи, для ответа на которые нужны мелкие детали изображения
+HIGH_DETAIL_PATTERN = re.compile(
+    r"\b(?:текст|прочита|прочти|распозна|переведи|перевод|надпис|мелк|детал|документ|таблиц|"
+    r"график|диаграм|схем|чек|формул|код|скриншот|скрин|экран|ошибк|цифр|номер|сколько|"
+    r"text|read|ocr|translate|detail|document|table|chart|graph|diagram|receipt|formula|"
+    r"code|screenshot|screen|error|number|count|how many)",
+    re.IGNORECASE
+)
+
+
+def choose_detail(caption):
+    """Уровень детализации по подписи к фото: high только если нужны мелкие детали"""
+    if caption and HIGH_DETAIL_PATTERN.search(caption):
+        return DETAIL_HIGH
+    return DETAIL_LOW
+
+
+def _is_enough(width, height, detail):
+    if detail == DETAIL_LOW:
+        return max(width, height) >= LOW_DETAIL_SIDE
+    return min(width, height) >= HIGH_DETAIL_SHORT_SIDE or max(width, height) >= HIGH_DETAIL_LONG_SIDE
+
+
+def select_photo_size(photo_sizes, detail):
+    """Наименьший PhotoSize, которого достаточно для выбранной детализации"""
+    photo_sizes = sorted(photo_sizes, key=lambda p: p.width * p.height)
+    for photo_size in photo_sizes:
+        if _is_enough(photo_size.width, photo_size.height, detail):
+            return photo_size
+    # Все варианты меньше целевого размера - берем самый большой
+    return photo_sizes[-1]
+
+
+def _target_size(width, height, detail):
+    if detail == DETAIL_LOW:
+        scale = LOW_DETAIL_SIDE / max(width, height)
+    else:
+        scale = min(HIGH_DETAIL_SHORT_SIDE / min(width, height), HIGH_DETAIL_LONG_SIDE / max(width, height))
+    if scale >= 1:
+        return None
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def prepare_image(data, detail, quality=85):
+    """Уменьшить изображение до размера, который реально использует OpenAI.
+
+    Возвращает JPEG байты. Без Pillow данные возвращаются без изменений.
+    """
+    if Image is None:
+        return data
+    with Image.open(io.BytesIO(data)) as image:
+        size = _target_size(image.width, image.height, detail)
+        if size is None and image.format == "JPEG":
+            return data
+        if size is not None:
+            image = image.resize(size, Image.LANCZOS)
+        output = io.BytesIO()
+        image.convert("RGB").save(output, format="JPEG", quality=quality, optimize=True)
+    prepared = output.getvalue()
+    # Пережатие не должно увеличивать объем
+    return prepared if len(prepared) < len(data) else data
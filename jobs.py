@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Очередь долгих задач (генерация изображений) с отдельным пулом потоков.
+
+Задачи выполняются в своих потоках, поэтому генерация изображения не
+занимает потоки, обрабатывающие текстовые сообщения. Очередь общая (FIFO)
+и ограничена, а у одного пользователя может быть не больше max_per_user
+задач в очереди и в работе одновременно. Пока задача ждет, ей сообщается
+ее место в очереди (on_position), чтобы обновлять статусное сообщение.
+
+AsyncJobQueue - то же для asyncio: задачи - корутины, а вместо потоков -
+workers задач asyncio. Обработчик только ставит задачу и сразу
+возвращается, поэтому очередь чата не ждет генерации.
+"""
+
+import time
+import asyncio
+import threading
+import contextvars
+from collections import Counter, deque
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+# Причины отказа в JobRejected
+QUEUE_FULL = "queue_full"
+USER_LIMIT = "user_limit"
+
+
+class JobRejected(Exception):
+    """Задача не поставлена в очередь: очередь заполнена или у пользователя слишком много задач"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class _Job:
+    __slots__ = ("user", "func", "args", "context", "on_position", "position", "notified", "started", "lock")
+
+    def __init__(self, user, func, args, on_position):
+        self.user = user
+        self.func = func
+        self.args = args
+        # Задача выполняется в контексте того, кто ее поставил (например, с ID запроса для логов)
+        self.context = contextvars.copy_context()
+        self.on_position = on_position
+        self.position = 0
+        self.notified = 0
+        self.started = False
+        # Уведомление о месте в очереди и запуск задачи не пересекаются
+        self.lock = threading.Lock()
+
+
+class JobQueue:
+    """Пул потоков с общей очередью и ограничением задач на пользователя"""
+
+    def __init__(self, workers=2, max_pending=20, max_per_user=1, name="job-worker"):
+        self.max_pending = max_pending
+        self.max_per_user = max_per_user
+        self._queue = deque()
+        self._active = Counter()
+        self._running = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, user, func, *args, on_position=None):
+        """Поставить func(*args) в очередь от имени user.
+
+        Возвращает место в очереди (0 - задача начнет выполняться сразу).
+        on_position(место) вызывается сразу, если задача встала в очередь, и затем
+        при каждом продвижении очереди, пока задача не начала выполняться.
+        Если поставить задачу нельзя, выбрасывает JobRejected.
+        """
+        job = _Job(user, func, args, on_position)
+        with self._cond:
+            if self._closed or len(self._queue) >= self.max_pending:
+                self.rejected += 1
+                raise JobRejected(QUEUE_FULL)
+            if self._active[user] >= self.max_per_user:
+                self.rejected += 1
+                raise JobRejected(USER_LIMIT)
+            self._active[user] += 1
+            idle = len(self._threads) - self._running - len(self._queue)
+            self._queue.append(job)
+            job.position = 0 if idle > 0 else len(self._queue)
+            self._cond.notify()
+        self._notify(job)
+        return job.position
+
+    def _notify(self, job):
+        if job.on_position is None:
+            return
+        with job.lock:
+            if job.started or not job.position or job.position == job.notified:
+                return
+            job.notified = job.position
+            try:
+                job.on_position(job.position)
+            except Exception as e:
+                log.error("job_position_update_failed", user=job.user, error=e)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                job = self._queue.popleft()
+                self._running += 1
+                for position, waiting in enumerate(self._queue, 1):
+                    waiting.position = position
+                waiting_jobs = list(self._queue)
+
+            with job.lock:
+                job.started = True
+            # Ожидающие задачи сдвинулись на одно место
+            for waiting in waiting_jobs:
+                self._notify(waiting)
+
+            failed = False
+            try:
+                job.context.run(job.func, *job.args)
+            except Exception:
+                failed = True
+                log.exception("job_failed", user=job.user)
+
+            with self._cond:
+                self.failed += failed
+                self.completed += 1
+                self._running -= 1
+                self._active[job.user] -= 1
+                if not self._active[job.user]:
+                    del self._active[job.user]
+
+    def active(self, user):
+        """Сколько задач пользователя в очереди и в работе"""
+        with self._cond:
+            return self._active.get(user, 0)
+
+    def stats(self):
+        """Текущее состояние очереди и счетчики"""
+        with self._cond:
+            return {
+                "workers": len(self._threads),
+                "pending": len(self._queue),
+                "running": self._running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "failed": self.failed,
+            }
+
+    def shutdown(self, timeout=None):
+        """Перестать принимать задачи и дождаться выполнения уже принятых (не дольше timeout)"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+
+class AsyncJobQueue:
+    """Пул задач asyncio с общей очередью и ограничением задач на пользователя (как JobQueue)"""
+
+    def __init__(self, workers=2, max_pending=20, max_per_user=1):
+        self.max_pending = max_pending
+        self.max_per_user = max_per_user
+        self._queue = deque()
+        self._active = Counter()
+        self._running = 0
+        self._closed = False
+        # Одно освобождение на каждую поставленную задачу и на каждого исполнителя при остановке
+        self._available = asyncio.Semaphore(0)
+        # Уведомления о месте в очереди (ссылки нужны, чтобы задачи не собрал сборщик мусора)
+        self._notifications = set()
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(workers)]
+
+    def submit(self, user, func, *args, on_position=None):
+        """Поставить await func(*args) в очередь от имени user.
+
+        Возвращает место в очереди (0 - задача начнет выполняться сразу). on_position -
+        корутина-функция, вызывается так же, как в JobQueue.submit. Если поставить
+        задачу нельзя, выбрасывает JobRejected.
+        """
+        # Исполнители забирают задачи только при следующем шаге цикла событий: задачи,
+        # которым хватает свободных исполнителей, места в очереди не занимают
+        idle = len(self._workers) - self._running - len(self._queue)
+        if self._closed or -idle >= self.max_pending:
+            self.rejected += 1
+            raise JobRejected(QUEUE_FULL)
+        if self._active[user] >= self.max_per_user:
+            self.rejected += 1
+            raise JobRejected(USER_LIMIT)
+        job = _Job(user, func, args, on_position)
+        job.lock = asyncio.Lock()
+        self._active[user] += 1
+        self._queue.append(job)
+        job.position = 0 if idle > 0 else 1 - idle
+        self._available.release()
+        self._schedule_notify(job)
+        return job.position
+
+    def _schedule_notify(self, job):
+        if job.on_position is None or not job.position:
+            return
+        # Уведомление - в контексте того, кто поставил задачу (ID запроса в логах)
+        task = asyncio.create_task(self._notify(job), context=job.context)
+        self._notifications.add(task)
+        task.add_done_callback(self._notifications.discard)
+
+    async def _notify(self, job):
+        async with job.lock:
+            if job.started or not job.position or job.position == job.notified:
+                return
+            job.notified = job.position
+            try:
+                await job.on_position(job.position)
+            except Exception as e:
+                log.error("job_position_update_failed", user=job.user, error=e)
+
+    async def _worker(self):
+        while True:
+            await self._available.acquire()
+            if not self._queue:
+                # Остановка: уже принятые задачи разобраны
+                return
+            job = self._queue.popleft()
+            self._running += 1
+            # Ожидающие задачи сдвинулись на одно место
+            for position, waiting in enumerate(self._queue, 1):
+                waiting.position = position
+                self._schedule_notify(waiting)
+
+            async with job.lock:
+                job.started = True
+
+            failed = False
+            try:
+                # Задача выполняется в контексте того, кто ее поставил
+                await asyncio.create_task(job.func(*job.args), context=job.context)
+            except Exception:
+                failed = True
+                log.exception("job_failed", user=job.user)
+
+            self.failed += failed
+            self.completed += 1
+            self._running -= 1
+            self._active[job.user] -= 1
+            if not self._active[job.user]:
+                del self._active[job.user]
+
+    def active(self, user):
+        """Сколько задач пользователя в очереди и в работе"""
+        return self._active.get(user, 0)
+
+    def stats(self):
+        """Текущее состояние очереди и счетчики"""
+        return {
+            "workers": len(self._workers),
+            "pending": len(self._queue),
+            "running": self._running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+        }
+
+    async def shutdown(self, timeout=None):
+        """Перестать принимать задачи и дождаться выполнения уже принятых (не дольше timeout)"""
+        self._closed = True
+        for _ in self._workers:
+            self._available.release()
+        await asyncio.wait(self._workers, timeout=timeout)
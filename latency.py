@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Скользящая статистика задержек моделей по реальным запросам.
+
+Для каждой модели хранятся экспоненциально сглаженные (EWMA) среднее и
+отклонение времени до первого токена (TTFT) и полного ответа: новые
+запросы весят больше старых, поэтому оценка следует за текущей нагрузкой
+OpenAI. Статистика периодически сохраняется в JSON и переживает перезапуск.
+"""
+
+import os
+import json
+import time
+import threading
+from pathlib import Path
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+class _Estimate:
+    """EWMA среднего и среднего абсолютного отклонения (как оценка RTT в TCP)"""
+
+    __slots__ = ("mean", "dev")
+
+    def __init__(self, mean=None, dev=0.0):
+        self.mean = mean
+        self.dev = dev
+
+    def update(self, value, alpha):
+        if self.mean is None:
+            self.mean = value
+            self.dev = value / 2
+        else:
+            self.dev += alpha * (abs(value - self.mean) - self.dev)
+            self.mean += alpha * (value - self.mean)
+
+
+class ModelLatency:
+    """Оценки задержки одной модели"""
+
+    __slots__ = ("ttft", "total", "samples", "updated_at")
+
+    def __init__(self):
+        self.ttft = _Estimate()
+        self.total = _Estimate()
+        self.samples = 0
+        self.updated_at = 0.0
+
+    def to_dict(self):
+        return {
+            "ttft": self.ttft.mean, "ttft_dev": self.ttft.dev,
+            "total": self.total.mean, "total_dev": self.total.dev,
+            "samples": self.samples, "updated_at": self.updated_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.ttft = _Estimate(data.get("ttft"), data.get("ttft_dev", 0.0))
+        stats.total = _Estimate(data.get("total"), data.get("total_dev", 0.0))
+        stats.samples = data.get("samples", 0)
+        stats.updated_at = data.get("updated_at", 0.0)
+        return stats
+
+
+class LatencyTracker:
+    """Статистика задержек всех моделей с сохранением в файл"""
+
+    def __init__(self, path, alpha=0.1, save_interval=60.0):
+        self.path = Path(path)
+        self.alpha = alpha
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._models = {}
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self._models = {model: ModelLatency.from_dict(stats) for model, stats in data.items()}
+        except (OSError, ValueError) as e:
+            log.error("latency_stats_load_failed", path=self.path, error=e)
+
+    def record(self, model, ttft, total):
+        """Учесть один запрос к модели (секунды до первого токена и до конца ответа)"""
+        with self._lock:
+            stats = self._models.get(model)
+            if stats is None:
+                stats = self._models[model] = ModelLatency()
+            stats.ttft.update(ttft, self.alpha)
+            stats.total.update(total, self.alpha)
+            stats.samples += 1
+            stats.updated_at = time.time()
+            self._dirty = True
+            save_now = time.monotonic() - self._saved_at >= self.save_interval
+        if save_now:
+            self.save()
+
+    def get(self, model):
+        """Словарь с оценками модели или None, если запросов к ней еще не было"""
+        with self._lock:
+            stats = self._models.get(model)
+            return stats.to_dict() if stats is not None and stats.samples else None
+
+    def snapshot(self):
+        """Оценки всех моделей {модель: словарь}"""
+        with self._lock:
+            return {model: stats.to_dict() for model, stats in self._models.items() if stats.samples}
+
+    def save(self):
+        """Записать статистику на диск (через временный файл)"""
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {model: stats.to_dict() for model, stats in self._models.items()}
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.error("latency_stats_save_failed", path=self.path, error=e)
+            with self._lock:
+                self._dirty = True
@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Нагрузочный тест бота без доступа к сети.
+
+Поднимает локальные заглушки Telegram Bot API, OpenAI (chat.completions и
+images) и Google Custom Search с настраиваемыми задержками и долей ошибок,
+импортирует bot.py, направленный на эти заглушки, и прогоняет настоящие
+обработчики: N синтетических пользователей одновременно отправляют текст,
+поисковые запросы, фото и /image. В конце печатаются пропускная способность,
+перцентили задержек по обработчикам и по этапам (метрики из metrics.py).
+
+Пример:
+    python loadtest.py --users 50 --messages 10 --openai-ttft 0.5 --openai-error-rate 0.01
+
+С --openai-rpm заглушка OpenAI ограничивает число запросов в минуту, отдает
+заголовки x-ratelimit-* и отвечает 429 сверх лимита - так проверяется
+очередь openai_scheduler.
+"""
+
+import io
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import tempfile
+import threading
+from collections import Counter, defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from telebot import types
+
+TOKEN = "123456:LOADTEST"
+
+# Признак, по которому заглушка OpenAI отвечает вызовом google_search
+SEARCH_MARKER = "Найди"
+TOPICS = [
+    "погода в Бангкоке", "курс биткоина", "новости OpenAI", "история Рима", "рецепт борща",
+    "квантовые компьютеры", "чемпионат мира", "фотосинтез", "язык Python", "черные дыры",
+    "марафон в Берлине", "цены на нефть", "вулканы Исландии", "искусственный интеллект", "кофе",
+]
+WORDS = ("Это синтетический ответ заглушки OpenAI для нагрузочного теста, "
+         "который приходит по частям как настоящий поток токенов.").split()
+
+KINDS = ("text", "search", "photo", "image")
+
+
+def sample_latency(mean, jitter):
+    """Задержка с логнормальным распределением и заданным средним (jitter - sigma)"""
+    if mean <= 0:
+        return 0.0
+    if jitter <= 0:
+        return mean
+    return random.lognormvariate(math.log(mean) - jitter ** 2 / 2, jitter)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def make_jpeg():
+    """Тестовое фото: настоящий JPEG, если установлен Pillow"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return b"\xff\xd8\xff\xe0" + b"\0" * 1024 + b"\xff\xd9"
+    image = Image.new("RGB", (1280, 960), (90, 140, 200))
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=85)
+    return output.getvalue()
+
+
+class MockServer(ThreadingHTTPServer):
+    """Заглушка внешнего API: задержка и доля ошибок задаются параметрами"""
+
+    daemon_threads = True
+
+    def __init__(self, handler_class, latency, error_rate, jitter, **options):
+        super().__init__(("127.0.0.1", 0), handler_class)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.jitter = jitter
+        self.options = options
+        self.calls = Counter()
+        self.errors = 0
+        self.limited = 0
+        self._requests = deque()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def next_id(self):
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def should_fail(self):
+        if random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            return True
+        return False
+
+    def rate_limit(self, rpm):
+        """(заголовки x-ratelimit-*, None) или (None, секунд до освобождения), если лимит исчерпан"""
+        now = time.monotonic()
+        with self._lock:
+            while self._requests and now - self._requests[0] >= 60:
+                self._requests.popleft()
+            if len(self._requests) >= rpm:
+                self.limited += 1
+                return None, 60 - (now - self._requests[0])
+            self._requests.append(now)
+            reset = 60 - (now - self._requests[0])
+            return {
+                "x-ratelimit-limit-requests": str(rpm),
+                "x-ratelimit-remaining-requests": str(rpm - len(self._requests)),
+                "x-ratelimit-reset-requests": f"{reset:.3f}s",
+            }, None
+
+    def delay(self, mean=None):
+        time.sleep(sample_latency(self.latency if mean is None else mean, self.jitter))
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def send_bytes(self, status, body, content_type="application/json", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, obj, headers=None):
+        self.send_bytes(status, json.dumps(obj, ensure_ascii=False).encode("utf-8"), headers=headers)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TelegramHandler(MockHandler):
+    """Заглушка Bot API: /bot<token>/<method> и /file/bot<token>/<path>"""
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        body = self.read_body()
+        if body and self.headers.get("Content-Type", "").startswith("application/x-www-form-urlencoded"):
+            params.update({key: values[-1] for key, values in parse_qs(body.decode("utf-8")).items()})
+
+        if url.path.startswith("/file/"):
+            self.server.count("download")
+            self.server.delay()
+            self.send_bytes(200, self.server.options["photo"], "image/jpeg")
+            return
+
+        method = url.path.rsplit("/", 1)[-1]
+        self.server.count(method)
+        self.server.delay()
+        if self.server.should_fail():
+            self.send_json(500, {"ok": False, "error_code": 500, "description": "Internal Server Error: mock"})
+            return
+        self.send_json(200, {"ok": True, "result": self.result(method, params)})
+
+    def result(self, method, params):
+        chat_id = int(params.get("chat_id", 0) or 0)
+        if method in ("sendMessage", "sendPhoto", "editMessageText", "editMessageReplyMarkup"):
+            text = params.get("text") or params.get("caption") or ""
+            self.server.options["replies"][chat_id] = text
+            return {
+                "message_id": int(params.get("message_id", 0) or 0) or self.server.next_id(),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": text,
+            }
+        if method == "getFile":
+            return {"file_id": params.get("file_id"), "file_unique_id": params.get("file_id"),
+                    "file_size": len(self.server.options["photo"]), "file_path": "photos/loadtest.jpg"}
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "loadtest", "username": "loadtest_bot"}
+        return True
+
+
+class OpenAIHandler(MockHandler):
+    """Заглушка OpenAI: /v1/chat/completions (в том числе stream) и /v1/images/generations"""
+
+    def do_POST(self):
+        request = json.loads(self.read_body() or b"{}")
+        path = urlsplit(self.path).path
+        if path.endswith("/images/generations"):
+            self.images(request)
+        elif path.endswith("/chat/completions"):
+            self.chat(request)
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def fail(self):
+        self.send_json(500, {"error": {"message": "mock server error", "type": "server_error"}})
+
+    def images(self, request):
+        self.server.count("images")
+        self.server.delay(self.server.options["image_latency"])
+        if self.server.should_fail():
+            self.fail()
+            return
+        self.send_json(200, {"created": int(time.time()), "data": [{
+            "url": f"https://example.com/loadtest/{self.server.next_id()}.png",
+            "revised_prompt": f"A detailed illustration of {request.get('prompt', '')}",
+        }]})
+
+    def wants_search(self, request):
+        messages = request.get("messages") or [{}]
+        last = messages[-1]
+        return ("tools" in request and last.get("role") == "user"
+                and isinstance(last.get("content"), str) and SEARCH_MARKER in last["content"])
+
+    def chat(self, request):
+        self.server.count("chat.stream" if request.get("stream") else "chat")
+        options = self.server.options
+        headers = {}
+        if options["rpm"]:
+            headers, retry_after = self.server.rate_limit(options["rpm"])
+            if headers is None:
+                self.send_json(429, {"error": {"message": "mock rate limit", "type": "requests",
+                                               "code": "rate_limit_exceeded"}},
+                               headers={"retry-after": f"{retry_after:.1f}"})
+                return
+        # Время до первого токена
+        self.server.delay()
+        if self.server.should_fail():
+            self.fail()
+            return
+
+        model = request.get("model", "gpt-4o-mini")
+        tool_call = None
+        if self.wants_search(request):
+            query = request["messages"][-1]["content"].replace(SEARCH_MARKER, "").strip()
+            tool_call = {"index": 0, "id": f"call_{self.server.next_id()}", "type": "function",
+                         "function": {"name": "google_search", "arguments": json.dumps({"query": query})}}
+            words = []
+        else:
+            words = [random.choice(WORDS) for _ in range(options["completion_tokens"])]
+        usage = {"prompt_tokens": sum(len(json.dumps(m)) // 4 for m in request.get("messages", [])),
+                 "completion_tokens": len(words) or 20}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        finish_reason = "tool_calls" if tool_call else "stop"
+
+        if not request.get("stream"):
+            time.sleep(options["token_interval"] * len(words))
+            message = {"role": "assistant", "content": " ".join(words) or None}
+            if tool_call:
+                message["tool_calls"] = [{key: value for key, value in tool_call.items() if key != "index"}]
+            self.send_json(200, {
+                "id": "chatcmpl-loadtest", "object": "chat.completion", "created": int(time.time()),
+                "model": model, "usage": usage,
+                "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            }, headers=headers)
+            return
+
+        self.send_response(200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def chunk(delta, finish=None):
+            self.write_event({"id": "chatcmpl-loadtest", "object": "chat.completion.chunk",
+                              "created": int(time.time()), "model": model,
+                              "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]})
+
+        chunk({"role": "assistant", "content": ""})
+        if tool_call:
+            chunk({"tool_calls": [tool_call]})
+        for index, word in enumerate(words):
+            if index:
+                time.sleep(options["token_interval"])
+            chunk({"content": word + " "})
+        chunk({}, finish_reason)
+        if (request.get("stream_options") or {}).get("include_usage"):
+            self.write_event({"id": "chatcmpl-loadtest", "object": "chat.completion.chunk",
+                              "created": int(time.time()), "model": model, "choices": [], "usage": usage})
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    def write_event(self, obj):
+        self.write_chunk(f"data: {json.dumps(obj, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+class GoogleHandler(MockHandler):
+    """Заглушка Google Custom Search: /customsearch/v1"""
+
+    def do_GET(self):
+        self.server.count("search")
+        self.server.delay()
+        if self.server.should_fail():
+            self.send_json(500, {"error": {"code": 500, "message": "mock backend error"}})
+            return
+        query = parse_qs(urlsplit(self.path).query).get("q", [""])[0]
+        self.send_json(200, {"items": [
+            {"title": f"{query} - результат {i}", "link": f"https://example.com/{i}",
+             "snippet": f"Краткое описание результата {i} по запросу {query}."}
+            for i in range(1, 4)
+        ]})
+
+
+class LoadTest:
+    """Синтетические пользователи, которые по очереди отправляют сообщения в свои чаты"""
+
+    def __init__(self, bot_module, process_updates, args, replies):
+        self.bot = bot_module
+        self.process_updates = process_updates
+        self.args = args
+        self.replies = replies
+        self.weights = [args.text, args.search, args.photo, args.image]
+        self.error_texts = {bot_module.MESSAGE_ERROR_TEXT, bot_module.PHOTO_ERROR_TEXT,
+                            bot_module.IMAGE_ERROR_TEXT}
+        self.rejected_texts = {bot_module.IMAGE_QUEUE_FULL_TEXT, bot_module.IMAGE_USER_LIMIT_TEXT}
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.rejected = Counter()
+        self._lock = threading.Lock()
+        self._update_id = 0
+
+    def next_update_id(self):
+        with self._lock:
+            self._update_id += 1
+            return self._update_id
+
+    def make_update(self, kind, chat_id, user_id):
+        message = {
+            "message_id": self.next_update_id(),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"},
+            "chat": {"id": chat_id, "type": "private"},
+            "date": int(time.time()),
+        }
+        topic = random.choice(TOPICS)
+        if kind == "text":
+            message["text"] = f"Расскажи про {topic}"
+        elif kind == "search":
+            message["text"] = f"{SEARCH_MARKER} {topic}"
+        elif kind == "image":
+            message["text"] = f"/image {topic}"
+        else:
+            message["photo"] = [
+                {"file_id": f"photo_{size}", "file_unique_id": f"photo_{size}", "width": size,
+                 "height": size * 3 // 4}
+                for size in (90, 320, 800, 1280)
+            ]
+            message["caption"] = "Что на этом фото?"
+        return types.Update.de_json({"update_id": self.next_update_id(), "message": message})
+
+    def run_user(self, index):
+        chat_id = user_id = 1_000_000 + index
+        for _ in range(self.args.messages):
+            kind = random.choices(KINDS, self.weights)[0]
+            update = self.make_update(kind, chat_id, user_id)
+            done = threading.Event()
+            failed = []
+
+            def task():
+                try:
+                    self.process_updates([update])
+                except Exception as e:
+                    failed.append(e)
+                finally:
+                    done.set()
+
+            self.replies.pop(chat_id, None)
+            started = time.perf_counter()
+            if not self.bot.dispatcher.submit(chat_id, task):
+                with self._lock:
+                    self.rejected[kind] += 1
+                continue
+            done.wait()
+            if kind == "image":
+                # Изображение генерируется в очереди image_jobs уже после выхода из обработчика
+                self.wait_image_reply(chat_id, user_id)
+            elapsed = time.perf_counter() - started
+
+            with self._lock:
+                if self.replies.get(chat_id) in self.rejected_texts:
+                    self.rejected[kind] += 1
+                    continue
+                self.latencies[kind].append(elapsed)
+                if failed or self.replies.get(chat_id) in self.error_texts:
+                    self.errors[kind] += 1
+            if self.args.think_time:
+                time.sleep(sample_latency(self.args.think_time, 0.5))
+
+    def wait_image_reply(self, chat_id, user_id, timeout=300):
+        """Дождаться итогового сообщения генерации (изображение, ошибка или отказ) и завершения задачи"""
+        pending_texts = {self.bot.IMAGE_PROGRESS_TEXT}
+        queued_prefix = self.bot.IMAGE_QUEUED_TEXT.split("{")[0]
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            reply = self.replies.get(chat_id)
+            if (reply is not None and reply not in pending_texts and not reply.startswith(queued_prefix)
+                    and not self.bot.image_jobs.active(user_id)):
+                return
+            time.sleep(0.01)
+
+    def run(self):
+        threads = [threading.Thread(target=self.run_user, args=(index,), daemon=True)
+                   for index in range(self.args.users)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+
+def print_report(test, duration, servers, bot, metrics):
+    total = sum(len(values) for values in test.latencies.values())
+    print()
+    print(f"Пользователей: {test.args.users}, сообщений на пользователя: {test.args.messages}")
+    print(f"Время теста: {duration:.1f} с, обработано: {total}, "
+          f"пропускная способность: {total / duration:.1f} сообщ/с")
+    print()
+    print(f"{'Обработчик':<10} {'Запросов':>8} {'Ошибок':>7} {'Отклон.':>7} "
+          f"{'p50':>7} {'p95':>7} {'p99':>7} {'max':>7}")
+    for kind in KINDS:
+        values = test.latencies.get(kind)
+        if not values:
+            continue
+        print(f"{kind:<10} {len(values):>8} {test.errors[kind]:>7} {test.rejected[kind]:>7} "
+              f"{percentile(values, 0.5):>7.2f} {percentile(values, 0.95):>7.2f} "
+              f"{percentile(values, 0.99):>7.2f} {max(values):>7.2f}")
+
+    print()
+    print("Этапы обработки (секунды):")
+    print(f"{'Обработчик':<10} {'Этап':<24} {'n':>6} {'p50':>7} {'p95':>7} {'p99':>7}")
+    for (handler, stage, model), (count, values) in sorted(metrics.stage_seconds.quantiles().items()):
+        print(f"{handler:<10} {stage:<24} {count:>6} {values[0.5]:>7.3f} {values[0.95]:>7.3f} "
+              f"{values[0.99]:>7.3f}")
+
+    print()
+    for name, server in servers.items():
+        calls = ", ".join(f"{method}={count}" for method, count in sorted(server.calls.items()))
+        limited = f", отказов по лимиту: {server.limited}" if server.limited else ""
+        print(f"{name}: {calls or '-'}; ошибок: {server.errors}{limited}")
+    openai_stats = bot.openai_scheduler.stats()
+    print(f"Очередь OpenAI: задержано по лимиту {openai_stats['delayed']}, повторов {openai_stats['retries']}, "
+          f"ошибок {openai_stats['failed']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест обработчиков bot.py на локальных заглушках")
+    parser.add_argument("--users", type=int, default=20, help="одновременных пользователей")
+    parser.add_argument("--messages", type=int, default=5, help="сообщений от каждого пользователя")
+    parser.add_argument("--think-time", type=float, default=0.0, help="средняя пауза пользователя между сообщениями")
+    parser.add_argument("--workers", type=int, help="потоков обработки (CHAT_WORKERS)")
+    parser.add_argument("--no-stream", action="store_true", help="отключить потоковые ответы")
+    parser.add_argument("--seed", type=int, help="seed генератора случайных чисел")
+
+    mix = parser.add_argument_group("доли типов сообщений")
+    mix.add_argument("--text", type=float, default=0.6)
+    mix.add_argument("--search", type=float, default=0.2)
+    mix.add_argument("--photo", type=float, default=0.15)
+    mix.add_argument("--image", type=float, default=0.05)
+
+    mocks = parser.add_argument_group("заглушки (задержки в секундах)")
+    mocks.add_argument("--jitter", type=float, default=0.3, help="sigma логнормального разброса задержек")
+    mocks.add_argument("--telegram-latency", type=float, default=0.03)
+    mocks.add_argument("--telegram-error-rate", type=float, default=0.0)
+    mocks.add_argument("--openai-ttft", type=float, default=0.4, help="время до первого токена")
+    mocks.add_argument("--openai-token-interval", type=float, default=0.02)
+    mocks.add_argument("--openai-tokens", type=int, default=60, help="токенов в ответе")
+    mocks.add_argument("--openai-error-rate", type=float, default=0.0)
+    mocks.add_argument("--openai-rpm", type=int, default=0, help="лимит запросов в минуту (0 - без лимита)")
+    mocks.add_argument("--image-latency", type=float, default=3.0)
+    mocks.add_argument("--google-latency", type=float, default=0.3)
+    mocks.add_argument("--google-error-rate", type=float, default=0.0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    replies = {}
+    servers = {
+        "telegram": MockServer(TelegramHandler, args.telegram_latency, args.telegram_error_rate, args.jitter,
+                               photo=make_jpeg(), replies=replies),
+        "openai": MockServer(OpenAIHandler, args.openai_ttft, args.openai_error_rate, args.jitter,
+                             token_interval=args.openai_token_interval, completion_tokens=args.openai_tokens,
+                             image_latency=args.image_latency, rpm=args.openai_rpm),
+        "google": MockServer(GoogleHandler, args.google_latency, args.google_error_rate, args.jitter),
+    }
+
+    history_dir = tempfile.TemporaryDirectory(prefix="botgpt-loadtest-")
+    # Переменные окружения задаются до импорта bot.py: он читает настройки при импорте
+    # (load_dotenv не перезаписывает уже заданные переменные)
+    os.environ.update({
+        "TG_BOT_TOKEN": TOKEN,
+        "TELEGRAM_API_URL": servers["telegram"].url + "/bot{0}/{1}",
+        "TELEGRAM_FILE_URL": servers["telegram"].url + "/file/bot{0}/{1}",
+        "OPENAI_API_KEY": "sk-loadtest",
+        "OPENAI_BASE_URL": servers["openai"].url + "/v1",
+        "GOOGLE_API_KEY": "loadtest",
+        "GOOGLE_CX": "loadtest",
+        "GOOGLE_SEARCH_URL": servers["google"].url + "/customsearch/v1",
+        "ALLOWED_USER_IDS": "",
+        "HISTORY_DIR": history_dir.name,
+        "METRICS_PORT": "0",
+        # Тест измеряет пропускную способность, а не защиту от флуда
+        "ADMISSION_USER_RATE": "0",
+        "ADMISSION_CHAT_RATE": "0",
+        # Записи о каждом сообщении не нужны и искажают замер
+        "LOG_LEVEL": "WARNING",
+    })
+    if args.workers:
+        os.environ["CHAT_WORKERS"] = str(args.workers)
+    if args.no_stream:
+        os.environ["STREAM_RESPONSES"] = "false"
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bot
+    import metrics
+
+    # Обновления отдаются обработчикам напрямую, а очереди по чатам - тот же диспетчер, что в боте
+    process_updates = bot.bot.process_new_updates
+    bot.start_dispatcher()
+
+    print(f"Заглушки: telegram {servers['telegram'].url}, openai {servers['openai'].url}, "
+          f"google {servers['google'].url}")
+    print(f"Потоков обработки: {bot.CHAT_WORKERS}, потоковые ответы: {bot.STREAM_RESPONSES}")
+
+    test = LoadTest(bot, process_updates, args, replies)
+    try:
+        duration = test.run()
+    finally:
+        bot.dispatcher.shutdown(timeout=30)
+        bot.image_jobs.shutdown(timeout=30)
+        bot.storage.close()
+        history_dir.cleanup()
+    print_report(test, duration, servers, bot, metrics)
+
+
+if __name__ == "__main__":
+    main()
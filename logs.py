@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Структурированные логи: уровни, ID запроса, выборка и фоновая запись.
+
+Запись в лог - событие с полями:
+    log = get_logger(__name__)
+    log.info("model_routed", chat_id=chat_id, model=model)
+
+Пока уровень события отключен, вызов стоит одну проверку уровня: поля не
+форматируются и никуда не копируются. Форматирование и запись в stdout
+выполняет отдельный поток (QueueHandler/QueueListener), поэтому обработчик
+не ждет journald. Если очередь переполнена, записи отбрасываются и
+считаются, а не блокируют обработку.
+
+Частые события можно записывать выборочно (setup(sample={"событие": доля})),
+длинные значения полей обрезаются до field_limit символов. ID запроса
+задается через request_context() и попадает во все записи, сделанные в
+этом потоке или задаче asyncio.
+"""
+
+import sys
+import json
+import time
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+import contextvars
+from contextlib import contextmanager
+
+# ID обрабатываемого запроса (обновления Telegram); "-" вне обработки
+request_id = contextvars.ContextVar("request_id", default="-")
+
+_sample_rates = {}
+_field_limit = 500
+_listener = None
+_handler = None
+
+
+@contextmanager
+def request_context(value):
+    """Все записи внутри блока помечаются ID запроса value"""
+    token = request_id.set(str(value))
+    try:
+        yield
+    finally:
+        request_id.reset(token)
+
+
+def _truncate(value, limit):
+    text = value if isinstance(value, str) else repr(value)
+    if len(text) > limit:
+        return f"{text[:limit]}…(+{len(text) - limit})"
+    return text
+
+
+class StructuredLogger:
+    """Обертка над logging.Logger: событие и поля вместо готовой строки"""
+
+    def __init__(self, logger):
+        self._logger = logger
+
+    def _log(self, level, event, fields, exc_info=False):
+        if not self._logger.isEnabledFor(level):
+            return
+        rate = _sample_rates.get(event)
+        if rate is not None:
+            if random.random() >= rate:
+                return
+            fields["sampled"] = rate
+        self._logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event, **fields):
+        """error с трассировкой текущего исключения"""
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+    def is_enabled(self, level):
+        return self._logger.isEnabledFor(level)
+
+
+def get_logger(name):
+    return StructuredLogger(logging.getLogger(name))
+
+
+class _RequestIdFilter(logging.Filter):
+    """Запоминает ID запроса в записи: фильтр выполняется в потоке, который пишет в лог"""
+
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    """2026-01-01 12:00:00 INFO bot [123] событие key=value ..."""
+
+    def format(self, record):
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created))
+        parts = [timestamp, record.levelname, record.name, f"[{getattr(record, 'request_id', '-')}]",
+                 record.getMessage()]
+        for key, value in getattr(record, "fields", {}).items():
+            text = _truncate(value, _field_limit)
+            if not text or any(char in text for char in ' ="\n'):
+                text = json.dumps(text, ensure_ascii=False)
+            parts.append(f"{key}={text}")
+        line = " ".join(parts)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-запись на строку (для сборщиков логов)"""
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "event": record.getMessage(),
+        }
+        for key, value in getattr(record, "fields", {}).items():
+            if isinstance(value, (int, float, bool)) or value is None:
+                entry[key] = value
+            else:
+                entry[key] = _truncate(value, _field_limit)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который при переполненной очереди отбрасывает запись, а не ждет"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Форматирование - в потоке QueueListener; запись передается как есть
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def parse_sample_rates(value):
+    """"событие=доля,событие=доля" -> {событие: доля}"""
+    rates = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        event, rate = item.split("=", 1)
+        try:
+            rates[event.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            pass
+    return rates
+
+
+def setup(level="INFO", fmt="text", sample=None, field_limit=500, queue_size=10000, stream=None):
+    """Настроить корневой логгер: запись в stream (stdout) через очередь и фоновый поток"""
+    global _listener, _handler, _field_limit
+    _sample_rates.clear()
+    _sample_rates.update(sample or {})
+    _field_limit = field_limit
+
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    handler = _DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    handler.addFilter(_RequestIdFilter())
+
+    root = logging.getLogger()
+    if _listener is not None:
+        _listener.stop()
+        root.removeHandler(_handler)
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+
+    _handler = handler
+    _listener = logging.handlers.QueueListener(handler.queue, output)
+    _listener.start()
+
+
+def dropped():
+    """Сколько записей отброшено из-за переполненной очереди"""
+    return _handler.dropped if _handler is not None else 0
+
+
+@atexit.register
+def shutdown():
+    """Дописать оставшиеся в очереди записи"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
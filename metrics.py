@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Метрики бота в формате Prometheus.
+
+Обработчик сообщения размечается на этапы (чтение истории, запрос к модели,
+вызовы функций, повторный запрос, сохранение, отправка ответа); длительность
+каждого этапа попадает в гистограмму с метками handler/stage/model.
+Кроме бакетов для Prometheus гистограммы хранят окно последних значений,
+по которому считаются p50/p95/p99 для /stats.
+
+Эндпоинт /metrics поднимается отдельным HTTP сервером (start_http_server).
+"""
+
+import math
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы бакетов задержек (секунды): от быстрых операций с диском до длинных ответов GPT-5
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def _key(self, labels):
+        return tuple((name, str(labels.get(name, ""))) for name in self.labelnames)
+
+    def collect(self):
+        """Строки метрики в текстовом формате Prometheus"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                lines.extend(self._collect_series(key, series))
+        return lines
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик"""
+
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._series.get(self._key(labels), 0)
+
+    def _collect_series(self, key, value):
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}"]
+
+
+class Gauge(_Metric):
+    """Текущее значение"""
+
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = value
+
+    def _collect_series(self, key, value):
+        return [f"{self.name}{_format_labels(key)} {_format_value(value)}"]
+
+
+class _HistogramSeries:
+    __slots__ = ("counts", "sum", "count", "recent")
+
+    def __init__(self, buckets, window):
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=window)
+
+
+class Histogram(_Metric):
+    """Гистограмма с бакетами Prometheus и окном последних значений для перцентилей"""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, window=1024):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.window = window
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _HistogramSeries(self.buckets, self.window)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series.counts[index] += 1
+                    break
+            series.sum += value
+            series.count += 1
+            series.recent.append(value)
+
+    def quantiles(self, quantiles=QUANTILES):
+        """{значения меток: (число наблюдений, {квантиль: значение})} по окну последних значений"""
+        with self._lock:
+            items = [(key, series.count, sorted(series.recent)) for key, series in self._series.items()]
+        result = {}
+        for key, count, values in items:
+            if values:
+                result[tuple(value for _, value in key)] = (
+                    count, {q: values[min(len(values) - 1, int(q * len(values)))] for q in quantiles})
+        return result
+
+    def _collect_series(self, key, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, series.counts):
+            cumulative += count
+            labels = key + (("le", _format_value(float(bound)) if bound != math.inf else "+Inf"),)
+            lines.append(f"{self.name}_bucket{_format_labels(labels)} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(series.sum)}")
+        lines.append(f"{self.name}_count{_format_labels(key)} {series.count}")
+        return lines
+
+
+class Registry:
+    """Набор метрик, которые отдаются на /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+stage_seconds = REGISTRY.register(Histogram(
+    "bot_stage_seconds", "Duration of handler stages", ("handler", "stage", "model")))
+handler_seconds = REGISTRY.register(Histogram(
+    "bot_handler_seconds", "Total handler duration", ("handler", "model")))
+tool_seconds = REGISTRY.register(Histogram(
+    "bot_tool_seconds", "Duration of tool calls", ("function",)))
+tool_calls_total = REGISTRY.register(Counter(
+    "bot_tool_calls_total", "Tool calls by function and outcome", ("function", "status")))
+errors_total = REGISTRY.register(Counter(
+    "bot_errors_total", "Handler errors", ("handler",)))
+markdown_fallbacks_total = REGISTRY.register(Counter(
+    "bot_markdown_fallbacks_total", "Replies resent without Markdown after a parse error", ("operation",)))
+openai_tokens_total = REGISTRY.register(Counter(
+    "bot_openai_tokens_total", "OpenAI token usage", ("model", "type")))
+openai_queue_depth = REGISTRY.register(Gauge(
+    "bot_openai_queue_depth", "Requests waiting for OpenAI rate limits"))
+openai_retries_total = REGISTRY.register(Counter(
+    "bot_openai_retries_total", "Retried OpenAI requests by model and error", ("model", "reason")))
+admission_total = REGISTRY.register(Counter(
+    "bot_admission_total", "Updates admitted or shed before processing by kind and result", ("kind", "result")))
+shard_up = REGISTRY.register(Gauge(
+    "bot_shard_up", "Whether the shard worker process is running", ("shard",)))
+shard_queue_depth = REGISTRY.register(Gauge(
+    "bot_shard_queue_depth", "Updates waiting in the shard queue", ("shard",)))
+shard_restarts_total = REGISTRY.register(Counter(
+    "bot_shard_restarts_total", "Shard worker restarts", ("shard",)))
+photo_cache_total = REGISTRY.register(Counter(
+    "bot_photo_cache_total", "Photo cache lookups by result", ("result",)))
+search_prefetch_total = REGISTRY.register(Counter(
+    "bot_search_prefetch_total", "Speculative searches by intent category and outcome", ("category", "result")))
+router_decisions_total = REGISTRY.register(Counter(
+    "bot_router_decisions_total", "Models chosen by the automatic router", ("model",)))
+model_ttft_seconds = REGISTRY.register(Gauge(
+    "bot_model_ttft_seconds", "Smoothed time to first token by model", ("model",)))
+model_latency_seconds = REGISTRY.register(Gauge(
+    "bot_model_latency_seconds", "Smoothed total completion time by model", ("model",)))
+
+
+class Trace:
+    """Замер этапов одного обработчика: trace.span("stage") для этапа, finish() в конце"""
+
+    def __init__(self, handler, model=""):
+        self.handler = handler
+        self.model = model
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def span(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage_seconds.observe(time.perf_counter() - started,
+                                  handler=self.handler, stage=stage, model=self.model)
+
+    def error(self):
+        errors_total.inc(handler=self.handler)
+
+    def finish(self):
+        handler_seconds.observe(time.perf_counter() - self.started, handler=self.handler, model=self.model)
+
+
+def record_usage(model, usage):
+    """Учесть токены из response.usage (None - ничего не делать)"""
+    if usage is None:
+        return
+    openai_tokens_total.inc(usage.prompt_tokens or 0, model=model, type="prompt")
+    openai_tokens_total.inc(usage.completion_tokens or 0, model=model, type="completion")
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(host, port):
+    """Запустить HTTP сервер с /metrics в фоновом потоке"""
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Планировщик запросов к OpenAI с учетом лимитов.
+
+OpenAI возвращает в каждом ответе остаток лимитов модели:
+x-ratelimit-remaining-requests / -tokens и время до их восстановления
+(x-ratelimit-reset-*). Планировщик запоминает их по модели, уменьшает
+остаток на каждый отправленный запрос и, когда лимит почти исчерпан,
+задерживает запрос до восстановления. Ошибки 429, 5xx и сетевые ошибки
+повторяются с экспоненциальной задержкой со случайным разбросом, поэтому
+при всплеске нагрузки пользователь получает ответ чуть позже, а не ошибку.
+
+Запросы выполняются через with_raw_response, чтобы были доступны заголовки:
+    response = scheduler.call("gpt-4o-mini", tokens, client.chat.completions.with_raw_response.create, **params)
+"""
+
+import re
+import time
+import random
+import asyncio
+import threading
+
+import openai
+
+import metrics
+from logs import get_logger
+
+log = get_logger(__name__)
+
+# Длительность в заголовках reset: "1s", "6m0s", "20ms", "1h2m3.5s"
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+# Если время восстановления неизвестно, проверяем лимит снова через столько секунд
+DEFAULT_RESET = 1.0
+# Ожидающие запросы перепроверяют лимит не реже: заголовки других ответов могут освободить его раньше
+WAIT_STEP = 1.0
+
+
+def parse_duration(value):
+    """Секунды из значения заголовка x-ratelimit-reset-* (None, если не разобрать)"""
+    if not value:
+        return None
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def _header_int(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class _Limit:
+    """Остаток одного лимита (запросов или токенов) модели"""
+
+    __slots__ = ("limit", "remaining", "reset_at")
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = 0.0
+
+    def update(self, limit, remaining, reset, now):
+        if limit is not None:
+            self.limit = limit
+        if remaining is not None:
+            self.remaining = remaining
+            self.reset_at = now + (reset if reset is not None else DEFAULT_RESET)
+
+    def wait_time(self, amount, headroom, now):
+        """Сколько ждать, чтобы потратить amount (0 - можно сейчас)"""
+        if self.remaining is None:
+            return 0.0
+        if now >= self.reset_at:
+            # Окно восстановилось: остаток уточнится по заголовкам следующего ответа
+            self.remaining = self.limit
+            if self.remaining is None:
+                return 0.0
+        reserve = int(self.limit * headroom) if self.limit else 0
+        # Запрос больше всего лимита все равно придется отправить, когда лимит полон
+        if self.remaining - amount >= reserve or (self.limit and self.remaining >= self.limit):
+            return 0.0
+        return max(self.reset_at - now, 0.01)
+
+
+class OpenAIScheduler:
+    """Очередь запросов к OpenAI по лимитам из заголовков ответов и повторы при ошибках"""
+
+    def __init__(self, max_retries=5, backoff_base=0.5, backoff_max=30.0, headroom=0.05, max_wait=60.0):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # Доля лимита, которую оставляем в запасе (ответы приходят с задержкой, остаток неточен)
+        self.headroom = headroom
+        # Дольше не ждем восстановления лимита: отправляем запрос, при 429 сработают повторы
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._limits = {}
+        self.waiting = 0
+        self.requests = 0
+        self.delayed = 0
+        self.retries = 0
+        self.failed = 0
+
+    def _limits_for(self, key):
+        limits = self._limits.get(key)
+        if limits is None:
+            limits = self._limits[key] = (_Limit(), _Limit())
+        return limits
+
+    def _reserve(self, key, tokens):
+        """Списать запрос и токены из остатка; вернуть время ожидания, если их не хватает"""
+        now = time.monotonic()
+        with self._lock:
+            requests_limit, tokens_limit = self._limits_for(key)
+            wait = max(requests_limit.wait_time(1, self.headroom, now),
+                       tokens_limit.wait_time(tokens, self.headroom, now))
+            if wait:
+                return wait
+            if requests_limit.remaining is not None:
+                requests_limit.remaining -= 1
+            if tokens_limit.remaining is not None:
+                tokens_limit.remaining -= tokens
+            return 0.0
+
+    def update(self, key, headers):
+        """Учесть остаток лимитов из заголовков ответа OpenAI"""
+        if headers is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            requests_limit, tokens_limit = self._limits_for(key)
+            requests_limit.update(_header_int(headers, "x-ratelimit-limit-requests"),
+                                  _header_int(headers, "x-ratelimit-remaining-requests"),
+                                  parse_duration(headers.get("x-ratelimit-reset-requests")), now)
+            tokens_limit.update(_header_int(headers, "x-ratelimit-limit-tokens"),
+                                _header_int(headers, "x-ratelimit-remaining-tokens"),
+                                parse_duration(headers.get("x-ratelimit-reset-tokens")), now)
+
+    def _retry_delay(self, key, error, attempt):
+        """Задержка перед повтором после ошибки (None - не повторять)"""
+        if attempt >= self.max_retries:
+            return None
+        if isinstance(error, openai.APIStatusError):
+            self.update(key, error.response.headers)
+            # Закончились деньги на счете - повтор не поможет
+            if error.status_code == 429 and error.code == "insufficient_quota":
+                return None
+            if error.status_code not in (408, 409, 429) and error.status_code < 500:
+                return None
+            retry_after = self._retry_after(error.response.headers)
+        elif isinstance(error, openai.APIConnectionError):
+            retry_after = None
+        else:
+            return None
+
+        # Экспоненциальная задержка с полным случайным разбросом, чтобы повторы не шли волной
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        status = getattr(error, "status_code", None) or type(error).__name__
+        with self._lock:
+            self.retries += 1
+        metrics.openai_retries_total.inc(model=key, reason=status)
+        log.warning("openai_retry", model=key, status=status, attempt=attempt + 1, max_retries=self.max_retries,
+                    delay=round(delay, 1))
+        return delay
+
+    @staticmethod
+    def _retry_after(headers):
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after"):
+                return float(headers["retry-after"])
+        except ValueError:
+            pass
+        return None
+
+    def _queue_wait(self, key, tokens, started):
+        """Время ожидания лимита (0 - отправлять запрос)"""
+        wait = self._reserve(key, tokens)
+        if wait and time.monotonic() - started + wait > self.max_wait:
+            return 0.0
+        return wait
+
+    def _begin_wait(self):
+        with self._lock:
+            self.waiting += 1
+            self.delayed += 1
+            metrics.openai_queue_depth.set(self.waiting)
+
+    def _end_wait(self):
+        with self._lock:
+            self.waiting -= 1
+            metrics.openai_queue_depth.set(self.waiting)
+
+    def call(self, key, tokens, func, *args, **kwargs):
+        """Выполнить func (метод with_raw_response) с учетом лимитов key; вернуть разобранный ответ"""
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            wait = self._queue_wait(key, tokens, started)
+            if wait:
+                self._begin_wait()
+                try:
+                    while wait:
+                        time.sleep(min(wait, WAIT_STEP))
+                        wait = self._queue_wait(key, tokens, started)
+                finally:
+                    self._end_wait()
+
+            with self._lock:
+                self.requests += 1
+            try:
+                raw = func(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(key, e, attempt)
+                if delay is None:
+                    with self._lock:
+                        self.failed += 1
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self.update(key, raw.headers)
+            return raw.parse()
+
+    async def call_async(self, key, tokens, func, *args, **kwargs):
+        """Асинхронный вариант call для AsyncOpenAI"""
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            wait = self._queue_wait(key, tokens, started)
+            if wait:
+                self._begin_wait()
+                try:
+                    while wait:
+                        await asyncio.sleep(min(wait, WAIT_STEP))
+                        wait = self._queue_wait(key, tokens, started)
+                finally:
+                    self._end_wait()
+
+            with self._lock:
+                self.requests += 1
+            try:
+                raw = await func(*args, **kwargs)
+            except Exception as e:
+                delay = self._retry_delay(key, e, attempt)
+                if delay is None:
+                    with self._lock:
+                        self.failed += 1
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self.update(key, raw.headers)
+            return raw.parse()
+
+    def stats(self):
+        """Очередь, счетчики и последние известные остатки лимитов по моделям"""
+        with self._lock:
+            return {
+                "waiting": self.waiting,
+                "requests": self.requests,
+                "delayed": self.delayed,
+                "retries": self.retries,
+                "failed": self.failed,
+                "limits": {
+                    key: {"requests": requests_limit.remaining, "tokens": tokens_limit.remaining}
+                    for key, (requests_limit, tokens_limit) in self._limits.items()
+                },
+            }
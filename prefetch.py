@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Упреждающий поиск для вопросов о текущей информации.
+
+На вопрос о погоде, новостях, ценах или датах модель почти всегда отвечает
+вызовом google_search, и ответ ждет три последовательных шага: первый
+запрос к модели, поиск и второй запрос. Здесь вопрос оценивается локально
+(без обращения к OpenAI), и для вероятных поисковых запросов поиск по
+тексту пользователя запускается одновременно с первым запросом к модели.
+
+Если модель запросила поиск, близкий по смыслу к упреждающему, используется
+уже готовый (или почти готовый) результат. Модель пишет запрос на
+английском, поэтому запросы сравниваются не по словам, а по признакам:
+категория (погода, цены, ... - те же, что у кэша поиска в search_cache.py)
+и начала остальных слов в латинской транслитерации,
+что сближает имена собственные ("бангкоке" и "Bangkok"). Доля совпадений
+видна в /stats: по ней видно, окупаются ли лишние запросы к Google.
+"""
+
+import re
+import threading
+from collections import Counter
+
+from search_cache import CATEGORY_PATTERNS, normalize_query
+
+# Результаты упреждающего поиска
+HIT = "hit"
+MISS = "miss"
+UNUSED = "unused"
+
+# Отдельные слова о датах: в вопросе они слишком многозначны ("четное число"), но в запросе означают дату
+DATE_WORD = re.compile(r"^(?:дат[аеуы]?|числ[оа]|день|дня|недел[яеию]|date|day|week)$")
+
+# Слова, которые не различают запросы (в том числе указания времени: модель добавляет их по-своему)
+STOP_WORDS = frozenset((
+    "а", "в", "во", "на", "и", "или", "по", "с", "со", "о", "об", "у", "к", "за", "из", "для", "до", "от",
+    "что", "как", "какая", "какой", "какое", "какие", "где", "когда", "сколько", "ли", "же", "мне", "я",
+    "ты", "вы", "сейчас", "сегодня", "завтра", "вчера", "текущий", "текущая", "последние", "новые",
+    "скажи", "подскажи", "расскажи", "найди", "покажи", "узнай", "пожалуйста", "будет", "есть", "это",
+    "a", "an", "the", "in", "on", "at", "of", "for", "to", "and", "or", "is", "are", "what", "how", "where",
+    "when", "which", "me", "now", "today", "tomorrow", "yesterday", "current", "currently", "latest",
+    "recent", "new", "please", "tell", "find", "show", "will", "be",
+))
+
+TRANSLIT = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "e", "ж": "zh", "з": "z", "и": "i",
+    "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s", "т": "t",
+    "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "sch", "ъ": "", "ы": "y", "ь": "",
+    "э": "e", "ю": "yu", "я": "ya",
+})
+
+# Длина начала слова, по которой сравниваются формы одного слова ("бангкоке" и "бангкок")
+STEM_LENGTH = 5
+
+
+def search_intent(text, max_chars=200):
+    """Категория вероятного поискового запроса или None.
+
+    Длинные сообщения (код, тексты для разбора) не считаются поисковыми, даже
+    если в них встречаются слова о ценах или новостях.
+    """
+    if not text or len(text) > max_chars:
+        return None
+    for category, pattern in CATEGORY_PATTERNS:
+        if pattern.search(text):
+            return category
+    return None
+
+
+def query_features(query):
+    """Признаки запроса: категории и начала остальных значимых слов латиницей"""
+    features = set()
+    text = normalize_query(query)
+    for category, pattern in CATEGORY_PATTERNS:
+        # Слова оборота категории ("exchange rate") становятся одним признаком - категорией
+        text, found = pattern.subn(" ", text)
+        if found:
+            features.add(f"#{category}")
+    for word in text.split():
+        if word in STOP_WORDS:
+            continue
+        if DATE_WORD.match(word):
+            features.add("#dates")
+        else:
+            features.add(word.translate(TRANSLIT)[:STEM_LENGTH])
+    return features
+
+
+def query_similarity(first, second):
+    """Близость запросов от 0 до 1 (коэффициент Жаккара по признакам)"""
+    first, second = query_features(first), query_features(second)
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+class Speculation:
+    """Упреждающий поиск одного сообщения: запрос и его выполняющийся результат (Future или Task)"""
+
+    __slots__ = ("query", "category", "result")
+
+    def __init__(self, query, category, result):
+        self.query = query
+        self.category = category
+        self.result = result
+
+
+class SearchPrefetcher:
+    """Решает, запускать ли упреждающий поиск, и сопоставляет его с вызовами модели"""
+
+    def __init__(self, min_similarity=0.5, num_results=5, max_chars=200):
+        self.min_similarity = min_similarity
+        # Сколько результатов запрашивать: вызов, которому нужно больше, не использует упреждающий поиск
+        self.num_results = num_results
+        self.max_chars = max_chars
+        self._lock = threading.Lock()
+        self.results = Counter()
+
+    def query_for(self, text):
+        """(запрос, категория) для упреждающего поиска или None"""
+        category = search_intent(text, self.max_chars)
+        if category is None:
+            return None
+        return " ".join(text.split()), category
+
+    def match(self, speculation, calls):
+        """Индекс вызова, которому подходит результат упреждающего поиска, или None.
+
+        calls - список (имя функции, аргументы); результат достается самому близкому
+        по запросу вызову google_search.
+        """
+        best, best_similarity = None, self.min_similarity
+        for index, (function_name, function_args) in enumerate(calls):
+            if function_name != "google_search" or not isinstance(function_args, dict):
+                continue
+            if function_args.get("num_results", 5) > self.num_results:
+                continue
+            similarity = query_similarity(speculation.query, str(function_args.get("query", "")))
+            if similarity >= best_similarity:
+                best, best_similarity = index, similarity
+        return best
+
+    def record(self, speculation, result):
+        """Учесть исход упреждающего поиска: HIT, MISS (модель искала другое) или UNUSED (не искала)"""
+        with self._lock:
+            self.results[(speculation.category, result)] += 1
+
+    def stats(self):
+        with self._lock:
+            totals = Counter()
+            for (_, result), count in self.results.items():
+                totals[result] += count
+            started = sum(totals.values())
+            return {
+                "started": started,
+                "hits": totals[HIT],
+                "misses": totals[MISS],
+                "unused": totals[UNUSED],
+                "hit_rate": totals[HIT] / started if started else 0.0,
+            }
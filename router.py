@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Автоматический выбор модели под запрос.
+
+Запрос оценивается локально, без обращения к OpenAI: длина, код, признаки
+задачи на рассуждение, вычисления, вложения. Сумма весов признаков дает
+уровень сложности, а из моделей, которым он по силам, выбирается самая
+дешевая, чья ожидаемая задержка (скользящее среднее + отклонение по
+реальным запросам) укладывается в SLO. Решение возвращается вместе с
+причиной, чтобы по логам можно было подобрать пороги.
+"""
+
+import re
+
+# Признаки задачи на рассуждение (подстроки в нижнем регистре)
+REASONING_CUES = (
+    "почему", "докажи", "доказать", "объясни", "сравни", "проанализируй", "анализ",
+    "пошагово", "по шагам", "рассуждай", "реши", "решить", "вычисли", "рассчитай",
+    "оптимизир", "алгоритм", "спроектируй", "архитектур", "плюсы и минусы",
+    "why", "prove", "explain", "compare", "analyze", "analyse", "step by step",
+    "reason", "solve", "calculate", "optimize", "algorithm", "design", "trade-off",
+)
+
+CODE_PATTERN = re.compile(
+    r"```|^\s*(def|class|import|from \S+ import|function|const|let|var|public|#include|SELECT|Traceback)\b"
+    r"|[{};]\s*$|=>|\w+\([^)]*\)\s*[{:]",
+    re.MULTILINE | re.IGNORECASE)
+MATH_PATTERN = re.compile(r"\d\s*[-+*/^=<>]\s*\d|[∫∑√≤≥≠]|\b(sin|cos|log|lim)\b", re.IGNORECASE)
+
+# Веса признаков в оценке сложности
+WEIGHT_LONG = 2
+WEIGHT_CODE = 2
+WEIGHT_REASONING = 1
+WEIGHT_MATH = 1
+WEIGHT_ATTACHMENT = 1
+# Больше двух признаков рассуждения не добавляют сложности
+MAX_REASONING_CUES = 2
+
+
+def classify(text, attachments=0, long_prompt=600):
+    """Оценка сложности запроса: (баллы, список причин)"""
+    text = text or ""
+    lowered = text.lower()
+    score = 0
+    reasons = []
+
+    if len(text) >= long_prompt:
+        score += WEIGHT_LONG
+        reasons.append(f"длина {len(text)}")
+    if CODE_PATTERN.search(text):
+        score += WEIGHT_CODE
+        reasons.append("код")
+    cues = [cue for cue in REASONING_CUES if cue in lowered][:MAX_REASONING_CUES]
+    if cues:
+        score += WEIGHT_REASONING * len(cues)
+        reasons.append("рассуждение: " + ", ".join(cues))
+    if MATH_PATTERN.search(text):
+        score += WEIGHT_MATH
+        reasons.append("вычисления")
+    if attachments:
+        score += WEIGHT_ATTACHMENT * attachments
+        reasons.append(f"вложений: {attachments}")
+    return score, reasons
+
+
+class ModelRouter:
+    """Выбор самой дешевой модели, которая справится с запросом в пределах SLO.
+
+    tiers - {модель: уровень}, где уровень - сложность запросов, с которыми модель
+    справляется (чем выше, тем модель дороже и медленнее). Уровень запроса 1, если
+    баллов меньше complex_score, иначе 2. Если подходящие модели не укладываются
+    в SLO, запрос уходит более слабой модели, которая укладывается.
+    """
+
+    def __init__(self, tiers, latency, slo=10.0, complex_score=2, long_prompt=600):
+        # Порядок от дешевой модели к дорогой
+        self.models = sorted(tiers, key=tiers.get)
+        self.tiers = tiers
+        self.latency = latency
+        self.slo = slo
+        self.complex_score = complex_score
+        self.long_prompt = long_prompt
+
+    def expected_latency(self, model):
+        """Ожидаемое время ответа с запасом на разброс (None - нет данных)"""
+        stats = self.latency.get(model)
+        if stats is None:
+            return None
+        return stats["total"] + stats["total_dev"]
+
+    def route(self, text, attachments=0):
+        """(модель, причина) для запроса"""
+        score, reasons = classify(text, attachments, self.long_prompt)
+        tier = 2 if score >= self.complex_score else 1
+        features = f"баллы {score}" + (f" ({'; '.join(reasons)})" if reasons else "")
+
+        capable = [model for model in self.models if self.tiers[model] >= tier] or self.models[-1:]
+        estimates = {model: self.expected_latency(model) for model in self.models}
+
+        for model in capable:
+            expected = estimates[model]
+            if expected is None:
+                # Без статистики считаем, что модель укладывается: так она наберет замеры
+                return model, f"уровень {tier}, {features}; {model}: нет данных о задержке"
+            if expected <= self.slo:
+                return model, f"уровень {tier}, {features}; {model}: ~{expected:.1f} с <= SLO {self.slo:.1f} с"
+
+        # Подходящие модели не укладываются в SLO - берем самую сильную из более слабых, которая укладывается
+        for model in reversed(self.models):
+            expected = estimates[model]
+            if model not in capable and expected is not None and expected <= self.slo:
+                return model, (f"уровень {tier}, {features}; {capable[0]}: ~{estimates[capable[0]]:.1f} с "
+                               f"> SLO {self.slo:.1f} с, понижение до {model}: ~{expected:.1f} с")
+
+        # SLO не выполняется ни одной моделью - берем самую быструю из подходящих
+        model = min(capable, key=estimates.get)
+        return model, (f"уровень {tier}, {features}; SLO {self.slo:.1f} с не выполняется, "
+                       f"самая быстрая {model}: ~{estimates[model]:.1f} с")
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Кэш результатов google_search.
+
+Запросы нормализуются (регистр, пробелы, пунктуация), время жизни записи
+зависит от категории запроса: погода и курсы устаревают быстро, справочные
+данные - медленно. По тем же категориям prefetch.py распознает вопросы,
+для которых стоит искать заранее. Одновременные одинаковые запросы выполняются одним
+HTTP запросом (singleflight), остальные потоки ждут его результат.
+"""
+
+import re
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# Время жизни результатов по категориям запросов (секунды)
+CATEGORY_TTLS = {
+    "prices": 120,
+    "news": 300,
+    "weather": 600,
+    "dates": 600,
+    "default": 3600,
+}
+
+# Слова и обороты категорий, целиком (от границы до границы слова). Короткие и
+# многозначные основы перечислены с окончаниями: "цен" не должно находить
+# "ценность", "курс" - "курсор", "rate" - "rated", "rain" - "rainbow"
+CATEGORY_WORDS = [
+    ("prices", [
+        r"цен(?:а|ы|у|е|ой|ам|ах|ами)?", r"стоимост\w*", r"сколько\s+сто(?:ит|ят)",
+        r"курс(?:а|у|ом|е|ы|ов)?\s+(?:валют\w*|доллар\w*|евро|рубл\w*|юан\w*|бат(?:а|у|ом)?|биткоин\w*|"
+        r"крипт\w*|акци\w*|usd|eur|rub|thb|btc)",
+        r"акци(?:я|и|й|ям)\s+компани\w*", r"бирж(?:а|и|е|у|ей|евой|евые)",
+        r"биткоин\w*", r"криптовалют\w*", r"доллар(?:а|у|ом|е|ы|ов)?", r"евро", r"рубл(?:ь|я|ю|ем|е|и|ей)",
+        r"prices?", r"costs?", r"(?:exchange|interest)\s+rates?", r"stock\s+(?:price|market)s?", r"share\s+prices?",
+        r"bitcoin", r"btc", r"ethereum", r"crypto(?:currenc(?:y|ies))?", r"usd", r"eur", r"rub", r"thb",
+    ]),
+    ("news", [
+        r"новост(?:ь|и|ей|ям|ях|ями)", r"последние\s+событи[яй]", r"что\s+(?:случилось|произошло)",
+        r"сч[её]т\s+(?:матча|игры)", r"результат(?:ы|ов)?\s+матч(?:а|ей)",
+        r"news", r"headlines?", r"breaking", r"(?:final|live|latest)\s+scores?",
+    ]),
+    ("weather", [
+        r"погод\w*", r"температур\w*", r"прогноз(?:а|у|ом|ы)?\s+погоды", r"дожд(?:ь|я|ю|ем|е|и|ей|ливо|ливая)",
+        r"снег(?:а|у|ом|е|опад\w*)?", r"жар(?:а|ы|у|ой)",
+        r"weather", r"forecast", r"temperatures?", r"rain(?:s|ing|y)?", r"snow(?:s|ing|y)?",
+    ]),
+    ("dates", [
+        r"какое\s+(?:сегодня\s+)?число", r"какой\s+(?:сегодня\s+)?день", r"день\s+недели",
+        r"какая\s+(?:сегодня\s+)?дата", r"расписани(?:е|я|ю|ем|и)", r"праздник(?:и|а|ов|ам)?",
+        r"what\s+(?:day|date)", r"today'?s\s+date", r"day\s+of\s+(?:the\s+)?week", r"schedules?", r"holidays?",
+    ]),
+]
+
+# Первая подходящая категория определяет время жизни (и категорию упреждающего поиска)
+CATEGORY_PATTERNS = [
+    (category, re.compile(r"\b(?:" + "|".join(words) + r")\b", re.IGNORECASE))
+    for category, words in CATEGORY_WORDS
+]
+
+
+def normalize_query(query):
+    """Привести запрос к виду, в котором одинаковые по смыслу запросы совпадают"""
+    query = re.sub(r"[^\w\s]", " ", query.lower())
+    return " ".join(query.split())
+
+
+def query_category(query):
+    """Категория запроса, определяющая время жизни результата"""
+    for category, pattern in CATEGORY_PATTERNS:
+        if pattern.search(query):
+            return category
+    return "default"
+
+
+class TTLCache:
+    """Ограниченный по размеру LRU-кэш с временем жизни записей и объединением одинаковых загрузок"""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Запросы, которые дождались уже выполняющейся загрузки
+        self.shared = 0
+
+    def _begin(self, key):
+        """Вернуть (значение, None, False) при попадании или (None, future, владелец загрузки)"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value, None, False
+                del self._data[key]
+
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+                self.misses += 1
+            else:
+                self.shared += 1
+            return None, future, owner
+
+    def _complete(self, key, future, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+            del self._inflight[key]
+        future.set_result(value)
+
+    def _fail(self, key, future, error):
+        with self._lock:
+            del self._inflight[key]
+        future.set_exception(error)
+
+    def get_or_load(self, key, loader, ttl):
+        """Вернуть значение из кэша или загрузить его через loader().
+
+        Исключения loader() не кэшируются и передаются всем ожидающим потокам.
+        """
+        value, future, owner = self._begin(key)
+        if future is None:
+            return value
+        if not owner:
+            return future.result()
+
+        try:
+            value = loader()
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._complete(key, future, value, ttl)
+        return value
+
+    async def get_or_load_async(self, key, loader, ttl):
+        """То же, что get_or_load, но loader() - корутина (для асинхронного режима)"""
+        value, future, owner = self._begin(key)
+        if future is None:
+            return value
+        if not owner:
+            return await asyncio.wrap_future(future)
+
+        try:
+            value = await loader()
+        except BaseException as e:
+            self._fail(key, future, e)
+            raise
+        self._complete(key, future, value, ttl)
+        return value
+
+    def stats(self):
+        """Счетчики попаданий и промахов"""
+        with self._lock:
+            lookups = self.hits + self.misses + self.shared
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "shared": self.shared,
+                "hit_rate": (self.hits + self.shared) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Обработка чатов в нескольких процессах (шардах).
+
+В одном процессе обработчики делят GIL: разбор и сериализация больших
+историй и кодирование фото в base64 мешают друг другу и приему
+обновлений. Супервизор запускает N процессов-шардов и направляет каждое
+обновление в шард по стабильному хэшу chat_id. Чат всегда
+обрабатывается одним и тем же шардом, поэтому порядок сообщений чата и
+владение его историей не меняются.
+
+Супервизор и шард связаны двумя каналами (Pipe): обновления и отчеты о
+состоянии. У каждого канала по одному процессу на концах, межпроцессных
+блокировок нет, поэтому шард, убитый посреди чтения или записи, не
+блокирует ни супервизор, ни процесс, который его заменит. Каждый запуск
+шарда получает новые каналы. Шард подтверждает получение каждого
+обновления, и следующее отправляется только после подтверждения:
+обновления, которые шард не успел получить, при перезапуске достаются
+новому процессу. Теряется только то, что завершившийся шард уже
+обрабатывал.
+
+Отчеты отправляет основной цикл шарда между обновлениями. Шард, который
+завершился или давно не присылал отчет (в том числе потому, что завис
+его основной цикл), перезапускается. Сводка по шардам записывается в
+status_path, чтобы ее могли показать сами шарды (/stats).
+"""
+
+import os
+import json
+import time
+import zlib
+import queue
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+
+import metrics
+from logs import get_logger
+
+log = get_logger(__name__)
+
+# Переменная окружения с номером шарда: ее читает код, выполняемый при импорте в процессе шарда
+SHARD_ENV = "BOT_SHARD"
+
+# Метка остановки в очереди шарда: шард дорабатывает полученные обновления и завершается
+_STOP = None
+# Подтверждение получения обновления шардом
+_ACK = b"+"
+
+
+def shard_for(chat_id, shards):
+    """Номер шарда чата (crc32, а не hash(): результат одинаков во всех процессах и между запусками)"""
+    if chat_id is None or shards <= 1:
+        return 0
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+
+def current_shard():
+    """Номер шарда текущего процесса (None вне шарда)"""
+    value = os.getenv(SHARD_ENV)
+    return int(value) if value else None
+
+
+def serve_shard(index, updates, health, process, stats, health_interval=5.0):
+    """Цикл процесса-шарда: process(обновление) для каждого обновления из канала updates до метки остановки.
+
+    Получение каждого обновления подтверждается в тот же канал до вызова process().
+
+    Раз в health_interval цикл отправляет в канал health отчет с состоянием шарда
+    (stats() и число полученных обновлений). Отчеты отправляет сам цикл, поэтому
+    если process() зависнет, отчеты прекратятся и супервизор перезапустит шард.
+    """
+    received = 0
+    next_report = 0.0
+    while True:
+        now = time.monotonic()
+        if now >= next_report:
+            try:
+                health.send({"shard": index, "pid": os.getpid(), "received": received,
+                             "time": time.time(), **stats()})
+            except (OSError, ValueError):
+                # Супервизор завершился
+                return
+            next_report = now + health_interval
+        try:
+            if not updates.poll(max(0.0, next_report - time.monotonic())):
+                continue
+            update = updates.recv()
+            if update is _STOP:
+                return
+            updates.send_bytes(_ACK)
+        except (EOFError, OSError):
+            return
+        received += 1
+        try:
+            process(update)
+        except Exception:
+            log.exception("shard_update_failed", shard=index)
+
+
+class _Shard:
+    __slots__ = ("index", "pending", "process", "updates", "health", "restarts", "started_at",
+                 "report", "reported_at")
+
+    def __init__(self, index, queue_limit):
+        self.index = index
+        # Обновления, еще не отправленные процессу шарда
+        self.pending = queue.Queue(maxsize=queue_limit)
+        self.process = None
+        # Концы каналов на стороне супервизора: обновления (и подтверждения) и отчеты
+        self.updates = None
+        self.health = None
+        self.restarts = 0
+        self.started_at = 0.0
+        self.report = {}
+        self.reported_at = 0.0
+
+
+class ShardSupervisor:
+    """Процессы-шарды, маршрутизация обновлений по chat_id и контроль их состояния.
+
+    target(index, канал обновлений, канал отчетов) выполняется в процессе шарда.
+    Процессы запускаются через spawn: каждый шард заново импортирует модули и
+    получает собственные потоки, соединения и кэши.
+    """
+
+    def __init__(self, shards, target, queue_limit=1000, health_interval=5.0, health_timeout=30.0,
+                 status_path=None):
+        self.target = target
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.status_path = status_path
+        self._context = multiprocessing.get_context("spawn")
+        self._shards = [_Shard(index, queue_limit) for index in range(shards)]
+        self._lock = threading.Lock()
+        # Уведомляет потоки отправки о перезапуске шарда (новом канале)
+        self._restarted = threading.Condition(self._lock)
+        self._stopping = threading.Event()
+        self._monitor = None
+        self._pumps = []
+        self.routed = 0
+        self.rejected = 0
+
+    def start(self):
+        for shard in self._shards:
+            self._spawn(shard)
+            pump = threading.Thread(target=self._pump, args=(shard,), name=f"shard-pump-{shard.index}",
+                                    daemon=True)
+            pump.start()
+            self._pumps.append(pump)
+        self._monitor = threading.Thread(target=self._monitor_loop, name="shard-monitor", daemon=True)
+        self._monitor.start()
+
+    def _spawn(self, shard):
+        updates_shard, updates_supervisor = self._context.Pipe()
+        health_reader, health_writer = self._context.Pipe(duplex=False)
+        # Дочерний процесс получает копию окружения на момент запуска
+        previous = os.environ.get(SHARD_ENV)
+        os.environ[SHARD_ENV] = str(shard.index)
+        try:
+            process = self._context.Process(target=self.target, args=(shard.index, updates_shard, health_writer),
+                                            name=f"shard-{shard.index}", daemon=True)
+            process.start()
+        finally:
+            if previous is None:
+                del os.environ[SHARD_ENV]
+            else:
+                os.environ[SHARD_ENV] = previous
+        # Эти концы теперь есть только у шарда: когда он завершится, ожидание
+        # подтверждения и чтение отчетов завершатся EOF
+        updates_shard.close()
+        health_writer.close()
+
+        with self._lock:
+            # Прежний канал обновлений закрывает поток отправки, который им пользуется
+            if shard.health is not None:
+                shard.health.close()
+            shard.process = process
+            shard.updates = updates_supervisor
+            shard.health = health_reader
+            shard.started_at = time.monotonic()
+            shard.report = {}
+            shard.reported_at = 0.0
+            self._restarted.notify_all()
+        metrics.shard_up.set(1, shard=str(shard.index))
+        log.info("shard_started", shard=shard.index, pid=process.pid)
+
+    def route(self, chat_id, update):
+        """Передать обновление шарду чата; False, если очередь шарда заполнена"""
+        shard = self._shards[shard_for(chat_id, len(self._shards))]
+        try:
+            shard.pending.put_nowait(update)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.routed += 1
+        return True
+
+    def _pump(self, shard):
+        """Отправлять обновления из очереди шарда в канал его текущего процесса"""
+        update = shard.pending.get()
+        while True:
+            with self._lock:
+                connection = shard.updates
+            try:
+                connection.send(update)
+                if update is _STOP:
+                    return
+                # Пока шард не подтвердил получение, обновление остается за супервизором
+                connection.recv_bytes()
+            except (EOFError, OSError, ValueError):
+                # Процесс шарда завершился или убит: то же обновление получит процесс, который его заменит
+                connection.close()
+                with self._restarted:
+                    while shard.updates is connection and not self._stopping.is_set():
+                        self._restarted.wait()
+                if self._stopping.is_set():
+                    return
+                continue
+            update = shard.pending.get()
+
+    def _monitor_loop(self):
+        next_check = time.monotonic() + self.health_interval
+        while not self._stopping.is_set():
+            with self._lock:
+                channels = {shard.health: shard for shard in self._shards if shard.health is not None}
+            for channel in wait(list(channels), timeout=max(0.1, next_check - time.monotonic())):
+                shard = channels[channel]
+                try:
+                    report = channel.recv()
+                except (EOFError, OSError):
+                    # Шард завершился: канал больше не слушаем, шард перезапустит _check
+                    with self._lock:
+                        channel.close()
+                        shard.health = None
+                    next_check = time.monotonic()
+                    continue
+                with self._lock:
+                    shard.report = report
+                    shard.reported_at = time.monotonic()
+            if time.monotonic() >= next_check:
+                next_check = time.monotonic() + self.health_interval
+                self._check()
+
+    def _check(self):
+        """Перезапустить завершившиеся и зависшие шарды, обновить метрики и файл состояния"""
+        now = time.monotonic()
+        for shard in self._shards:
+            if self._stopping.is_set():
+                return
+            process = shard.process
+            last_seen = shard.reported_at or shard.started_at
+            if not process.is_alive():
+                reason = f"exited with code {process.exitcode}"
+            elif now - last_seen > self.health_timeout:
+                reason = f"no health report for {now - last_seen:.0f}s"
+                process.kill()
+                process.join(5)
+            else:
+                metrics.shard_queue_depth.set(shard.pending.qsize(), shard=str(shard.index))
+                continue
+            log.warning("shard_restarting", shard=shard.index, reason=reason)
+            metrics.shard_up.set(0, shard=str(shard.index))
+            metrics.shard_restarts_total.inc(shard=str(shard.index))
+            with self._lock:
+                shard.restarts += 1
+            self._spawn(shard)
+        self._write_status()
+
+    def stats(self):
+        """Состояние шардов: процесс, очередь, последний отчет"""
+        now = time.monotonic()
+        result = []
+        with self._lock:
+            for shard in self._shards:
+                result.append({
+                    "shard": shard.index,
+                    "pid": shard.process.pid if shard.process else None,
+                    "alive": bool(shard.process and shard.process.is_alive()),
+                    "queued": shard.pending.qsize(),
+                    "restarts": shard.restarts,
+                    "report_age": now - shard.reported_at if shard.reported_at else None,
+                    "report": dict(shard.report),
+                })
+        return result
+
+    def _write_status(self):
+        if self.status_path is None:
+            return
+        status = {"updated_at": time.time(), "routed": self.routed, "rejected": self.rejected,
+                  "shards": self.stats()}
+        tmp_path = self.status_path.with_name(f".{self.status_path.name}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(status, f)
+            os.replace(tmp_path, self.status_path)
+        except OSError as e:
+            log.error("shard_status_write_failed", error=e)
+
+    def shutdown(self, timeout=30.0):
+        """Дать шардам обработать уже принятые обновления и остановить их (не дольше timeout)"""
+        # Завершающиеся шарды больше не перезапускаются
+        self._stopping.set()
+        for shard in self._shards:
+            try:
+                shard.pending.put(_STOP, timeout=1)
+            except queue.Full:
+                shard.process.terminate()
+        deadline = time.monotonic() + timeout
+        for shard in self._shards:
+            shard.process.join(max(0, deadline - time.monotonic()))
+            if shard.process.is_alive():
+                log.warning("shard_stop_timeout", shard=shard.index)
+                shard.process.terminate()
+                shard.process.join(5)
+            metrics.shard_up.set(0, shard=str(shard.index))
+        with self._restarted:
+            self._restarted.notify_all()
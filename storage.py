@@ -0,0 +1,704 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Хранилища истории чатов и настроек пользователей.
+
+Все бэкенды реализуют интерфейс ChatStorage:
+- JsonFileStorage - исходный формат: один JSON файл на чат, перезаписывается целиком
+- AppendOnlyStorage - JSON Lines: на каждом ходу дописываются только новые сообщения
+- SQLiteStorage - одна база SQLite в режиме WAL с пакетной фиксацией транзакций
+
+CachedStorage оборачивает любой из них: активные чаты обслуживаются из памяти,
+а запись на диск выполняется фоновым потоком (write-behind). SharedSettingsStorage
+переносит настройки файловых бэкендов в SQLite, когда с одной директорией работают
+несколько процессов.
+
+save_history() рассчитан на то, что история только растет: бэкенды могут записать
+лишь сообщения, которых еще нет в хранилище. Если изменились уже сохраненные
+сообщения (сжатие истории, замена вложений), нужно вызывать replace_history().
+"""
+
+import os
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+def _dump(obj):
+    """Компактная сериализация сообщения или значения настройки"""
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
+
+def _atomic_write(path, text):
+    """Записать файл целиком через временный файл и os.replace"""
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _chat_id(path):
+    """chat_id из имени файла истории chat_<id>.json(l)"""
+    return int(path.stem[len("chat_"):])
+
+
+class ChatStorage:
+    """Базовый интерфейс хранилища"""
+
+    def load_history(self, chat_id):
+        """Вернуть список сообщений чата или None, если истории нет"""
+        raise NotImplementedError
+
+    def save_history(self, chat_id, history):
+        """Сохранить историю, в которой к уже сохраненной добавлены новые сообщения"""
+        raise NotImplementedError
+
+    def replace_history(self, chat_id, history):
+        """Полностью перезаписать историю чата"""
+        raise NotImplementedError
+
+    def clear_history(self, chat_id):
+        """Удалить историю чата"""
+        raise NotImplementedError
+
+    def chat_ids(self):
+        """Чаты, у которых есть сохраненная история"""
+        raise NotImplementedError
+
+    def read_history(self, chat_id):
+        """Прочитать историю только для просмотра (None, если ее нет).
+
+        В отличие от load_history, ничего не исправляет на диске и не меняет состояние
+        хранилища: историю в это время может записывать другой поток или процесс.
+        """
+        return self.load_history(chat_id)
+
+    def histories(self, skip=()):
+        """Все истории, кроме чатов из skip: пары (chat_id, сообщения) через read_history.
+
+        Нужно, например, для поиска используемых вложений.
+        """
+        for chat_id in self.chat_ids():
+            if chat_id in skip:
+                continue
+            history = self.read_history(chat_id)
+            if history:
+                yield chat_id, history
+
+    def get_setting(self, chat_id, key, default=None):
+        """Получить настройку пользователя"""
+        raise NotImplementedError
+
+    def set_setting(self, chat_id, key, value):
+        """Сохранить настройку пользователя"""
+        raise NotImplementedError
+
+    def flush(self):
+        """Принудительно записать отложенные изменения"""
+
+    def close(self):
+        """Записать изменения и освободить ресурсы"""
+        self.flush()
+
+
+class _FileSettingsMixin:
+    """Настройки пользователей в одном JSON файле рядом с историей"""
+
+    def _init_settings(self, directory):
+        self._settings_path = directory / 'settings.json'
+        self._settings_lock = threading.Lock()
+        self._settings = {}
+        if self._settings_path.exists():
+            try:
+                with open(self._settings_path, 'r', encoding='utf-8') as f:
+                    self._settings = json.load(f)
+            except Exception as e:
+                log.error("settings_load_failed", path=self._settings_path, error=e)
+
+    def get_setting(self, chat_id, key, default=None):
+        return self._settings.get(str(chat_id), {}).get(key, default)
+
+    def set_setting(self, chat_id, key, value):
+        with self._settings_lock:
+            self._settings.setdefault(str(chat_id), {})[key] = value
+            _atomic_write(self._settings_path, _dump(self._settings))
+
+
+class JsonFileStorage(_FileSettingsMixin, ChatStorage):
+    """Один JSON файл на чат (исходный формат chat_history/chat_<id>.json)"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True)
+        self._init_settings(self.directory)
+
+    def _path(self, chat_id):
+        return self.directory / f"chat_{chat_id}.json"
+
+    def load_history(self, chat_id):
+        path = self._path(chat_id)
+        if not path.exists():
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def save_history(self, chat_id, history):
+        self.replace_history(chat_id, history)
+
+    def replace_history(self, chat_id, history):
+        _atomic_write(self._path(chat_id), json.dumps(history, ensure_ascii=False, indent=2))
+
+    def clear_history(self, chat_id):
+        path = self._path(chat_id)
+        if path.exists():
+            path.unlink()
+
+    def chat_ids(self):
+        return [_chat_id(path) for path in self.directory.glob("chat_*.json")]
+
+
+class AppendOnlyStorage(_FileSettingsMixin, ChatStorage):
+    """JSON Lines: одно сообщение на строку, новые сообщения дописываются в конец файла"""
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True)
+        self._init_settings(self.directory)
+        # Сколько сообщений каждого чата уже лежит на диске
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def _path(self, chat_id):
+        return self.directory / f"chat_{chat_id}.jsonl"
+
+    def _legacy_path(self, chat_id):
+        return self.directory / f"chat_{chat_id}.json"
+
+    def _read(self, path):
+        """(сообщения, есть ли поврежденные строки)"""
+        history = []
+        damaged = False
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    history.append(json.loads(line))
+                except ValueError:
+                    # Недописанная строка после аварийной остановки (или дописываемая прямо сейчас)
+                    damaged = True
+        return history, damaged
+
+    def load_history(self, chat_id):
+        path = self._path(chat_id)
+        if not path.exists():
+            return self._migrate_legacy(chat_id)
+
+        history, damaged = self._read(path)
+        if damaged:
+            log.warning("history_damaged", file=path.name, messages=len(history))
+            self.replace_history(chat_id, history)
+        else:
+            self._counts[chat_id] = len(history)
+        return history
+
+    def read_history(self, chat_id):
+        # Недописанную строку не исправляем и не переносим старый формат: файл может
+        # принадлежать другому процессу (шарду), а его счетчик сообщений - потоку записи
+        try:
+            return self._read(self._path(chat_id))[0]
+        except FileNotFoundError:
+            pass
+        try:
+            with open(self._legacy_path(chat_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _migrate_legacy(self, chat_id):
+        """Перенести историю из старого chat_<id>.json в формат JSON Lines"""
+        legacy_path = self._legacy_path(chat_id)
+        if not legacy_path.exists():
+            return None
+        with open(legacy_path, 'r', encoding='utf-8') as f:
+            history = json.load(f)
+        self.replace_history(chat_id, history)
+        legacy_path.unlink()
+        return history
+
+    def _count(self, chat_id):
+        if chat_id not in self._counts:
+            path = self._path(chat_id)
+            if path.exists():
+                with open(path, 'rb') as f:
+                    self._counts[chat_id] = sum(1 for line in f if line.strip())
+            else:
+                self._counts[chat_id] = 0
+        return self._counts[chat_id]
+
+    def save_history(self, chat_id, history):
+        with self._lock:
+            count = self._count(chat_id)
+            if len(history) < count:
+                # История стала короче - это не дописывание, перезаписываем
+                self._replace(chat_id, history)
+                return
+            new_messages = history[count:]
+            if not new_messages:
+                return
+            data = ''.join(_dump(m) + '\n' for m in new_messages).encode('utf-8')
+            # Один небуферизованный write: сообщения хода попадают в файл одной записью,
+            # а не кусками по размеру буфера
+            with open(self._path(chat_id), 'ab', buffering=0) as f:
+                f.write(data)
+            self._counts[chat_id] = len(history)
+
+    def replace_history(self, chat_id, history):
+        with self._lock:
+            self._replace(chat_id, history)
+
+    def _replace(self, chat_id, history):
+        _atomic_write(self._path(chat_id), ''.join(_dump(m) + '\n' for m in history))
+        self._counts[chat_id] = len(history)
+
+    def clear_history(self, chat_id):
+        with self._lock:
+            for path in (self._path(chat_id), self._legacy_path(chat_id)):
+                if path.exists():
+                    path.unlink()
+            self._counts[chat_id] = 0
+
+    def chat_ids(self):
+        # Чаты, история которых еще лежит в старом chat_<id>.json, тоже считаются
+        return sorted({_chat_id(path) for pattern in ("chat_*.jsonl", "chat_*.json")
+                       for path in self.directory.glob(pattern)})
+
+
+class SQLiteStorage(ChatStorage):
+    """SQLite в режиме WAL: сообщения индексированы по (chat_id, seq), фиксация пакетами"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            chat_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (chat_id, seq)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS settings (
+            chat_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (chat_id, key)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path, commit_interval=1.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.commit_interval = commit_interval
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+        self._lock = threading.RLock()
+        self._counts = {}
+        self._dirty = False
+        self._last_commit = time.monotonic()
+        self._commit_timer = None
+
+    def _commit_later(self):
+        """Зафиксировать транзакцию сейчас или не позже чем через commit_interval"""
+        self._dirty = True
+        if time.monotonic() - self._last_commit >= self.commit_interval:
+            self._commit()
+        elif self._commit_timer is None:
+            self._commit_timer = threading.Timer(self.commit_interval, self.flush)
+            self._commit_timer.daemon = True
+            self._commit_timer.start()
+
+    def _commit(self):
+        self._conn.commit()
+        self._dirty = False
+        self._last_commit = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._commit_timer = None
+            if self._dirty:
+                self._commit()
+
+    def close(self):
+        with self._lock:
+            if self._commit_timer is not None:
+                self._commit_timer.cancel()
+            self.flush()
+            self._conn.close()
+
+    def _count(self, chat_id):
+        if chat_id not in self._counts:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM messages WHERE chat_id = ?", (chat_id,)).fetchone()
+            self._counts[chat_id] = row[0]
+        return self._counts[chat_id]
+
+    def load_history(self, chat_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM messages WHERE chat_id = ? ORDER BY seq", (chat_id,)).fetchall()
+            self._counts[chat_id] = len(rows)
+        if not rows:
+            return None
+        return [json.loads(row[0]) for row in rows]
+
+    def save_history(self, chat_id, history):
+        with self._lock:
+            count = self._count(chat_id)
+            if len(history) < count:
+                self._replace(chat_id, history)
+            elif len(history) > count:
+                self._insert(chat_id, history, count)
+            else:
+                return
+            self._commit_later()
+
+    def replace_history(self, chat_id, history):
+        with self._lock:
+            self._replace(chat_id, history)
+            self._commit_later()
+
+    def _replace(self, chat_id, history):
+        self._conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+        self._insert(chat_id, history, 0)
+
+    def _insert(self, chat_id, history, start):
+        self._conn.executemany(
+            "INSERT INTO messages (chat_id, seq, data) VALUES (?, ?, ?)",
+            [(chat_id, seq, _dump(history[seq])) for seq in range(start, len(history))])
+        self._counts[chat_id] = len(history)
+
+    def clear_history(self, chat_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+            self._counts[chat_id] = 0
+            self._commit_later()
+
+    def chat_ids(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT DISTINCT chat_id FROM messages")]
+
+    def get_setting(self, chat_id, key, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM settings WHERE chat_id = ? AND key = ?", (chat_id, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_setting(self, chat_id, key, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO settings (chat_id, key, value) VALUES (?, ?, ?)",
+                (chat_id, key, _dump(value)))
+            # Настройки меняются редко, фиксируем сразу
+            self._commit()
+
+
+class SharedSettingsStorage(ChatStorage):
+    """История в backend, настройки - в общей базе SQLite.
+
+    settings.json перезаписывается целиком из памяти процесса, поэтому несколько
+    процессов затирали бы изменения друг друга. SQLite в режиме WAL безопасно
+    принимает запись из нескольких процессов.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS settings (
+            chat_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (chat_id, key)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, backend, path, legacy_path=None):
+        self.backend = backend
+        self.path = Path(path)
+        is_new = not self.path.exists()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+        self._lock = threading.Lock()
+        if is_new and legacy_path is not None and Path(legacy_path).exists():
+            self._migrate(Path(legacy_path))
+
+    def _migrate(self, legacy_path):
+        """Перенести настройки из settings.json (повторный перенос ничего не меняет)"""
+        try:
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                settings = json.load(f)
+        except (OSError, ValueError) as e:
+            log.error("settings_load_failed", path=legacy_path, error=e)
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO settings (chat_id, key, value) VALUES (?, ?, ?)",
+                [(int(chat_id), key, _dump(value))
+                 for chat_id, values in settings.items() for key, value in values.items()])
+            self._conn.commit()
+
+    def load_history(self, chat_id):
+        return self.backend.load_history(chat_id)
+
+    def save_history(self, chat_id, history):
+        self.backend.save_history(chat_id, history)
+
+    def replace_history(self, chat_id, history):
+        self.backend.replace_history(chat_id, history)
+
+    def clear_history(self, chat_id):
+        self.backend.clear_history(chat_id)
+
+    def chat_ids(self):
+        return self.backend.chat_ids()
+
+    def read_history(self, chat_id):
+        return self.backend.read_history(chat_id)
+
+    def histories(self, skip=()):
+        return self.backend.histories(skip)
+
+    def get_setting(self, chat_id, key, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM settings WHERE chat_id = ? AND key = ?", (chat_id, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_setting(self, chat_id, key, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO settings (chat_id, key, value) VALUES (?, ?, ?)",
+                (chat_id, key, _dump(value)))
+            self._conn.commit()
+
+    def flush(self):
+        self.backend.flush()
+
+    def close(self):
+        self.backend.close()
+        with self._lock:
+            self._conn.close()
+
+
+class _CacheEntry:
+    __slots__ = ('history', 'sizes', 'size', 'version', 'flushed_version', 'replace')
+
+    def __init__(self, history):
+        self.history = history
+        self.sizes = [len(_dump(m)) for m in history]
+        self.size = sum(self.sizes)
+        self.version = 0
+        self.flushed_version = 0
+        # Нужна полная перезапись, а не дописывание
+        self.replace = False
+
+    @property
+    def dirty(self):
+        return self.version != self.flushed_version
+
+
+class CachedStorage(ChatStorage):
+    """LRU-кэш активных историй в памяти с отложенной записью в нижележащее хранилище"""
+
+    def __init__(self, backend, max_entries=256, max_bytes=64 * 1024 * 1024, flush_interval=2.0):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()
+        # Вытесненные из кэша, но еще не записанные истории
+        self._evicted = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        # Запись на диск выполняется строго по одному чату за раз
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name='history-flusher', daemon=True)
+        self._flusher.start()
+
+    def load_history(self, chat_id):
+        with self._lock:
+            entry = self._entries.get(chat_id) or self._evicted.get(chat_id)
+            if entry is not None:
+                self._touch(chat_id, entry)
+                # Копия списка: несохраненные изменения обработчика не должны попасть в кэш
+                return list(entry.history)
+
+        history = self.backend.load_history(chat_id)
+        if history is None:
+            return None
+        with self._lock:
+            # Пока читали с диска, история могла появиться в кэше
+            if chat_id not in self._entries:
+                self._insert(chat_id, _CacheEntry(history))
+        return list(history)
+
+    def save_history(self, chat_id, history):
+        self._store(chat_id, history, replace=False)
+
+    def replace_history(self, chat_id, history):
+        self._store(chat_id, history, replace=True)
+
+    def _store(self, chat_id, history, replace):
+        with self._lock:
+            entry = self._entries.get(chat_id) or self._evicted.get(chat_id)
+            if entry is None:
+                entry = _CacheEntry(list(history))
+            else:
+                self._size -= entry.size if chat_id in self._entries else 0
+                if not replace and history[:len(entry.history)] != entry.history:
+                    # История изменилась не только дописыванием (например, ее сжали, пока
+                    # обработчик ждал ответа модели) - дописать новые сообщения нельзя
+                    replace = True
+                if replace:
+                    entry.sizes = [len(_dump(m)) for m in history]
+                else:
+                    # Размер считаем только для новых сообщений
+                    entry.sizes = entry.sizes + [len(_dump(m)) for m in history[len(entry.sizes):]]
+                entry.size = sum(entry.sizes)
+                entry.history = list(history)
+            entry.version += 1
+            entry.replace = entry.replace or replace
+            self._entries.pop(chat_id, None)
+            self._evicted.pop(chat_id, None)
+            self._insert(chat_id, entry)
+
+    def clear_history(self, chat_id):
+        with self._write_lock:
+            with self._lock:
+                entry = self._entries.pop(chat_id, None)
+                if entry is not None:
+                    self._size -= entry.size
+                self._evicted.pop(chat_id, None)
+            self.backend.clear_history(chat_id)
+
+    def chat_ids(self):
+        with self._lock:
+            cached = set(self._entries) | set(self._evicted)
+        return sorted(cached | set(self.backend.chat_ids()))
+
+    def read_history(self, chat_id):
+        with self._lock:
+            entry = self._entries.get(chat_id) or self._evicted.get(chat_id)
+            if entry is not None:
+                return list(entry.history)
+        return self.backend.read_history(chat_id)
+
+    def histories(self, skip=()):
+        """Истории из памяти (в том числе еще не записанные), остальные - из нижележащего хранилища.
+
+        Чаты из кэша с диска не читаются: их файлы может в это время дописывать поток
+        записи. Прочитанные с диска истории не попадают в кэш и не вытесняют активные чаты.
+        """
+        with self._lock:
+            cached = {chat_id: list(entry.history)
+                      for chat_id, entry in list(self._evicted.items()) + list(self._entries.items())
+                      if chat_id not in skip}
+        yield from cached.items()
+        yield from self.backend.histories(skip=set(skip) | set(cached))
+
+    def get_setting(self, chat_id, key, default=None):
+        return self.backend.get_setting(chat_id, key, default)
+
+    def set_setting(self, chat_id, key, value):
+        self.backend.set_setting(chat_id, key, value)
+
+    def _touch(self, chat_id, entry):
+        if chat_id in self._entries:
+            self._entries.move_to_end(chat_id)
+
+    def _insert(self, chat_id, entry):
+        self._entries[chat_id] = entry
+        self._size += entry.size
+        # Вытесняем самые давние чаты; последний добавленный остается даже если он больше лимита
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or self._size > self.max_bytes):
+            old_id, old_entry = self._entries.popitem(last=False)
+            self._size -= old_entry.size
+            if old_entry.dirty:
+                self._evicted[old_id] = old_entry
+                self._wakeup.set()
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.error("history_flush_failed", error=e)
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                dirty = [(chat_id, entry) for chat_id, entry in
+                         list(self._evicted.items()) + list(self._entries.items()) if entry.dirty]
+
+            for chat_id, entry in dirty:
+                with self._lock:
+                    history, version, replace = entry.history, entry.version, entry.replace
+                try:
+                    if replace:
+                        self.backend.replace_history(chat_id, history)
+                    else:
+                        self.backend.save_history(chat_id, history)
+                except Exception as e:
+                    log.error("history_save_failed", chat_id=chat_id, error=e)
+                    continue
+                with self._lock:
+                    entry.flushed_version = version
+                    if entry.version == version:
+                        entry.replace = False
+                    if not entry.dirty and self._evicted.get(chat_id) is entry:
+                        del self._evicted[chat_id]
+
+            self.backend.flush()
+
+    def close(self):
+        self._stop.set()
+        self._wakeup.set()
+        self._flusher.join(timeout=10)
+        self.flush()
+        self.backend.close()
+
+
+def create_storage(backend, directory, shared_settings=False):
+    """Создать хранилище по имени бэкенда: json, jsonl или sqlite.
+
+    shared_settings - с директорией работают несколько процессов: настройки файловых
+    бэкендов хранятся в settings.db (у sqlite они и так в общей базе). Если settings.db
+    уже есть, настройки читаются из нее и без shared_settings: перенос из settings.json
+    выполняется один раз, и после возврата к одному процессу settings.json устарел.
+    """
+    directory = Path(directory)
+    if backend == 'json':
+        storage = JsonFileStorage(directory)
+    elif backend == 'jsonl':
+        storage = AppendOnlyStorage(directory)
+    elif backend == 'sqlite':
+        return SQLiteStorage(directory / 'chats.db')
+    else:
+        raise ValueError(f"Неизвестный бэкенд хранилища: {backend}")
+    settings_db = directory / 'settings.db'
+    if not shared_settings and settings_db.exists():
+        log.info("shared_settings_kept", path=settings_db)
+        shared_settings = True
+    if shared_settings:
+        return SharedSettingsStorage(storage, settings_db, legacy_path=directory / 'settings.json')
+    return storage
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Преобразование Markdown из ответов модели в HTML для Telegram.
+
+Модель пишет обычный Markdown (**жирный**, `код`, блоки ```, заголовки,
+списки, ссылки), а Telegram в режиме Markdown отклоняет сообщение при
+любой непарной звездочке или подчеркивании. Здесь ответ один раз
+переводится в HTML с теми тегами, которые поддерживает Telegram: все
+остальное экранируется, а разметка, которую нельзя вложить корректно,
+остается обычным текстом. Поэтому каждое сообщение принимается с первой
+попытки.
+
+Длинный ответ режется на части не длиннее лимита Telegram по границам
+строк. Блок кода, который не помещается в одну часть, делится по строкам,
+и каждая часть остается закрытым блоком <pre>.
+"""
+
+import re
+import html
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+FENCE = re.compile(r"^\s*```\s*([\w+#.-]*)\s*$")
+HEADING = re.compile(r"^#{1,6}\s+(.*?)\s*#*\s*$")
+BULLET = re.compile(r"^(\s*)[-*+]\s+(.*)$")
+QUOTE = re.compile(r"^>\s?(.*)$")
+RULE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+
+INLINE_CODE = re.compile(r"(`+)(.+?)\1")
+LINK = re.compile(r"\[([^\[\]]+)\]\(((?:https?|tg|mailto):[^\s()]+(?:\([^\s()]*\))?[^\s()]*)\)")
+# Порядок важен: ** и __ раньше одиночных * и _
+INLINE_STYLES = (
+    (re.compile(r"\*\*(?=\S)(.+?)(?<=\S)\*\*"), "b"),
+    (re.compile(r"(?<!\w)__(?=\S)(.+?)(?<=\S)__(?!\w)"), "b"),
+    (re.compile(r"~~(?=\S)(.+?)(?<=\S)~~"), "s"),
+    (re.compile(r"\|\|(?=\S)(.+?)(?<=\S)\|\|"), "tg-spoiler"),
+    (re.compile(r"(?<![\w*])\*(?=[^\s*])(.+?)(?<=[^\s*])\*(?![\w*])"), "i"),
+    (re.compile(r"(?<!\w)_(?=[^\s_])(.+?)(?<=[^\s_])_(?!\w)"), "i"),
+)
+TAG = re.compile(r"<(/?)([\w-]+)[^>]*>")
+# Вставки (код, ссылки) до подстановки стилей заменяются метками, чтобы стили их не трогали
+PLACEHOLDER = "\x00{}\x00"
+PLACEHOLDER_PATTERN = re.compile(r"\x00(\d+)\x00")
+
+HORIZONTAL_RULE = "──────────"
+
+
+def escape(text):
+    return html.escape(text, quote=False)
+
+
+def message_length(text):
+    """Длина в единицах UTF-16, как ее считает Telegram"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _balanced(fragment):
+    """Теги во фрагменте закрываются в порядке открытия"""
+    stack = []
+    for closing, name in TAG.findall(fragment):
+        if not closing:
+            stack.append(name)
+        elif not stack or stack.pop() != name:
+            return False
+    return not stack
+
+
+def render_inline(text):
+    """HTML для одной строки Markdown"""
+    return _render_inline(text.replace("\x00", ""), [])
+
+
+def _render_inline(text, inserts):
+    # inserts общий с внешним вызовом: в тексте ссылки могут быть метки вставок строки (код)
+
+    def keep(fragment):
+        inserts.append(fragment)
+        return PLACEHOLDER.format(len(inserts) - 1)
+
+    text = INLINE_CODE.sub(lambda m: keep(f"<code>{escape(m.group(2).strip())}</code>"), text)
+    text = LINK.sub(lambda m: keep(
+        f'<a href="{html.escape(m.group(2))}">{_render_inline(m.group(1), inserts)}</a>'), text)
+    text = escape(text)
+
+    for pattern, tag in INLINE_STYLES:
+        def wrap(match, tag=tag):
+            inner = match.group(1)
+            # Стиль, который пересекается с другим, оставляем как есть
+            if not _balanced(inner):
+                return match.group(0)
+            return f"<{tag}>{inner}</{tag}>"
+        text = pattern.sub(wrap, text)
+
+    return PLACEHOLDER_PATTERN.sub(lambda m: inserts[int(m.group(1))], text)
+
+
+def parse_blocks(text):
+    """Блоки ответа: ("code", язык, строки), ("quote", строки) и ("line", строка)"""
+    blocks = []
+    lines = text.replace("\r\n", "\n").split("\n")
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        fence = FENCE.match(line)
+        if fence:
+            code = []
+            index += 1
+            # Незакрытый блок (ответ оборвался) продолжается до конца текста
+            while index < len(lines) and not FENCE.match(lines[index]):
+                code.append(lines[index])
+                index += 1
+            blocks.append(("code", fence.group(1), code))
+            index += 1
+            continue
+        if QUOTE.match(line):
+            quote = []
+            while index < len(lines) and QUOTE.match(lines[index]):
+                quote.append(QUOTE.match(lines[index]).group(1))
+                index += 1
+            blocks.append(("quote", quote))
+            continue
+        blocks.append(("line", line))
+        index += 1
+    return blocks
+
+
+def _render_line(line):
+    if RULE.match(line):
+        return HORIZONTAL_RULE
+    heading = HEADING.match(line)
+    if heading:
+        return f"<b>{render_inline(heading.group(1))}</b>"
+    bullet = BULLET.match(line)
+    if bullet:
+        return f"{bullet.group(1)}• {render_inline(bullet.group(2))}"
+    return render_inline(line)
+
+
+def render_block(block):
+    kind = block[0]
+    if kind == "code":
+        _, language, lines = block
+        code = escape("\n".join(lines))
+        if language:
+            return f'<pre><code class="language-{escape(language)}">{code}</code></pre>'
+        return f"<pre>{code}</pre>"
+    if kind == "quote":
+        return "<blockquote>" + "\n".join(_render_line(line) for line in block[1]) + "</blockquote>"
+    return _render_line(block[1])
+
+
+def _fit(text, render, limit):
+    """Длина самого длинного начала text (по возможности до пробела), которое после render помещается в limit"""
+    size = min(len(text), limit)
+    while size > 1 and message_length(render(text[:size])) > limit:
+        size = size * 9 // 10
+    if size < len(text):
+        space = text.rfind(" ", 0, size)
+        if space > size // 2:
+            size = space
+    return max(size, 1)
+
+
+def _split_text(text, render, limit):
+    """Разрезать строку на куски, каждый из которых после render помещается в limit"""
+    pieces = []
+    while text:
+        size = _fit(text, render, limit)
+        pieces.append(text[:size])
+        text = text[size:].lstrip(" ")
+    return pieces
+
+
+def split_block(block, limit):
+    """Разбить блок, не помещающийся в limit, на меньшие блоки того же вида"""
+    kind = block[0]
+    if kind == "line":
+        return [("line", piece) for piece in _split_text(block[1], _render_line, limit)]
+
+    if kind == "code":
+        make = lambda lines: ("code", block[1], lines)
+        lines = block[2]
+    else:
+        make = lambda lines: ("quote", lines)
+        lines = block[1]
+
+    # Строки, которые не помещаются даже поодиночке, режем на куски
+    parts = []
+    for line in lines:
+        if message_length(render_block(make([line]))) <= limit:
+            parts.append(line)
+        else:
+            parts.extend(_split_text(line, lambda piece: render_block(make([piece])), limit))
+
+    groups = []
+    current = []
+    for line in parts:
+        if current and message_length(render_block(make(current + [line]))) > limit:
+            groups.append(make(current))
+            current = []
+        current.append(line)
+    if current:
+        groups.append(make(current))
+    return groups
+
+
+def render_chunks(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """HTML-части ответа для отправки с parse_mode='HTML', каждая не длиннее limit"""
+    rendered = []
+    for block in parse_blocks(text or ""):
+        fragment = render_block(block)
+        if message_length(fragment) <= limit:
+            rendered.append(fragment)
+        else:
+            rendered.extend(render_block(part) for part in split_block(block, limit))
+
+    chunks = []
+    current = []
+    length = 0
+    for fragment in rendered:
+        size = message_length(fragment)
+        # +1 - перевод строки между фрагментами
+        if current and length + 1 + size > limit:
+            chunks.append("\n".join(current))
+            current = []
+            length = 0
+        length += size + (1 if current else 0)
+        current.append(fragment)
+    if current:
+        chunks.append("\n".join(current))
+
+    chunks = [chunk.strip("\n") for chunk in chunks]
+    return [chunk for chunk in chunks if chunk.strip()]
+
+
+def html_to_text(fragment):
+    """Текст HTML-части без разметки (если Telegram все же не принял HTML)"""
+    return html.unescape(TAG.sub("", fragment))
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Тесты TokenBucket и AdmissionControl"""
+
+import pytest
+
+import admission
+from admission import (ADMITTED, CHAT_RATE, DENIED, KIND_IMAGE, KIND_PHOTO, KIND_TEXT, USER_RATE,
+                       AdmissionControl, TokenBucket)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Управляемое время admission.time.monotonic(): clock[0] - текущее значение"""
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_bucket_refill_is_capped():
+    bucket = TokenBucket(rate=1.0, burst=5, now=0.0)
+    bucket.take(5)
+    bucket.refill(2.0)
+    assert bucket.tokens == 2.0
+    bucket.refill(100.0)
+    assert bucket.tokens == 5
+
+
+def test_bucket_cost_above_burst_needs_full_bucket():
+    bucket = TokenBucket(rate=1.0, burst=3, now=0.0)
+    assert bucket.can_take(10)
+    bucket.take(10)
+    assert bucket.tokens == 0
+    bucket.refill(2.0)
+    assert not bucket.can_take(10)
+    bucket.refill(3.0)
+    assert bucket.can_take(10)
+
+
+def test_user_rate_limit_and_refill(clock):
+    control = AdmissionControl(lambda user_id: True, user_rate=60, user_burst=3, chat_rate=0)
+    assert [control.admit(1, 1, KIND_TEXT) for _ in range(4)] == [ADMITTED] * 3 + [USER_RATE]
+    # Другой пользователь со своей корзиной
+    assert control.admit(2, 1, KIND_TEXT) == ADMITTED
+    # 60 в минуту - токен в секунду
+    clock[0] += 1
+    assert control.admit(1, 1, KIND_TEXT) == ADMITTED
+    assert control.admit(1, 1, KIND_TEXT) == USER_RATE
+
+
+def test_chat_rate_limit(clock):
+    control = AdmissionControl(lambda user_id: True, user_rate=0, chat_rate=60, chat_burst=2)
+    assert control.admit(1, 100, KIND_TEXT) == ADMITTED
+    assert control.admit(2, 100, KIND_TEXT) == ADMITTED
+    assert control.admit(3, 100, KIND_TEXT) == CHAT_RATE
+    assert control.admit(3, 200, KIND_TEXT) == ADMITTED
+
+
+def test_rejected_update_does_not_spend_tokens(clock):
+    control = AdmissionControl(lambda user_id: True, user_rate=60, user_burst=10, chat_rate=60, chat_burst=1)
+    assert control.admit(1, 100, KIND_TEXT) == ADMITTED
+    for _ in range(5):
+        assert control.admit(1, 100, KIND_TEXT) == CHAT_RATE
+    # Корзина пользователя не тратилась на отказы по лимиту чата
+    assert [control.admit(1, chat_id, KIND_TEXT) for chat_id in range(9)] == [ADMITTED] * 9
+
+
+def test_costs_by_kind(clock):
+    control = AdmissionControl(lambda user_id: True, user_rate=60, user_burst=10, chat_rate=0,
+                               costs={KIND_PHOTO: 4, KIND_IMAGE: 10})
+    assert control.admit(1, 1, KIND_PHOTO) == ADMITTED
+    assert control.admit(1, 1, KIND_IMAGE) == USER_RATE
+    assert control.admit(1, 1, KIND_PHOTO) == ADMITTED
+    assert control.admit(1, 1, KIND_TEXT) == ADMITTED
+    assert control.admit(1, 1, KIND_PHOTO) == USER_RATE
+
+
+def test_whitelist(clock):
+    control = AdmissionControl(lambda user_id: user_id == 1)
+    assert control.admit(1, 1, KIND_TEXT) == ADMITTED
+    assert control.admit(2, 2, KIND_TEXT) == DENIED
+    stats = control.stats()
+    assert stats["admitted"] == {KIND_TEXT: 1}
+    assert stats["shed"] == {DENIED: 1}
+
+
+def test_should_notify_interval(clock):
+    control = AdmissionControl(lambda user_id: True, notice_interval=60)
+    assert control.should_notify(1, USER_RATE)
+    assert not control.should_notify(1, USER_RATE)
+    assert control.should_notify(1, DENIED)
+    clock[0] += 61
+    assert control.should_notify(1, USER_RATE)
+    stats = control.stats()
+    assert stats["notices_sent"] == 3
+    assert stats["notices_suppressed"] == 1
+
+
+def test_tracked_keys_are_bounded(clock):
+    control = AdmissionControl(lambda user_id: True, max_keys=100)
+    for user_id in range(1000):
+        control.admit(user_id, user_id, KIND_TEXT)
+    stats = control.stats()
+    assert stats["tracked_users"] == 100
+    assert stats["tracked_chats"] == 100
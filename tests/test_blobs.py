@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""Тесты удаления неиспользуемых вложений"""
+
+import os
+import time
+
+from blobs import BlobCollector, BlobStore, history_refs, make_tool_message
+from storage import AppendOnlyStorage, CachedStorage
+
+
+def age(store, ref, seconds):
+    """Сдвинуть время последнего использования данных в прошлое"""
+    path = store._path(ref)
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def image_message(ref):
+    return {"role": "user", "content": [{"type": "text", "text": "фото"},
+                                        {"type": "image_url", "image_url": {"url": ref, "detail": "low"}}]}
+
+
+def test_history_refs():
+    ref = "blob:" + "a" * 64 + ".jpg"
+    tool = {"role": "tool", "tool_call_id": "c1", "content": "…", "content_ref": "blob:b.txt"}
+    history = [{"role": "system", "content": "s"}, image_message(ref), tool,
+               {"role": "assistant", "content": "blob:not-a-ref-in-text"}]
+    assert list(history_refs(history)) == [ref, "blob:b.txt"]
+
+
+def test_collect_removes_only_unreferenced_old_blobs(tmp_path):
+    store = BlobStore(tmp_path / "blobs")
+    live = store.put(b"live", "jpg")
+    dead = store.put(b"dead", "jpg")
+    fresh = store.put(b"fresh", "jpg")
+    age(store, live, 7200)
+    age(store, dead, 7200)
+    assert store.collect({live}, min_age=3600) == (1, 4)
+    assert store.exists(live) and store.exists(fresh)
+    assert not store.exists(dead)
+
+
+def test_put_and_touch_refresh_usage(tmp_path):
+    store = BlobStore(tmp_path / "blobs")
+    first = store.put(b"data", "jpg")
+    age(store, first, 7200)
+    # То же содержимое сохранено повторно: ссылка на него может быть еще не в истории
+    assert store.put(b"data", "jpg") == first
+    assert store.collect(set(), min_age=3600) == (0, 0)
+    age(store, first, 7200)
+    assert store.touch(first)
+    assert store.collect(set(), min_age=3600) == (0, 0)
+    assert not store.touch("blob:missing.jpg")
+
+
+def test_collector_keeps_blobs_of_unsaved_histories(tmp_path):
+    store = BlobStore(tmp_path / "blobs")
+    storage = CachedStorage(AppendOnlyStorage(tmp_path), flush_interval=60)
+    saved = store.put(b"saved", "jpg")
+    cached = store.put(b"cached", "jpg")
+    cleared = store.put(b"cleared", "jpg")
+    tool = make_tool_message(store, "c1", "результат " * 100, inline_limit=10)
+    for ref in (saved, cached, cleared, tool["content_ref"]):
+        age(store, ref, 7200)
+
+    storage.save_history(1, [image_message(saved), tool])
+    storage.flush()
+    # История чата 2 пока только в памяти
+    storage.save_history(2, [image_message(cached)])
+    storage.save_history(3, [image_message(cleared)])
+    storage.clear_history(3)
+
+    def live_refs():
+        return {ref for _, history in storage.histories() for ref in history_refs(history)}
+
+    collector = BlobCollector(store, live_refs, interval=0, min_age=3600)
+    collector.collect()
+    assert [store.exists(ref) for ref in (saved, cached, cleared, tool["content_ref"])] == [True, True, False, True]
+    assert collector.stats()["removed"] == 1
+    storage.close()
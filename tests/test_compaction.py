@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Тесты сжатия истории: разбиение истории и проверка префикса перед заменой"""
+
+from compaction import HistoryCompactor, is_summary, make_summary_message, split_history
+from storage import AppendOnlyStorage
+
+SYSTEM = {"role": "system", "content": "s"}
+
+
+def turn(i):
+    return [{"role": "user", "content": f"вопрос {i}"}, {"role": "assistant", "content": f"ответ {i}"}]
+
+
+def history_of(turns, start=0):
+    return [SYSTEM] + [message for i in range(start, start + turns) for message in turn(i)]
+
+
+def test_split_history_keeps_recent_turns():
+    history = history_of(5)
+    system, old, replaced = split_history(history, keep_turns=2)
+    assert system == [SYSTEM]
+    assert old == history[1:7]
+    assert replaced == 7
+    assert history[replaced:] == turn(3) + turn(4)
+
+
+def test_split_history_short_history():
+    assert split_history(history_of(2), keep_turns=2) == ([SYSTEM], [], 0)
+
+
+def test_split_history_includes_previous_summary():
+    summary = make_summary_message("раньше")
+    history = [SYSTEM, summary] + history_of(4)[1:]
+    system, old, replaced = split_history(history, keep_turns=1)
+    assert system == [SYSTEM]
+    assert old[0] is summary
+    assert replaced == 2 + 6
+
+
+def test_tool_calls_stay_in_their_turn():
+    call = {"role": "assistant", "content": None,
+            "tool_calls": [{"id": "c1", "type": "function", "function": {"name": "f", "arguments": "{}"}}]}
+    history = history_of(2) + [{"role": "user", "content": "ищи"}, call,
+                               {"role": "tool", "tool_call_id": "c1", "content": "r"},
+                               {"role": "assistant", "content": "нашел"}]
+    _, _, replaced = split_history(history, keep_turns=1)
+    assert history[replaced:] == history[-4:]
+
+
+def make_compactor(tmp_path, swaps):
+    storage = AppendOnlyStorage(tmp_path)
+    # max_turns ниже числа ходов: порог по токенам не проверяется
+    compactor = HistoryCompactor(storage, lambda messages: f"пересказ {len(messages)}",
+                                 lambda chat_id, swap: swaps.append(swap),
+                                 max_turns=3, keep_turns=2)
+    return storage, compactor
+
+
+def test_compact_replaces_old_turns(tmp_path):
+    swaps = []
+    storage, compactor = make_compactor(tmp_path, swaps)
+    storage.save_history(1, history_of(5))
+    compactor.compact(1)
+    # Пока swap ждет в очереди чата, обработчик дописал ход
+    storage.save_history(1, history_of(6))
+    swaps.pop()()
+    history = storage.load_history(1)
+    assert history[0] == SYSTEM
+    assert is_summary(history[1]) and history[1]["content"].endswith("пересказ 6")
+    assert history[2:] == turn(3) + turn(4) + turn(5)
+    assert compactor.stats()["compacted"] == 1
+
+
+def test_swap_skipped_when_history_changed(tmp_path):
+    swaps = []
+    storage, compactor = make_compactor(tmp_path, swaps)
+    storage.save_history(1, history_of(5))
+    compactor.compact(1)
+    # /new и новые сообщения: пересказанная часть истории уже другая
+    storage.clear_history(1)
+    new_history = history_of(5, start=10)
+    storage.save_history(1, new_history)
+    swaps.pop()()
+    assert storage.load_history(1) == new_history
+    assert compactor.stats()["skipped"] == 1
+
+
+def test_schedule_disabled_without_apply(tmp_path):
+    compactor = HistoryCompactor(AppendOnlyStorage(tmp_path), lambda messages: "", None, max_turns=3, keep_turns=2)
+    assert not compactor.schedule(1, history_of(5))
+    compactor.apply = lambda chat_id, swap: None
+    assert not compactor.schedule(1, history_of(2))
+    assert compactor.schedule(1, history_of(5))
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Тесты ChatDispatcher и AsyncChatDispatcher: порядок задач чата и лимиты очередей"""
+
+import asyncio
+import threading
+
+from dispatcher import AsyncChatDispatcher, ChatDispatcher
+
+
+def test_chat_tasks_run_in_order():
+    dispatcher = ChatDispatcher(workers=4, max_chat_queue=50)
+    done = {1: [], 2: []}
+    for i in range(50):
+        for chat_id in done:
+            assert dispatcher.submit(chat_id, done[chat_id].append, i)
+    dispatcher.shutdown(timeout=10)
+    assert done == {1: list(range(50)), 2: list(range(50))}
+    assert dispatcher.stats()["completed"] == 100
+
+
+def test_chats_run_in_parallel():
+    dispatcher = ChatDispatcher(workers=2)
+    started = threading.Barrier(2, timeout=5)
+    # Обе задачи ждут друг друга: пройдут, только если выполняются одновременно
+    for chat_id in (1, 2):
+        dispatcher.submit(chat_id, started.wait)
+    dispatcher.shutdown(timeout=10)
+    assert dispatcher.stats()["failed"] == 0
+
+
+def test_chat_queue_limit():
+    dispatcher = ChatDispatcher(workers=1, max_chat_queue=2)
+    release = threading.Event()
+    assert dispatcher.submit(1, release.wait)
+    assert dispatcher.submit(1, release.wait)
+    assert not dispatcher.submit(1, release.wait)
+    # Лимит действует на чат, а не на весь диспетчер
+    assert dispatcher.submit(2, release.wait)
+    release.set()
+    dispatcher.shutdown(timeout=10)
+    stats = dispatcher.stats()
+    assert stats["rejected"] == 1
+    assert stats["completed"] == 3
+
+
+def test_failed_task_does_not_stop_chat():
+    dispatcher = ChatDispatcher(workers=1)
+    done = []
+    dispatcher.submit(1, lambda: 1 / 0)
+    dispatcher.submit(1, done.append, "next")
+    dispatcher.shutdown(timeout=10)
+    assert done == ["next"]
+    assert dispatcher.stats()["failed"] == 1
+
+
+def test_submit_after_shutdown_is_rejected():
+    dispatcher = ChatDispatcher(workers=1)
+    dispatcher.shutdown(timeout=10)
+    assert not dispatcher.submit(1, print)
+
+
+def test_async_chat_tasks_run_in_order():
+    async def scenario():
+        dispatcher = AsyncChatDispatcher()
+        done = {1: [], 2: []}
+
+        async def task(chat_id, i):
+            await asyncio.sleep(0)
+            done[chat_id].append(i)
+
+        for i in range(10):
+            for chat_id in done:
+                assert await dispatcher.submit(chat_id, task, chat_id, i)
+        await dispatcher.shutdown(timeout=10)
+        return done, dispatcher.stats()
+
+    done, stats = asyncio.run(scenario())
+    assert done == {1: list(range(10)), 2: list(range(10))}
+    assert stats["completed"] == 20
+    assert stats["chats"] == 0
+
+
+def test_async_chat_queue_limit():
+    async def scenario():
+        dispatcher = AsyncChatDispatcher(max_chat_queue=2)
+        release = asyncio.Event()
+        # Первая задача сразу уходит в работу и место в очереди чата не занимает
+        assert await dispatcher.submit(1, release.wait)
+        await asyncio.sleep(0)
+        results = [await dispatcher.submit(1, release.wait) for _ in range(3)]
+        other = await dispatcher.submit(2, release.wait)
+        release.set()
+        await dispatcher.shutdown(timeout=10)
+        return results, other, dispatcher.stats()
+
+    results, other, stats = asyncio.run(scenario())
+    assert results == [True, True, False]
+    assert other
+    assert stats["rejected"] == 1
+    assert stats["completed"] == 4
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Тесты очередей долгих задач: лимиты, место в очереди, порядок"""
+
+import asyncio
+import threading
+
+import pytest
+
+from jobs import QUEUE_FULL, USER_LIMIT, AsyncJobQueue, JobQueue, JobRejected
+
+
+def test_job_queue_limits_and_positions():
+    queue = JobQueue(workers=1, max_pending=1, max_per_user=1)
+    release = threading.Event()
+    started = threading.Event()
+    positions = []
+
+    def first():
+        started.set()
+        release.wait(5)
+
+    assert queue.submit(1, first) == 0
+    started.wait(5)
+    with pytest.raises(JobRejected) as rejected:
+        queue.submit(1, print)
+    assert rejected.value.reason == USER_LIMIT
+    assert queue.submit(2, print, on_position=positions.append) == 1
+    with pytest.raises(JobRejected) as rejected:
+        queue.submit(3, print)
+    assert rejected.value.reason == QUEUE_FULL
+    release.set()
+    queue.shutdown(timeout=5)
+    assert positions == [1]
+    assert queue.stats()["completed"] == 2
+
+
+def test_async_job_queue():
+    async def scenario():
+        queue = AsyncJobQueue(workers=1, max_pending=2, max_per_user=1)
+        release = asyncio.Event()
+        done = []
+        positions = {}
+
+        async def job(name):
+            await release.wait()
+            done.append(name)
+
+        def show(user):
+            async def on_position(position):
+                positions.setdefault(user, []).append(position)
+            return on_position
+
+        # Первая задача сразу достается свободному исполнителю и места в очереди не занимает
+        assert [queue.submit(user, job, user, on_position=show(user)) for user in (1, 2)] == [0, 1]
+        with pytest.raises(JobRejected) as rejected:
+            queue.submit(1, job, 1)
+        assert rejected.value.reason == USER_LIMIT
+        assert queue.submit(3, job, 3, on_position=show(3)) == 2
+        with pytest.raises(JobRejected) as rejected:
+            queue.submit(4, job, 4)
+        assert rejected.value.reason == QUEUE_FULL
+        await asyncio.sleep(0.01)
+        release.set()
+        await queue.shutdown(timeout=5)
+        return done, positions, queue.stats()
+
+    done, positions, stats = asyncio.run(scenario())
+    assert done == [1, 2, 3]
+    assert positions == {2: [1], 3: [2, 1]}
+    assert stats["completed"] == 3
+    assert stats["rejected"] == 2
+
+
+def test_async_job_failure_is_counted():
+    async def scenario():
+        queue = AsyncJobQueue(workers=1)
+
+        async def fail():
+            raise RuntimeError("boom")
+
+        queue.submit(1, fail)
+        await queue.shutdown(timeout=5)
+        return queue.stats()
+
+    assert asyncio.run(scenario())["failed"] == 1
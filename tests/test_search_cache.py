@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""Тесты категорий поисковых запросов и сравнения запросов упреждающего поиска"""
+
+import pytest
+
+from prefetch import query_similarity, search_intent
+from search_cache import CATEGORY_TTLS, normalize_query, query_category
+
+
+@pytest.mark.parametrize("query, category", [
+    ("курс доллара сегодня", "prices"),
+    ("Сколько стоит iPhone 16?", "prices"),
+    ("bitcoin price", "prices"),
+    ("USD THB exchange rate", "prices"),
+    ("последние новости", "news"),
+    ("счет матча Зенит", "news"),
+    ("погода в Бангкоке", "weather"),
+    ("current weather Bangkok", "weather"),
+    ("будет ли дождь завтра", "weather"),
+    ("какое сегодня число", "dates"),
+    ("расписание электричек", "dates"),
+    # Слова, которые начинаются так же, как слова категорий
+    ("ценность дружбы", "default"),
+    ("курсор мыши пропал", "default"),
+    ("курсовая работа", "default"),
+    ("rated movies", "default"),
+    ("rainbow six", "default"),
+    ("costume ideas", "default"),
+    ("ethics of AI", "default"),
+    ("how to live", "default"),
+])
+def test_query_category(query, category):
+    assert query_category(query) == category
+    assert category in CATEGORY_TTLS
+
+
+def test_prefetch_uses_same_categories():
+    assert search_intent("Курс биткоина") == "prices"
+    assert search_intent("что такое курсор") is None
+    assert search_intent("погода " + "x" * 300) is None
+
+
+def test_query_similarity():
+    assert query_similarity("Какая погода в Бангкоке сегодня?", "current weather Bangkok") == 1.0
+    assert query_similarity("Какая погода в Бангкоке сегодня?", "Bangkok hotels prices") < 0.5
+    assert query_similarity("привет", "") == 0.0
+
+
+def test_normalize_query():
+    assert normalize_query("  Погода,   в МОСКВЕ?! ") == "погода в москве"
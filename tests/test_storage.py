@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Тесты хранилищ истории: сохранение и чтение после перезапуска, replace_history"""
+
+import json
+import threading
+
+import pytest
+
+from storage import AppendOnlyStorage, CachedStorage, SQLiteStorage, create_storage
+
+BACKENDS = ["json", "jsonl", "sqlite"]
+
+
+def message(role, content):
+    return {"role": role, "content": content}
+
+
+HISTORY = [message("system", "s"), message("user", "привет"), message("assistant", "ответ")]
+
+
+def reopen(storage, backend, directory):
+    storage.close()
+    return create_storage(backend, directory)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_round_trip(tmp_path, backend):
+    storage = create_storage(backend, tmp_path)
+    assert storage.load_history(1) is None
+    storage.save_history(1, HISTORY[:2])
+    storage.save_history(1, HISTORY)
+    storage.save_history(2, HISTORY[:1])
+    storage = reopen(storage, backend, tmp_path)
+    assert storage.load_history(1) == HISTORY
+    assert storage.load_history(2) == HISTORY[:1]
+    storage.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_replace_changes_saved_messages(tmp_path, backend):
+    storage = create_storage(backend, tmp_path)
+    storage.save_history(1, HISTORY)
+    # Сжатие: первые сообщения заменены сводкой, длина та же
+    compacted = [HISTORY[0], message("system", "сводка"), HISTORY[2]]
+    storage.replace_history(1, compacted)
+    storage.save_history(1, compacted + [message("user", "еще")])
+    storage = reopen(storage, backend, tmp_path)
+    assert storage.load_history(1) == compacted + [message("user", "еще")]
+    storage.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_shorter_history_is_replaced(tmp_path, backend):
+    storage = create_storage(backend, tmp_path)
+    storage.save_history(1, HISTORY)
+    storage.save_history(1, HISTORY[:1])
+    storage = reopen(storage, backend, tmp_path)
+    assert storage.load_history(1) == HISTORY[:1]
+    storage.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_clear_and_settings(tmp_path, backend):
+    storage = create_storage(backend, tmp_path)
+    storage.save_history(1, HISTORY)
+    storage.set_setting(1, "model", "gpt")
+    storage.clear_history(1)
+    storage.save_history(1, HISTORY[:1])
+    storage = reopen(storage, backend, tmp_path)
+    assert storage.load_history(1) == HISTORY[:1]
+    assert storage.get_setting(1, "model") == "gpt"
+    assert storage.get_setting(2, "model", "default") == "default"
+    storage.close()
+
+
+def test_jsonl_appends_only_new_messages(tmp_path):
+    storage = AppendOnlyStorage(tmp_path)
+    storage.save_history(1, HISTORY[:2])
+    path = tmp_path / "chat_1.jsonl"
+    before = path.read_bytes()
+    storage.save_history(1, HISTORY)
+    assert path.read_bytes().startswith(before)
+    assert len(path.read_text(encoding="utf-8").splitlines()) == 3
+
+
+def test_jsonl_damaged_tail(tmp_path):
+    storage = AppendOnlyStorage(tmp_path)
+    storage.save_history(1, HISTORY)
+    with open(tmp_path / "chat_1.jsonl", "a", encoding="utf-8") as f:
+        f.write('{"role": "user", "cont')
+    storage = AppendOnlyStorage(tmp_path)
+    assert storage.load_history(1) == HISTORY
+    # Поврежденная строка удалена, и следующее сообщение дописывается с новой строки
+    storage.save_history(1, HISTORY + [message("user", "еще")])
+    assert AppendOnlyStorage(tmp_path).load_history(1) == HISTORY + [message("user", "еще")]
+
+
+def test_jsonl_migrates_legacy_json(tmp_path):
+    (tmp_path / "chat_1.json").write_text(json.dumps(HISTORY), encoding="utf-8")
+    storage = AppendOnlyStorage(tmp_path)
+    assert storage.load_history(1) == HISTORY
+    assert not (tmp_path / "chat_1.json").exists()
+    assert AppendOnlyStorage(tmp_path).load_history(1) == HISTORY
+
+
+def test_sqlite_batched_commit_is_flushed_on_close(tmp_path):
+    storage = SQLiteStorage(tmp_path / "chats.db", commit_interval=60)
+    storage.save_history(1, HISTORY[:1])
+    storage.save_history(1, HISTORY)
+    storage.close()
+    storage = SQLiteStorage(tmp_path / "chats.db")
+    assert storage.load_history(1) == HISTORY
+    storage.close()
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_cached_storage_writes_behind(tmp_path, backend):
+    storage = CachedStorage(create_storage(backend, tmp_path), max_entries=1, flush_interval=60)
+    storage.save_history(1, HISTORY)
+    compacted = [HISTORY[0], message("system", "сводка")]
+    storage.save_history(1, compacted)
+    # Чат 1 вытеснен из кэша до записи на диск, но читается из памяти
+    storage.save_history(2, HISTORY[:1])
+    assert storage.load_history(1) == compacted
+    storage.close()
+    storage = create_storage(backend, tmp_path)
+    assert storage.load_history(1) == compacted
+    assert storage.load_history(2) == HISTORY[:1]
+    storage.close()
+
+
+def test_histories_during_save(tmp_path):
+    storage = AppendOnlyStorage(tmp_path)
+    history = [message("system", "s")]
+    storage.save_history(1, history)
+    stop = threading.Event()
+    scans = []
+
+    def scan():
+        # Как сборка вложений: чтение, пока другой поток дописывает файл
+        while not stop.is_set():
+            scans.append(dict(storage.histories()))
+
+    scanner = threading.Thread(target=scan)
+    scanner.start()
+    try:
+        for i in range(500):
+            history = history + [message("user", f"вопрос {i}"), message("assistant", f"ответ {i}")]
+            storage.save_history(1, history)
+    finally:
+        stop.set()
+        scanner.join()
+    assert scans
+    assert AppendOnlyStorage(tmp_path).load_history(1) == history
+
+
+def test_histories_do_not_repair_line_being_written(tmp_path):
+    # Файл дописывает другой процесс (шард): просмотр видит строку наполовину
+    writer = AppendOnlyStorage(tmp_path)
+    writer.save_history(1, HISTORY)
+    line = json.dumps(message("user", "еще"), ensure_ascii=False) + "\n"
+    path = tmp_path / "chat_1.jsonl"
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line[:10])
+    reader = AppendOnlyStorage(tmp_path)
+    assert dict(reader.histories()) == {1: HISTORY}
+    assert reader._counts == {}
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line[10:])
+    assert AppendOnlyStorage(tmp_path).load_history(1) == HISTORY + [message("user", "еще")]
+
+
+def test_cached_histories_do_not_read_cached_chats(tmp_path):
+    backend = AppendOnlyStorage(tmp_path)
+    backend.save_history(1, HISTORY)
+    backend.save_history(2, HISTORY[:1])
+    read = []
+    read_history = backend.read_history
+    backend.read_history = lambda chat_id: read.append(chat_id) or read_history(chat_id)
+    storage = CachedStorage(backend, flush_interval=60)
+    storage.save_history(1, HISTORY + [message("user", "еще")])
+    assert dict(storage.histories()) == {1: HISTORY + [message("user", "еще")], 2: HISTORY[:1]}
+    assert read == [2]
+    storage.close()
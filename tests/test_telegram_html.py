@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Тесты render_chunks: лимит длины, закрытые теги и крайние случаи"""
+
+import pytest
+
+from telegram_html import _balanced, html_to_text, message_length, render_chunks, render_inline
+
+
+def test_empty_text():
+    assert render_chunks("") == []
+    assert render_chunks(None) == []
+    assert render_chunks(" \n\n ") == []
+
+
+def test_markup():
+    assert render_chunks("**жирный** и `код`") == ["<b>жирный</b> и <code>код</code>"]
+    assert render_chunks("```python\nx = 1 < 2\n```") == [
+        '<pre><code class="language-python">x = 1 &lt; 2</code></pre>']
+
+
+def test_unpaired_markup_stays_text():
+    chunk, = render_chunks("2 * 3 = 6, snake_case и <tag>")
+    assert "<b>" not in chunk and "<i>" not in chunk
+    assert html_to_text(chunk) == "2 * 3 = 6, snake_case и <tag>"
+
+
+def test_inline_code_in_link_text():
+    assert render_inline("[`code`](https://x.com) и `a`") == (
+        '<a href="https://x.com"><code>code</code></a> и <code>a</code>')
+
+
+def test_placeholder_characters_in_text():
+    assert "\x00" not in render_inline("a\x000\x00b `c`")
+
+
+@pytest.mark.parametrize("text", [
+    "слово " * 2000,
+    "\n".join(f"- пункт **{i}** со ссылкой [x](https://x.com/{i})" for i in range(500)),
+    "```\n" + "\n".join(f"print({i})  # <комментарий> & 😀" for i in range(800)) + "\n```",
+    "начало\n```js\n" + "x();\n" * 3000 + "```\nконец",
+    "a" * 10000,
+])
+def test_chunks_fit_limit_and_balanced(text):
+    chunks = render_chunks(text, limit=1000)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert message_length(chunk) <= 1000
+        assert _balanced(chunk)
+
+
+def test_code_block_split_keeps_pre():
+    chunks = render_chunks("```\n" + "line\n" * 1000 + "```", limit=500)
+    assert all(chunk.startswith("<pre>") and chunk.endswith("</pre>") for chunk in chunks)
+    assert sum(html_to_text(chunk).count("line") for chunk in chunks) == 1000
+
+
+def test_length_in_utf16_units():
+    # Эмодзи вне BMP занимает в Telegram две единицы
+    assert message_length("😀") == 2
+    chunks = render_chunks("😀" * 600, limit=1000)
+    assert all(message_length(chunk) <= 1000 for chunk in chunks)
+    assert "".join(chunks) == "😀" * 600
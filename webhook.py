@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Прием обновлений Telegram через webhook.
+
+Встроенный HTTP сервер принимает POST с JSON обновления, проверяет
+заголовок X-Telegram-Bot-Api-Secret-Token и передает обновление в
+диспетчер. Обработчики выполняются в его потоках, поэтому Telegram
+получает ответ 200 сразу, не дожидаясь ответа модели.
+
+Для локальной проверки достаточно отправить записанное обновление:
+curl -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" -d @update.json http://127.0.0.1:8080/telegram
+"""
+
+import hmac
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telebot import types
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Обновления Telegram намного меньше; больший запрос - не от Telegram
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """Обработчик запросов Telegram к webhook"""
+
+    # Keep-alive: Telegram переиспользует соединения для следующих обновлений
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if self.path != self.server.path:
+            self._respond(404)
+            return
+
+        token = self.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(token.encode("utf-8"), self.server.secret_token.encode("utf-8")):
+            self._respond(403)
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._respond(400)
+            return
+        if length > MAX_BODY_SIZE:
+            self._respond(413)
+            return
+
+        try:
+            update = types.Update.de_json(json.loads(self.rfile.read(length)))
+        except Exception as e:
+            log.warning("webhook_bad_update", error=e)
+            self._respond(400)
+            return
+
+        self.server.received += 1
+        try:
+            self.server.on_updates([update])
+        except Exception:
+            # Повторная доставка того же обновления не поможет - подтверждаем его
+            log.exception("webhook_dispatch_failed", update_id=update.update_id)
+        self._respond(200)
+
+    def do_GET(self):
+        self._respond(405)
+
+    def _respond(self, status):
+        body = b"ok" if status == 200 else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        if status != 200:
+            # Тело отклоненного запроса не прочитано (или не разобрано): на этом соединении
+            # оно было бы принято за следующий запрос, поэтому соединение закрываем
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Запросы Telegram не логируем: их столько же, сколько сообщений
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """HTTP сервер webhook: каждый запрос обрабатывается в своем потоке"""
+
+    daemon_threads = True
+
+    def __init__(self, host, port, path, secret_token, on_updates):
+        super().__init__((host, port), WebhookRequestHandler)
+        self.path = path
+        self.secret_token = secret_token
+        self.on_updates = on_updates
+        self.received = 0